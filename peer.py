@@ -20,15 +20,29 @@ peer.py
 """
 
 import os
+import re
 import sys
 import json
 import time
+import asyncio
 import uuid
+import math
+import heapq
+import bisect
+import base64
+import urllib.parse
+import queue
 import random
 import socket
+import gzip
+import struct
+import select
 import hashlib
 import datetime
+import itertools
+import collections
 import threading
+import concurrent.futures
 
 #---# WELL KNOWN HOST INFORMATION #---#
 # You may adjust these values to      #
@@ -43,23 +57,267 @@ DEFAULT_P2P_PORT = 8270
 DEFAULT_HTTP_PORT = 8080
 DEFAULT_BASE_PATH = "./"
 DEBUG_ENABLED = False
+METADATA_JOURNAL_ENABLED = True # journal metadata changes instead of rewriting metadata.json
+ASYNC_ENABLED = False # serve P2P and HTTP connections from one asyncio event loop instead of a thread per connection
 #--------------------------#
 
 #---# Program Constants #---#
 METADATA_FILE = "metadata.json"
+METADATA_JOURNAL_FILE = "metadata.journal"
+METADATA_JOURNAL_MAX_SIZE = 1024 * 1024 #bytes -- compact the journal into metadata.json past this size
 FILE_UPLOAD_PATH = "FileUploads"
 PEER_TIMEOUT = 60 #seconds # How long must a peer be inactive for before it is untracked
 PEER_CLEANUP_INTERVAL = 10 #seconds # How long between checking for inactive peers
 GOSSIP_INTERVAL = 30 #seconds -- How often peer gossips
 GOSSIP_PEER_COUNT = 3 # how many peers do we attempt to gossip to
 NUM_FILES_ON_JOIN = 3 # how many files do we attempt to get on join
+METADATA_FLUSH_DELAY = 1 #seconds -- longest a metadata change waits before it is written to disk
+PROTOCOL_FEATURES = ["binary", "framed", "ranges", "pipeline", "busy", "announce_batch", "delta", "sync"] # optional protocol features this peer supports, advertised to other peers
+FRAME_MAGIC = b"\x00TDF" # starts a length-prefixed message. JSON messages never start with a NUL byte
+FRAME_HEADER = struct.Struct("!4sI") # FRAME_MAGIC + payload length
+MAX_FRAME_SIZE = 256 * 1024 * 1024 #bytes -- largest framed message we accept
+MAX_FILE_DATA_SIZE = 1024 * 1024 * 1024 #bytes -- largest raw data we accept after a binary FILE_DATA header. Whole files are received into memory
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024 #bytes -- size of the chunks we request in a chunked download
+MAX_CHUNK_SIZE = 16 * 1024 * 1024 #bytes -- largest chunk we serve for a single ranged GET_FILE
+STREAM_BUFFER_SIZE = 64 * 1024 #bytes -- buffer used when a file can't be sent with sendfile, or must be hashed or hex-encoded
+SWARM_MAX_PEERS = 8 # how many peers we download chunks of one file from at once
+SWARM_CHUNK_TIMEOUT = 15 #seconds -- how long a peer has to answer a chunk request before the chunk goes to another peer
+POOL_IDLE_TIMEOUT = 20 #seconds -- how long a pooled connection to a peer may sit unused before we close it
+POOL_MAX_IDLE_PER_PEER = 4 # most unused connections we keep open to one peer
+SERVER_IDLE_TIMEOUT = 60 #seconds -- how long we keep an incoming connection open without receiving a message
+ASYNC_EXECUTOR_WORKERS = 16 # threads the asyncio servers hand blocking disk and network work to
+MESSAGE_WORKERS = 8 # threads that run the handlers for incoming messages
+MESSAGE_RESERVED_WORKERS = 2 # message workers kept free of bulk messages, so gossip never waits on file transfers
+MESSAGE_PRIORITIES = {"GOSSIP": 0, "GOSSIP_REPLY": 0, "ANNOUNCE": 1, "ANNOUNCE_BATCH": 1, "DELETE": 1, "SYNC": 1, "GET_FILE": 2, "FILE_DATA": 2} # lower is handled first
+BULK_MESSAGE_PRIORITY = 2 # messages with this priority are bulk file transfers
+MESSAGE_QUEUE_LIMITS = {"GOSSIP": 256, "GOSSIP_REPLY": 256, "ANNOUNCE": 256, "ANNOUNCE_BATCH": 64, "DELETE": 256, "SYNC": 64, "GET_FILE": 32, "FILE_DATA": 8} # most messages of a type waiting for a worker
+DEFAULT_MESSAGE_QUEUE_LIMIT = 64 # most waiting messages of a type not in MESSAGE_QUEUE_LIMITS
+UNSHED_MESSAGE_TYPES = {"FILE_DATA"} # never shed when their queue is full, the connection waits for room instead, which slows the sender down
+BUSY_RETRY_AFTER = 1 #seconds -- how long we ask a peer to wait before retrying a request we were too busy for
+SWARM_BUSY_RETRIES = 5 # how many BUSY replies in a row a peer may send before we stop downloading from it
+BROADCAST_PARALLELISM = 16 # most messages a broadcast sends at once
+BROADCAST_DEADLINE = 10 #seconds -- longest a broadcast waits for its sends to finish
+ANNOUNCE_COALESCE_WINDOW = 0.5 #seconds -- how long announcements for a peer are collected before they are sent as one batch
+ANNOUNCE_BATCH_MAX_FILES = 256 # most files announced in one ANNOUNCE_BATCH
+GOSSIP_ID_TTL = 300 #seconds -- how long a gossip id is remembered. Much longer than gossip takes to spread through the network
+GOSSIP_ID_BUCKETS = 10 # generations the remembered gossip ids are split into. One expires every GOSSIP_ID_TTL / GOSSIP_ID_BUCKETS seconds
+GOSSIP_ID_MAX = 100000 # most gossip ids remembered at once, whatever their age
+INVENTORY_CHANGELOG_SIZE = 4096 # most changed files remembered for delta gossip replies. Peers further behind get a full reply
+SYNC_INTERVAL = 60 #seconds -- how often we compare metadata with a random peer
+SYNC_TREE_DEPTH = 3 # file_id prefix length of the leaves of the metadata digest. 16^3 leaves for hex file_ids
+SYNC_LEAF_ENTRIES = 32 # a differing subtree with at most this many entries is sent whole instead of being walked down
+SYNC_TOMBSTONE_TTL = 3600 #seconds -- how long a deleted file_id is kept from coming back through a sync
+FILE_FILTER_FALSE_POSITIVE_RATE = 0.01 # chance the Bloom filter of our files in GOSSIP claims a file we don't have
+METADATA_CHANGELOG_SIZE = 4096 # most changed files the metadata store remembers, so readers can rebuild only those. Readers further behind rebuild everything
+STATS_CHANGELOG_SIZE = 4096 # most changed files remembered for /stats.json?since= deltas. Older versions get the full document
+STATS_PAGE_SIZE = 100 # files in a page of /stats.json when the query doesn't give a limit
+STATS_MAX_PAGE_SIZE = 1000 # most files in a page of /stats.json
+STATS_QUERY_PARAMS = ("limit", "cursor", "location", "owner", "prefix", "sort", "order") # /stats.json query parameters that ask for a page of the files
+STATS_SORT_KEYS = {"name": "file_name", "size": "file_size", "timestamp": "file_timestamp", "replicas": "peers_with_file"} # ?sort= values, and the field they sort by
+EVENTS_CHECK_INTERVAL = 0.5 #seconds -- how often peers and files are checked for changes to push to /events, while anyone is watching
+EVENTS_KEEPALIVE = 15 #seconds -- longest an /events stream goes without sending anything
+EVENTS_QUEUE_LIMIT = 256 # most events waiting for one /events subscriber. One further behind is dropped and reconnects
+HTTP_KEEPALIVE_TIMEOUT = 15 #seconds -- how long the webserver keeps an idle HTTP connection open for the next request
+HTTP_MAX_REQUEST_SIZE = 16 * 1024 #bytes -- largest HTTP request head we read
+HTTP_GZIP_MIN_SIZE = 1024 #bytes -- smaller responses are not worth compressing
+HTTP_GZIP_LEVEL = 6 # gzip compression level for HTTP responses
+STATIC_FILES = {"index.html": "text/html", "stats.js": "application/javascript", "style.css": "text/css"} # files of the stats page, and their content types
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30) #seconds -- histogram buckets for message handlers and metadata loads and saves
+METRICS_LOCK_BUCKETS = (0.000001, 0.00001, 0.0001, 0.001, 0.01, 0.1, 1) #seconds -- histogram buckets for METADATA_LOCK wait and hold times
 #---------------------------#
 
+#-----------------#
+#---# Metrics #---#
+#                 #
+# code related to #
+# /metrics        #
+#-----------------#
+def metrics_labels(label, value):
+    """Returns the Prometheus label set for label=value, or "" if the metric has no label"""
+    if label is None:
+        return ""
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'{{{label}="{value}"}}'
+# end metrics_labels()
+
+class Counter:
+    """
+    A Prometheus counter, optionally split by one label.
+    Counting takes a lock of its own, so threads counting different things don't wait on each other.
+    """
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {} if label else {None: 0} # key: label value (None without a label), value: count
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, label_value=None):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def retire(self, label_value, into):
+        """Drop the series for label_value, adding its count to the series for into, so totals still add up"""
+        with self.lock:
+            count = self.values.pop(label_value, None)
+            if count is not None:
+                self.values[into] = self.values.get(into, 0) + count
+
+    def render(self):
+        """Returns the lines of the counter in the Prometheus text format"""
+        with self.lock:
+            values = sorted(self.values.items(), key=lambda item: str(item[0]))
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{metrics_labels(self.label, label_value)} {value}" for label_value, value in values)
+        return lines
+# end Counter
+
+class Histogram:
+    """
+    A Prometheus histogram, optionally split by one label.
+    Each observation adds one to a single bucket; the counts are only made cumulative when rendered.
+    """
+    def __init__(self, name, help, buckets=METRICS_LATENCY_BUCKETS, label=None):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.label = label
+        self.values = {} # key: label value, value: [count per bucket, with +Inf last, sum of observations]
+        self.lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(label_value)
+            if series is None:
+                series = self.values[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bucket] += 1
+            series[1] += value
+
+    def render(self):
+        """Returns the lines of the histogram in the Prometheus text format"""
+        with self.lock:
+            values = sorted(((label_value, list(counts), total) for label_value, (counts, total) in self.values.items()), key=lambda item: str(item[0]))
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_value, counts, total in values:
+            labels = metrics_labels(self.label, label_value)
+            inner = labels[1:-1] + "," if labels else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{inner}le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+# end Histogram
+
+class TimedLock:
+    """
+    Wraps a threading.RLock to time how long threads wait for it and how long they hold it.
+    Only the outermost acquire of a thread is timed, re-entering is free.
+    """
+    def __init__(self, lock, wait, hold):
+        self.lock = lock
+        self.wait = wait # Histogram of the seconds waited to get the lock
+        self.hold = hold # Histogram of the seconds the lock was held
+        self.local = threading.local() # depth: how many times the thread holds the lock, acquired: since when
+
+    def acquire(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        depth = getattr(self.local, "depth", 0)
+        self.local.depth = depth + 1
+        if depth == 0:
+            self.local.acquired = time.perf_counter()
+            self.wait.observe(self.local.acquired - start)
+        return True
+
+    def release(self):
+        self.local.depth -= 1
+        if self.local.depth == 0:
+            self.hold.observe(time.perf_counter() - self.local.acquired)
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+# end TimedLock
+
+class Metrics:
+    """
+    The metrics served at /metrics, in the Prometheus text format.
+
+    The hot paths only add to counters and histograms. Everything that is already counted
+    elsewhere (peers, files, queues, caches) is read when /metrics is requested.
+    """
+    def __init__(self):
+        self.received = Counter("peer_messages_received_total", "Messages received, by type.", "type")
+        self.messages = Histogram("peer_message_handler_seconds", "Time spent handling messages, by type.", label="type")
+        self.bytes_received = Counter("peer_bytes_received_total", "Bytes received from peers.")
+        self.bytes_sent = Counter("peer_bytes_sent_total", "Bytes sent to peers.")
+        self.send_failures = Counter("peer_send_failures_total", "Messages and files that could not be sent, by tracked peer_id. Peers no longer tracked are counted as removed, addresses never tracked as untracked.", "peer")
+        self.lock_wait = Histogram("peer_metadata_lock_wait_seconds", "Time spent waiting for METADATA_LOCK.", METRICS_LOCK_BUCKETS)
+        self.lock_hold = Histogram("peer_metadata_lock_hold_seconds", "Time METADATA_LOCK was held.", METRICS_LOCK_BUCKETS)
+        self.metadata_load = Histogram("peer_metadata_load_seconds", "Time spent loading the metadata from disk.")
+        self.metadata_save = Histogram("peer_metadata_save_seconds", "Time spent writing the metadata to disk, by journal, snapshot or compact.", label="kind")
+
+    def message_type(self, msg_type):
+        """Returns the label for msg_type. Types we don't know are all "other", so peers can't make up new series"""
+        return msg_type if msg_type in MESSAGE_PRIORITIES else "other"
+
+    def send_failed(self, peer_id):
+        """Count a failed send to peer_id, which is None when we don't know who is at the address"""
+        self.send_failures.inc(label_value=peer_id if peer_id is not None and peer_id in tracked_peers else "untracked")
+
+    def peer_removed(self, peer_id):
+        """Fold the series of a peer we stopped tracking into "removed", so there is one series per tracked peer"""
+        self.send_failures.retire(peer_id, "removed")
+
+    def handled(self, msg_type, seconds):
+        """Count a message of msg_type that took seconds to handle"""
+        self.messages.observe(seconds, self.message_type(msg_type))
+
+    def render(self):
+        """Returns the whole /metrics document"""
+        lines = []
+        for metric in (self.received, self.messages, self.bytes_received, self.bytes_sent, self.send_failures,
+                       self.lock_wait, self.lock_hold, self.metadata_load, self.metadata_save):
+            lines.extend(metric.render())
+
+        def collected(name, type, help, values, label=None):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {type}")
+            if label is None:
+                lines.append(f"{name} {values}")
+            else:
+                lines.extend(f"{name}{metrics_labels(label, key)} {value}" for key, value in sorted(values.items()))
+
+        with message_pool.condition:
+            queued = {msg_type: len(queue) for msg_type, queue in message_pool.queues.items()}
+            rejected = dict(message_pool.rejected)
+            busy = message_pool.workers - message_pool.idle
+        gossip_ids = seen_gossip_ids.stats()
+        collected("peer_messages_rejected_total", "counter", "Messages shed because the queue for their type was full, by type.", rejected, "type")
+        collected("peer_message_queue_length", "gauge", "Messages waiting for a worker, by type.", queued, "type")
+        collected("peer_handler_threads_active", "gauge", "Message workers handling a message.", busy)
+        collected("peer_handler_threads", "gauge", "Message workers.", message_pool.workers)
+        collected("peer_threads", "gauge", "Threads running in the peer.", threading.active_count())
+        collected("peer_tracked_peers", "gauge", "Peers being tracked.", len(tracked_peers))
+        collected("peer_catalog_files", "gauge", "Files in the metadata.", len(metadata_store))
+        collected("peer_gossip_id_cache_size", "gauge", "Gossip ids remembered.", gossip_ids["size"])
+        for name in ("hits", "misses", "evictions"):
+            collected(f"peer_gossip_id_cache_{name}_total", "counter", f"Gossip id cache {name}.", gossip_ids[name])
+        collected("peer_file_filter_false_positives_total", "counter", "Peers asked for a file their file filter wrongly said they may have.", holder_filters.false_positives)
+        return "\n".join(lines) + "\n"
+# end Metrics
+
+metrics = Metrics()
+
 #---# Program Globals #---#
-tracked_peers = {} # key: peerId, value: dict with host, port, last_seen
-seen_gossip_ids = set() # uses a set to avoid repeats
 server_ready = threading.Event()
-METADATA_LOCK = threading.RLock()
+METADATA_LOCK = TimedLock(threading.RLock(), metrics.lock_wait, metrics.lock_hold)
 #-------------------------#
 
 def debug(*args):
@@ -70,26 +328,775 @@ def debug(*args):
         print("[DEBUG]", *args)
 # end debug()
 
+def describe_message(msg):
+    """
+    Short description of a received message for debug output. Cheap to build, and never
+    includes the file data a FILE_DATA carries.
+    """
+    if not msg:
+        return repr(msg)
+    parts = [str(msg.get("type"))]
+    for field in ("file_id", "data_length"):
+        if field in msg:
+            parts.append(f"{field}={msg[field]}")
+    return " ".join(parts)
+# end describe_message()
+
 #-----------------------------#
 #---# Metadata Management #---#
 #                             #
 # code related to managing    #
 # the metadata of files       #
 #-----------------------------#
-def load_metadata():
+class CatalogDigest:
+    """
+    Merkle digest of the file metadata, keyed by file_id prefix, so two peers can find where
+    their metadata differs without sending all of it.
+
+    Every prefix of length 0 to depth is a node. A node's hash is the XOR of the hashes of the
+    entries under it, so a change to one entry updates depth + 1 nodes in O(1) each. Two nodes
+    with the same hash hold the same entries. Leaves (prefixes of length depth) also keep
+    their file_ids, so the entries under any node can be listed.
+
+    Only the metadata itself is hashed. Which peers have a file is each peer's own view.
+    """
+    def __init__(self, depth=SYNC_TREE_DEPTH):
+        self.depth = depth
+        self.clear()
+
+    def clear(self):
+        """Forget every entry"""
+        self.leaf_hashes = {} # key: file_id, value: hash of its entry
+        self.nodes = {} # key: prefix, value: [hash, number of entries under it]
+        self.children = {} # key: prefix, value: set of the child prefixes with entries under them
+        self.buckets = {} # key: leaf prefix, value: set of the file_ids in it
+
+    def key(self, file_id):
+        """Return the leaf prefix of file_id. Short file_ids are padded so every leaf is depth long"""
+        return file_id[:self.depth].ljust(self.depth, "_")
+
+    def put(self, file_id, entry):
+        """Add or replace the entry of file_id"""
+        if file_id in self.leaf_hashes:
+            self.remove(file_id)
+        entry_hash = int.from_bytes(hashlib.sha256(json.dumps(entry, sort_keys=True).encode()).digest()[:16], "big")
+        self.leaf_hashes[file_id] = entry_hash
+        key = self.key(file_id)
+        self.buckets.setdefault(key, set()).add(file_id)
+        for length in range(self.depth + 1):
+            prefix = key[:length]
+            node = self.nodes.setdefault(prefix, [0, 0])
+            node[0] ^= entry_hash
+            node[1] += 1
+            if length:
+                self.children.setdefault(key[:length - 1], set()).add(prefix)
+
+    def remove(self, file_id):
+        """Remove the entry of file_id, if present"""
+        entry_hash = self.leaf_hashes.pop(file_id, None)
+        if entry_hash is None:
+            return
+        key = self.key(file_id)
+        bucket = self.buckets[key]
+        bucket.discard(file_id)
+        if not bucket:
+            del self.buckets[key]
+        for length in range(self.depth, -1, -1):
+            prefix = key[:length]
+            node = self.nodes[prefix]
+            node[0] ^= entry_hash
+            node[1] -= 1
+            if not node[1]:
+                del self.nodes[prefix]
+                self.children.pop(prefix, None)
+                if length:
+                    self.children[key[:length - 1]].discard(prefix)
+
+    def hash(self, prefix):
+        """Return the hash of the node at prefix as hex. Empty nodes hash to zero"""
+        return format(self.nodes.get(prefix, (0, 0))[0], "032x")
+
+    def count(self, prefix):
+        """Return the number of entries under prefix"""
+        return self.nodes.get(prefix, (0, 0))[1]
+
+    def child_hashes(self, prefix):
+        """Return the hashes of the non-empty children of prefix"""
+        return {child: self.hash(child) for child in self.children.get(prefix, ())}
+
+    def file_ids(self, prefix):
+        """Return the file_ids under prefix"""
+        if len(prefix) == self.depth:
+            return list(self.buckets.get(prefix, ()))
+        file_ids = []
+        for child in self.children.get(prefix, ()):
+            file_ids.extend(self.file_ids(child))
+        return file_ids
+# end CatalogDigest
+
+class MetadataStore:
+    """
+    Authoritative in-memory copy of the file metadata.
+
+    All reads and writes go to the in-memory dictionary, so they cost O(1) per entry.
+    Changes mark the store dirty, and a background flusher persists them at most
+    METADATA_FLUSH_DELAY seconds later. Many changes close together are coalesced into a
+    single write.
+
+    Persistence has two modes:
+        journaled (default): every change is appended as one JSON line to METADATA_JOURNAL_FILE.
+            On load the journal is replayed over the last snapshot in METADATA_FILE. Once the
+            journal grows past METADATA_JOURNAL_MAX_SIZE it is compacted into a new snapshot.
+        snapshot: the whole store is written to METADATA_FILE on every flush.
+
+    Snapshots are written atomically (temp file + rename). The store is guarded by METADATA_LOCK.
+
+    Which peers have which files is kept apart from the entries, in two indexes: the peers with
+    each file (an insertion-ordered set) and the files each peer has. Checking whether a peer has
+    a file is O(1), and removing a peer costs O(files that peer has). Entries handed out by get()
+    and snapshot(), and written to disk, get their peers_with_file back as a list.
+    """
+    def __init__(self, path, journal_path, flush_delay=METADATA_FLUSH_DELAY):
+        self.path = path
+        self.journal_path = journal_path
+        self.journal_enabled = True
+        self.flush_delay = flush_delay
+        self.entries = {} # key: file_id, value: file metadata, without peers_with_file
+        self.holders = {} # key: file_id, value: dict of the peer_ids with the file, used as an ordered set
+        self.files_by_peer = {} # key: peer_id, value: set of the file_ids the peer has
+        self.digest = CatalogDigest() # Merkle digest of the entries, for SYNC
+        self.deleted = collections.OrderedDict() # key: file_id deleted recently, value: when, oldest first
+        self.version = 0 # counts changes, so readers can cheaply tell whether anything changed
+        self.changelog = collections.OrderedDict() # key: file_id, value: version of its last change, oldest first
+        self.forgotten = 0 # newest version dropped from the changelog, or that changed every file
+        self.local_version = 0 # counts changes to our local files, for Inventory. Bumped by whoever writes to FileUploads, and by loads and resets
+        self.pending = [] # journal records not yet written to disk
+        self.dirty = False
+        self.dirty_event = threading.Event()
+        self.flush_lock = threading.Lock() # only one write to disk at a time
+        self.flusher_thread = None
+
+    def load(self, journal=True):
+        """
+        Replace the in-memory metadata with the snapshot in the metadata file, then replay
+        the journal over it.
+        """
+        start = time.perf_counter()
+        with METADATA_LOCK:
+            self.journal_enabled = journal
+            self.set_entries(load_metadata(self.path))
+            self.pending = []
+            self.dirty = False
+            replayed = self.replay_journal()
+        metrics.metadata_load.observe(time.perf_counter() - start)
+
+        if replayed and not self.journal_enabled:
+            # switching back to snapshot mode, fold the journal into the snapshot
+            self.compact()
+        elif self.journal_size() > METADATA_JOURNAL_MAX_SIZE:
+            self.compact()
+
+    def replay_journal(self):
+        """Apply every record in the journal to the in-memory metadata. Returns the number of records applied"""
+        count = 0
+        good_size = 0 # bytes of the journal holding complete records
+        try:
+            with open(self.journal_path, "rb") as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("record is missing its newline")
+                        record = json.loads(line)
+                    except ValueError:
+                        # only the last record can be partial, after a crash. Cut it off so
+                        # new records are not appended onto it.
+                        debug("Dropping a partially written metadata journal record.")
+                        f.close()
+                        os.truncate(self.journal_path, good_size)
+                        break
+                    self.apply(record)
+                    good_size += len(line)
+                    count += 1
+        except FileNotFoundError:
+            pass
+        debug(f"Replayed {count} metadata journal record(s).")
+        return count
+
+    def journal_size(self):
+        """Size in bytes of the journal on disk"""
+        try:
+            return os.path.getsize(self.journal_path)
+        except OSError:
+            return 0
+
+    def start_flusher(self):
+        """Start the background thread that writes dirty metadata to disk"""
+        if self.flusher_thread is None:
+            self.flusher_thread = threading.Thread(target=self.flush_loop, daemon=True)
+            self.flusher_thread.start()
+
+    def flush_loop(self):
+        """
+        Waits for the store to become dirty, then waits flush_delay more seconds so that
+        changes arriving together are written once.
+        """
+        while True:
+            self.dirty_event.wait()
+            time.sleep(self.flush_delay)
+            self.flush()
+
+    def record(self, record):
+        """Apply a change to the in-memory metadata and queue it to be persisted. Returns True if anything changed"""
+        with METADATA_LOCK:
+            changed = self.apply(record)
+            if changed:
+                self.queue(record)
+            return changed
+
+    def queue(self, record):
+        """Queue an already applied change to be persisted by the flusher"""
+        self.version += 1
+        if self.journal_enabled:
+            self.pending.append(record)
+        self.dirty = True
+        self.dirty_event.set()
+
+    def apply(self, record):
+        """
+        Apply one journal record to the in-memory metadata. Returns True if anything changed.
+
+        Records are:
+            {"op": "put", "file_id", "entry"}: a new file, or a newer version of a file
+            {"op": "add_peer", "file_id", "peer_id"}: peer_id now has a copy of file_id
+            {"op": "remove_peer", "peer_id"}: peer_id no longer has any files
+            {"op": "remove_holder", "file_id", "peer_id"}: peer_id no longer has file_id
+            {"op": "delete", "file_id"}: file_id was deleted
+            {"op": "reset", "peer_id", "keep"}: only keep the files in keep, held by peer_id alone
+            {"op": "batch", "records"}: several of the above, applied in order
+        """
+        op = record["op"]
+
+        if op == "put":
+            self.put_entry(record["file_id"], record["entry"])
+            self.changed(record["file_id"])
+            return True
+
+        if op == "add_peer":
+            if record["file_id"] not in self.entries:
+                return False
+            if not self.add_holder(record["file_id"], record["peer_id"]):
+                return False
+            self.changed(record["file_id"])
+            return True
+
+        if op == "remove_peer":
+            file_ids = self.files_by_peer.pop(record["peer_id"], None)
+            if not file_ids:
+                return False
+            for file_id in file_ids:
+                del self.holders[file_id][record["peer_id"]]
+                self.changed(file_id)
+            return True
+
+        if op == "remove_holder":
+            holders = self.holders.get(record["file_id"])
+            if holders is None or record["peer_id"] not in holders:
+                return False
+            del holders[record["peer_id"]]
+            file_ids = self.files_by_peer[record["peer_id"]]
+            file_ids.discard(record["file_id"])
+            if not file_ids:
+                del self.files_by_peer[record["peer_id"]]
+            self.changed(record["file_id"])
+            return True
+
+        if op == "delete":
+            if self.entries.pop(record["file_id"], None) is None:
+                return False
+            self.clear_holders(record["file_id"])
+            self.digest.remove(record["file_id"])
+            self.remember_deleted(record["file_id"])
+            self.changed(record["file_id"])
+            return True
+
+        if op == "batch":
+            updated = False
+            for inner in record["records"]:
+                updated = self.apply(inner) or updated
+            return updated
+
+        if op == "reset":
+            keep = set(record["keep"])
+            peer_id = record["peer_id"]
+            for file_id in [file_id for file_id in self.entries if file_id not in keep]:
+                del self.entries[file_id]
+                self.digest.remove(file_id)
+            self.holders = {file_id: {peer_id: None} for file_id in self.entries}
+            self.files_by_peer = {peer_id: set(self.entries)} if self.entries else {}
+            self.local_version += 1
+            self.changed_all()
+            return True
+
+        debug(f"Unknown metadata journal record: {op}")
+        return False
+
+    def flush(self):
+        """Persist any changes made since the last write"""
+        with self.flush_lock:
+            with METADATA_LOCK:
+                if not self.dirty:
+                    return
+                self.dirty = False
+                self.dirty_event.clear()
+
+                if not self.journal_enabled:
+                    # copy under the lock, serialize outside of it
+                    data = self.snapshot()
+                else:
+                    records = self.pending
+                    self.pending = []
+
+            start = time.perf_counter()
+            if not self.journal_enabled:
+                save_metadata(data, self.path)
+                metrics.metadata_save.observe(time.perf_counter() - start, "snapshot")
+                return
+
+            try:
+                with open(self.journal_path, "a") as f:
+                    f.write("".join(json.dumps(record) + "\n" for record in records))
+                    f.flush()
+                    os.fsync(f.fileno())
+            except IOError as e:
+                debug(f"Failed to write metadata journal {self.journal_path}: {e}")
+                return
+            metrics.metadata_save.observe(time.perf_counter() - start, "journal")
+
+        if self.journal_size() > METADATA_JOURNAL_MAX_SIZE:
+            self.compact()
+
+    def compact(self):
+        """Write the whole store as a new snapshot and empty the journal"""
+        with self.flush_lock:
+            start = time.perf_counter()
+            with METADATA_LOCK:
+                data = self.snapshot()
+                # the snapshot covers everything not yet journaled too
+                self.pending = []
+            if not save_metadata(data, self.path):
+                return # keep the journal, the old snapshot + journal are still valid
+            metrics.metadata_save.observe(time.perf_counter() - start, "compact")
+            try:
+                with open(self.journal_path, "w"):
+                    pass # truncate
+            except IOError as e:
+                debug(f"Failed to truncate metadata journal {self.journal_path}: {e}")
+            debug(f"Compacted metadata journal into {self.path}")
+
+    def get(self, file_id):
+        """Return a copy of the metadata for file_id, or None if unknown"""
+        with METADATA_LOCK:
+            return self.export(file_id) if file_id in self.entries else None
+
+    def snapshot(self):
+        """Return a copy of all metadata as a dictionary"""
+        with METADATA_LOCK:
+            return {file_id: self.export(file_id) for file_id in self.entries}
+
+    def __contains__(self, file_id):
+        return file_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def build_put(self, file_id, file_metadata):
+        """
+        Build the put record for file_metadata if it is new or newer than what we have.
+        Returns None if there is nothing to update, or file_metadata is malformed.
+        """
+        if not valid_file_metadata(file_metadata):
+            return None # bad entry
+        old = self.entries.get(file_id)
+
+        if old is None:
+            # New file - initialize peers_with_file if missing
+            entry = dict(file_metadata)
+            entry["peers_with_file"] = list(file_metadata.get("peers_with_file") or [])
+            return {"op": "put", "file_id": file_id, "entry": entry}
+
+        if file_metadata["file_timestamp"] > old["file_timestamp"]:
+            # keep dynamic lists like peers_with_file
+            updated = dict(file_metadata) # start with new data
+            updated["peers_with_file"] = list(self.holders.get(file_id, ()))
+            return {"op": "put", "file_id": file_id, "entry": updated}
+
+        return None # No update
+
+    def update(self, file_id, file_metadata):
+        """Add file_metadata if it is new or newer than what we have. Returns True if changed"""
+        with METADATA_LOCK:
+            put = self.build_put(file_id, file_metadata)
+            if put is None:
+                return False # No update
+            return self.record(put) # updated or added successfully
+
+    def merge(self, file_entries, peer_id, removed=()):
+        """
+        Merge a list of file metadata held by peer_id, such as the files of a GOSSIP_REPLY.
+        peer_id no longer has the file_ids in removed. With no peer_id, only the metadata is merged.
+
+        The whole list is applied under one lock acquisition and persisted as one journal
+        record. Returns the set of file_ids whose metadata was added or updated.
+        """
+        with METADATA_LOCK:
+            records = []
+            changed = set()
+            for file_metadata in file_entries:
+                if not valid_file_metadata(file_metadata):
+                    continue # bad entry
+                file_id = file_metadata["file_id"]
+
+                put = self.build_put(file_id, file_metadata)
+                if put is not None and self.apply(put):
+                    records.append(put)
+                    changed.add(file_id)
+
+                if peer_id is None:
+                    continue
+                add = {"op": "add_peer", "file_id": file_id, "peer_id": peer_id}
+                if self.apply(add):
+                    records.append(add)
+
+            for file_id in removed:
+                drop = {"op": "remove_holder", "file_id": file_id, "peer_id": peer_id}
+                if self.apply(drop):
+                    records.append(drop)
+
+            if records:
+                self.queue({"op": "batch", "records": records})
+            return changed
+
+    def changed(self, file_id):
+        """Log a change to file_id, under the version the change gets when it is queued"""
+        self.changelog[file_id] = self.version + 1
+        self.changelog.move_to_end(file_id)
+        while len(self.changelog) > METADATA_CHANGELOG_SIZE:
+            _, version = self.changelog.popitem(last=False)
+            self.forgotten = max(self.forgotten, version)
+
+    def changed_all(self):
+        """Log a change to every file"""
+        self.changelog.clear()
+        self.forgotten = self.version + 1
+
+    def changed_since(self, since):
+        """
+        Return the file_ids changed after version since, or None if the changelog doesn't go back
+        that far and everything must be rebuilt. Called with METADATA_LOCK held
+        """
+        if since is None or not self.forgotten <= since <= self.version:
+            return None
+        changed = []
+        for file_id in reversed(self.changelog):
+            if self.changelog[file_id] <= since:
+                break
+            changed.append(file_id)
+        return changed
+
+    def local_files_changed(self):
+        """
+        Note that a file in FileUploads was saved or removed. Call it after the file's metadata
+        was updated, so Inventory sees the file and its metadata together
+        """
+        with METADATA_LOCK:
+            self.local_version += 1
+
+    def add_peer(self, file_id, peer_id):
+        """Add peer_id to the peers_with_file of file_id. Returns True if added"""
+        return self.record({"op": "add_peer", "file_id": file_id, "peer_id": peer_id})
+
+    def remove_peer(self, peer_id):
+        """Remove peer_id from the peers_with_file of every file. Returns True if anything changed"""
+        return self.record({"op": "remove_peer", "peer_id": peer_id})
+
+    def delete(self, file_id):
+        """Remove file_id from the metadata. Returns True if it was known"""
+        return self.record({"op": "delete", "file_id": file_id})
+
+    def reset(self, keep_ids, peer_id):
+        """Drop every file not in keep_ids, and mark peer_id as the only peer with the kept files"""
+        return self.record({"op": "reset", "peer_id": peer_id, "keep": sorted(keep_ids)})
+
+    def set_entries(self, data):
+        """Replace all metadata with data, a dictionary of file_id to file metadata with peers_with_file lists"""
+        self.changed_all()
+        self.version += 1
+        self.local_version += 1
+        self.entries = {}
+        self.holders = {}
+        self.files_by_peer = {}
+        self.digest.clear()
+        for file_id, entry in data.items():
+            self.put_entry(file_id, entry)
+
+    def put_entry(self, file_id, entry):
+        """Store entry as the metadata of file_id. The peers in its peers_with_file replace the file's holders"""
+        entry = dict(entry)
+        peers = entry.pop("peers_with_file", None) or []
+        self.entries[file_id] = entry
+        self.digest.put(file_id, entry)
+        self.clear_holders(file_id)
+        self.holders[file_id] = {}
+        for peer_id in peers:
+            self.add_holder(file_id, peer_id)
+
+    def add_holder(self, file_id, peer_id):
+        """Index peer_id as having file_id. Returns True if it was not already"""
+        holders = self.holders[file_id]
+        if peer_id in holders:
+            return False
+        holders[peer_id] = None
+        self.files_by_peer.setdefault(peer_id, set()).add(file_id)
+        return True
+
+    def clear_holders(self, file_id):
+        """Remove file_id from the indexes"""
+        for peer_id in self.holders.pop(file_id, ()):
+            file_ids = self.files_by_peer.get(peer_id)
+            if file_ids is not None:
+                file_ids.discard(file_id)
+                if not file_ids:
+                    del self.files_by_peer[peer_id]
+
+    def export(self, file_id):
+        """Return a copy of the metadata of file_id, with its peers_with_file as a list"""
+        entry = dict(self.entries[file_id])
+        entry["peers_with_file"] = list(self.holders.get(file_id, ()))
+        return entry
+
+    def remember_deleted(self, file_id):
+        """Remember that file_id was deleted, and forget deletes older than SYNC_TOMBSTONE_TTL"""
+        now = time.time()
+        self.deleted.pop(file_id, None)
+        self.deleted[file_id] = now
+        while self.deleted and next(iter(self.deleted.values())) < now - SYNC_TOMBSTONE_TTL:
+            self.deleted.popitem(last=False)
+
+    def was_deleted(self, file_id):
+        """Return True if file_id was deleted in the last SYNC_TOMBSTONE_TTL seconds"""
+        with METADATA_LOCK:
+            deleted_at = self.deleted.get(file_id)
+            return deleted_at is not None and deleted_at >= time.time() - SYNC_TOMBSTONE_TTL
+
+    def holders_of(self, file_id):
+        """Return a list of the peer_ids with a copy of file_id, in the order they got it"""
+        with METADATA_LOCK:
+            return list(self.holders.get(file_id, ()))
+
+    def holds(self, file_id, peer_id):
+        """Return True if peer_id has a copy of file_id"""
+        with METADATA_LOCK:
+            return peer_id in self.holders.get(file_id, ())
+
+    def files_held_by(self, peer_id):
+        """Return the set of file_ids peer_id has a copy of"""
+        with METADATA_LOCK:
+            return set(self.files_by_peer.get(peer_id, ()))
+# end MetadataStore
+
+metadata_store = MetadataStore(METADATA_FILE, METADATA_JOURNAL_FILE)
+
+class Inventory:
+    """
+    Versions our inventory (the metadata of the files in FileUploads), so a GOSSIP_REPLY only
+    has to carry what changed since the peer asking last heard from us.
+
+    Each change to a local file, and each local file going away, takes the next version. The
+    changelog keeps the version of the last change to each file, oldest first, for at most
+    changelog_size files. A peer that has seen a version the changelog still covers gets a delta.
+    Anyone else gets everything. The epoch is new each time we start, because versions start over.
+
+    Also remembers the (epoch, version) of every peer's inventory we have applied, which our
+    GOSSIP messages carry so the peers can reply with deltas.
+    """
+    def __init__(self, changelog_size=INVENTORY_CHANGELOG_SIZE):
+        self.epoch = uuid.uuid4().hex
+        self.version = 0
+        self.entries = {} # key: file_id, value: metadata of our local file as of the last refresh
+        self.changelog = collections.OrderedDict() # key: file_id, value: version of its last change
+        self.changelog_size = changelog_size
+        self.forgotten = 0 # newest version dropped from the changelog. Deltas must start at or after it
+        self.store_version = None # metadata_store.local_version at the last refresh
+        self.filter = None # encoded Bloom filter of our local file_ids, and the version it is for
+        self.seen = {} # key: peer_id, value: (epoch, version) of their inventory we have applied
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Find what changed in our local files since the last refresh. Cheap when no local file
+        changed: new holders and remote files don't make it rescan
+        """
+        with self.lock:
+            store_version = metadata_store.local_version
+            if store_version == self.store_version:
+                return
+            self.store_version = store_version
+            current = {entry["file_id"]: entry for entry in get_local_file_entries(metadata_store.snapshot())}
+
+            # who else has a file is not part of our inventory, receivers don't take it from us
+            for file_id, entry in current.items():
+                old = self.entries.get(file_id)
+                if old is None or strip_holders(old) != strip_holders(entry):
+                    self.bump(file_id)
+            for file_id in self.entries:
+                if file_id not in current:
+                    self.bump(file_id)
+            self.entries = current
+
+    def bump(self, file_id):
+        """Record a change to file_id as the next version"""
+        self.version += 1
+        self.changelog[file_id] = self.version
+        self.changelog.move_to_end(file_id)
+        while len(self.changelog) > self.changelog_size:
+            _, version = self.changelog.popitem(last=False)
+            self.forgotten = version
+
+    def reply_files(self, known=None):
+        """
+        Return the fields of a GOSSIP_REPLY for a peer that has seen known, an {"epoch", "version"}
+        of our inventory, or None. The files are only what changed since known when we still can tell.
+        """
+        self.refresh()
+        with self.lock:
+            inventory = {"epoch": self.epoch, "version": self.version}
+            try:
+                since = int(known["version"]) if known["epoch"] == self.epoch else -1
+            except (TypeError, KeyError, ValueError):
+                since = -1
+
+            if since < self.forgotten or since > self.version:
+                return {"files": self.with_holders(self.entries), "inventory": inventory}
+
+            changed = []
+            for file_id in reversed(self.changelog):
+                if self.changelog[file_id] <= since:
+                    break
+                changed.append(file_id)
+            return {
+                "files": self.with_holders(file_id for file_id in changed if file_id in self.entries),
+                "removed": [file_id for file_id in changed if file_id not in self.entries],
+                "delta": True,
+                "since": since,
+                "inventory": inventory
+            }
+
+    def with_holders(self, file_ids):
+        """
+        Return the entries of file_ids with their current peers_with_file. Holders change without
+        a refresh, and older peers still take them from a GOSSIP_REPLY. Called with self.lock held
+        """
+        with METADATA_LOCK:
+            return [dict(self.entries[file_id], peers_with_file=list(metadata_store.holders.get(file_id, ()))) for file_id in file_ids]
+
+    def local_file_ids(self):
+        """Return the set of our local file_ids"""
+        self.refresh()
+        with self.lock:
+            return set(self.entries)
+
+    def file_filter(self, known=None):
+        """
+        Return the Bloom filter of our local file_ids, encoded for a GOSSIP_REPLY, rebuilt only when
+        the inventory changes. A peer that has seen known, the current version of our inventory, got
+        the filter with it, so it only gets the version
+        """
+        self.refresh()
+        with self.lock:
+            if self.is_current(known):
+                return {"epoch": self.epoch, "version": self.version}
+            if self.filter is None or self.filter["version"] != self.version:
+                bloom = BloomFilter.for_capacity(len(self.entries), FILE_FILTER_FALSE_POSITIVE_RATE)
+                for file_id in self.entries:
+                    bloom.add(file_id)
+                self.filter = {"epoch": self.epoch, "version": self.version, **bloom.encode()}
+            return self.filter
+
+    def filter_version(self):
+        """Return the version of our file filter, for a GOSSIP. Peers behind it get the filter in our GOSSIP_REPLY"""
+        self.refresh()
+        with self.lock:
+            return {"epoch": self.epoch, "version": self.version}
+
+    def is_current(self, known):
+        """Return True if known, an {"epoch", "version"} from a peer, is the current version of our inventory. Called with self.lock held"""
+        return isinstance(known, dict) and known.get("epoch") == self.epoch and known.get("version") == self.version
+
+    def known_versions(self):
+        """Return the versions of the tracked peers' inventories we have seen, to put in a GOSSIP"""
+        with self.lock:
+            return {
+                peer_id: {"epoch": epoch, "version": version}
+                for peer_id, (epoch, version) in self.seen.items()
+                if peer_id in tracked_peers
+            }
+
+    def saw(self, peer_id, msg):
+        """
+        Remember the version of peer_id's inventory from a GOSSIP_REPLY we applied. A delta only
+        counts when we had what it starts from, otherwise our next GOSSIP asks for everything.
+        """
+        inventory = msg.get("inventory")
+        if not isinstance(inventory, dict):
+            return
+        epoch = inventory.get("epoch")
+        version = inventory.get("version")
+        with self.lock:
+            seen = self.seen.get(peer_id)
+            same_epoch = seen is not None and seen[0] == epoch
+            if msg.get("delta") and not (same_epoch and seen[1] >= msg.get("since", 0)):
+                self.seen.pop(peer_id, None)
+                return
+            if same_epoch and seen[1] >= version:
+                return # an older reply arriving late
+            self.seen[peer_id] = (epoch, version)
+
+    def forget(self, peer_id):
+        """Stop remembering peer_id's inventory version"""
+        with self.lock:
+            self.seen.pop(peer_id, None)
+# end Inventory
+
+inventory = Inventory()
+
+def valid_file_metadata(file_metadata):
+    """Return True if file_metadata from a peer has the file_id and numeric file_timestamp every entry needs"""
+    if not isinstance(file_metadata, dict) or not isinstance(file_metadata.get("file_id"), str):
+        return False
+    timestamp = file_metadata.get("file_timestamp")
+    return isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool)
+# end valid_file_metadata()
+
+def strip_holders(entry):
+    """Return a copy of file metadata without its peers_with_file"""
+    return {key: value for key, value in entry.items() if key != "peers_with_file"}
+# end strip_holders()
+
+def load_metadata(path=METADATA_FILE):
     """
     Attempts to load metadata from METADATA_FILE into a dictionary and return the metadata as a dictionary
     If a metadata file does not exist, it creates it and returns an empty dictionary
+
+    Only used at startup. Use metadata_store to read metadata while running.
     """
     with METADATA_LOCK:
         try:
-            with open(METADATA_FILE, "r") as f:
+            with open(path, "r") as f:
                 metadata = json.load(f)
         except FileNotFoundError:
-            debug(f"Metadata file does not exist. Creating file '{METADATA_FILE}'")
+            debug(f"Metadata file does not exist. Creating file '{path}'")
             metadata = {}
-            with open(METADATA_FILE, "w") as f:
-                json.dump(metadata, f, indent=2)
+            save_metadata(metadata, path)
         return metadata
 #end load_metadata()
 
@@ -98,44 +1105,27 @@ def update_metadata(file_id, file_metadata):
     Add or update a file entry in the metadata.
     Only updates if the file is new or has a newer timestamp
     """
-    with METADATA_LOCK:
-        metadata = load_metadata()
-        old = metadata.get(file_id)
-
-        if old is None:
-            # New file - initialize peers_with_file if missing
-            if "peers_with_file" not in file_metadata:
-                file_metadata["peers_with_file"] = []
-            metadata[file_id] = file_metadata
-            save_metadata(metadata)
-            return True
-
-        if file_metadata["file_timestamp"] > old["file_timestamp"]:
-            # keep dynamic lists like peers_with_file
-            preserve_fields = {}
-            preserve_fields["peers_with_file"] = old.get("peers_with_file", [])
-
-            # build an updated entry
-            updated = dict(file_metadata) # start with new data
-            updated.update(preserve_fields) # add the preserved fields
-
-            metadata[file_id] = updated
-            save_metadata(metadata)
-            return True # updated or added successfully
-        
-        return False # No update
+    return metadata_store.update(file_id, file_metadata)
 # end update_metadata()
 
-def save_metadata(data):
+def save_metadata(data, path=METADATA_FILE):
     """
-    Saves the metadata to the file
+    Saves the metadata to the file. Returns True if it was written.
+
+    Writes to a temporary file first and renames it over the metadata file, so a crash
+    mid-write never leaves a half-written metadata file behind.
     """
-    with METADATA_LOCK:
-        try:
-            with open(METADATA_FILE, "w") as f:
-                json.dump(data, f, indent=2)
-        except IOError as e:
-            debug(f"Failed to write metadata to {METADATA_FILE}: {e}")
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return True
+    except IOError as e:
+        debug(f"Failed to write metadata to {path}: {e}")
+        return False
 #end save_metadata()
 
 def get_local_file_entries(metadata, directory="FileUploads"):
@@ -168,44 +1158,15 @@ def add_peer_to_file(file_id, peer_id):
     """
     Adds a peer_id to the peers_with_file list for a file's metadata
     """
-    with METADATA_LOCK:
-        metadata = load_metadata()
-
-        if file_id not in metadata:
-            return False # cannot add
-        
-        entry = metadata[file_id]
-
-        if "peers_with_file" not in entry:
-            entry["peers_with_file"] = []
-
-        if peer_id not in entry["peers_with_file"]:
-            entry["peers_with_file"].append(peer_id)
-            save_metadata(metadata)
-            return True #peer added to metadata
-        
-        return False # Peer already listed
+    return metadata_store.add_peer(file_id, peer_id)
 #end add_peer_to_file()
 
 def remove_peer_from_files(peer_id):
     """
     Removes the given peer_id from peers_with_file list in all file entries in metadata.
-    Saves metadata if any changes are made.
+    Marks the metadata for saving if any changes are made.
     """
-    with METADATA_LOCK:
-        metadata = load_metadata()
-        updated = False
-
-        for file_id, entry in metadata.items():
-            peers = entry.get("peers_with_file")
-            if isinstance(peers, list) and peer_id in peers:
-                peers.remove(peer_id)
-                updated = True
-
-        if updated:
-            save_metadata(metadata)
-
-        return updated
+    return metadata_store.remove_peer(peer_id)
 #end remove_peer_from_files()
 
 def cleanup_on_exit(my_peer_id):
@@ -215,24 +1176,16 @@ def cleanup_on_exit(my_peer_id):
     Removes all files not stored locally.
 
     Removes all peers_with_file entries except for itself on local files.
+
+    Recorded as a single journal record, and written to disk right away.
     """
     with METADATA_LOCK:
-        metadata = load_metadata()
-        clean_metadata = {}
-        local_files = get_local_file_entries(metadata)
-        local_files_ids = {entry["file_id"] for entry in local_files}
-
-        for file_id, entry in metadata.items():
-            if file_id in local_files_ids:
-                # keep that file, clean up peers_with_file
-                entry["peers_with_file"] = [my_peer_id]
-                clean_metadata[file_id] = entry
-                debug(f"Preserving {entry['file_name']} (local file), resetting peers_with_file to this peer.")
-            else:
-                debug(f"Removing metadata for {entry['file_name']} (remote file).")
-
-        save_metadata(clean_metadata)
-        debug("Cleaned metadata for this peer.")
+        local_files = set(os.listdir(FILE_UPLOAD_PATH))
+        local_files_ids = {file_id for file_id in local_files if file_id in metadata_store}
+        debug(f"Preserving {len(local_files_ids)} local file(s), removing {len(metadata_store) - len(local_files_ids)} remote file(s).")
+        metadata_store.reset(local_files_ids, my_peer_id)
+    metadata_store.flush()
+    debug("Cleaned metadata for this peer.")
 # end cleanup_on_exit()
 #-----------------------------#
 # end of Metadata Management  #
@@ -258,14 +1211,302 @@ def hash_sha256(data, time):
     return hash
 # end hash_sha256
 
+def copy_and_hash_file(src_path, dst_path, time):
+    """
+    Copies src_path to dst_path one STREAM_BUFFER_SIZE block at a time, hashing the blocks as they pass.
+    Returns the same hash as hash_sha256(file contents, time), and the size of the file in bytes.
+
+    The source is read once and never held in memory as a whole.
+    """
+    hashBase = hashlib.sha256()
+    buffer = memoryview(bytearray(STREAM_BUFFER_SIZE))
+    size = 0
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        while True:
+            read = src.readinto(buffer)
+            if not read:
+                break
+            hashBase.update(buffer[:read])
+            dst.write(buffer[:read])
+            size += read
+    hashBase.update(str(time).encode())
+    return hashBase.hexdigest(), size
+# end copy_and_hash_file()
+
+def hash_file(path, time):
+    """
+    Hashes the file at path one STREAM_BUFFER_SIZE block at a time.
+    Returns the same hash as hash_sha256(file contents, time).
+    """
+    hashBase = hashlib.sha256()
+    buffer = memoryview(bytearray(STREAM_BUFFER_SIZE))
+    with open(path, "rb") as f:
+        while True:
+            read = f.readinto(buffer)
+            if not read:
+                break
+            hashBase.update(buffer[:read])
+    hashBase.update(str(time).encode())
+    return hashBase.hexdigest()
+# end hash_file()
+
+def encode_message(msg, framed=False):
+    """
+    Encodes msg for sending over a socket.
+
+    Framed messages are FRAME_MAGIC, the payload length as a 4 byte big-endian integer, then
+    the JSON payload. Only send framed messages to peers that advertise the "framed" feature.
+    """
+    payload = json.dumps(msg).encode()
+    if framed:
+        return FRAME_HEADER.pack(FRAME_MAGIC, len(payload)) + payload
+    return payload
+# end encode_message()
+
+def stream_file(client_socket, f, offset, count):
+    """
+    Sends count bytes of the open file f, starting at offset, to client_socket.
+
+    Uses sendfile (os.sendfile via socket.sendfile) so the bytes go from the page cache to the
+    socket without being copied into Python. Where os.sendfile is not available, falls back to
+    sending the file through one fixed-size buffer. Memory use is the same for any file size.
+    """
+    if count == 0:
+        return # socket.sendfile() refuses a count of 0, and there is nothing to send for an empty file or chunk
+    if hasattr(os, "sendfile"):
+        sent = client_socket.sendfile(f, offset, count)
+    else:
+        buffer = memoryview(bytearray(STREAM_BUFFER_SIZE))
+        f.seek(offset)
+        sent = 0
+        while sent < count:
+            read = f.readinto(buffer[:min(STREAM_BUFFER_SIZE, count - sent)])
+            if not read:
+                break
+            client_socket.sendall(buffer[:read])
+            sent += read
+
+    metrics.bytes_sent.inc(sent)
+    if sent != count:
+        # the file shrank while we were sending it. The peer is waiting for count bytes, so give up on the connection
+        raise ConnectionError(f"Only sent {sent} of {count} bytes of {f.name}")
+# end stream_file()
+
+def stream_file_hex(client_socket, f, size, file_metadata):
+    """
+    Sends the open file f to client_socket as a hex-encoded FILE_DATA message, for peers without binary support.
+    """
+    for block in hex_file_blocks(f, size, file_metadata):
+        client_socket.sendall(block)
+        metrics.bytes_sent.inc(len(block))
+# end stream_file_hex()
+
+def hex_file_blocks(f, size, file_metadata):
+    """
+    Yields the open file f as the bytes of a hex-encoded FILE_DATA message.
+
+    The JSON comes in three parts: everything before the data, the data hex-encoded one
+    STREAM_BUFFER_SIZE block at a time, then the end of the JSON.
+    """
+    text = json.dumps(msg_build_file_data(b"", file_metadata))
+    prefix, suffix = text[:-2], text[-2:] # split around the empty data string at the end: '"data": "' + '"}'
+    yield prefix.encode()
+
+    f.seek(0)
+    remaining = size
+    while remaining > 0:
+        block = f.read(min(STREAM_BUFFER_SIZE, remaining))
+        if not block:
+            raise ConnectionError(f"Only sent {size - remaining} of {size} bytes of {f.name}")
+        yield block.hex().encode()
+        remaining -= len(block)
+
+    yield suffix.encode()
+# end hex_file_blocks()
+
+def hash_file_range(f, offset, count):
+    """
+    Returns the sha256 hex digest of count bytes of the open file f starting at offset, read in fixed-size blocks
+    """
+    hashBase = hashlib.sha256()
+    buffer = memoryview(bytearray(STREAM_BUFFER_SIZE))
+    f.seek(offset)
+    remaining = count
+    while remaining > 0:
+        read = f.readinto(buffer[:min(STREAM_BUFFER_SIZE, remaining)])
+        if not read:
+            break
+        hashBase.update(buffer[:read])
+        remaining -= read
+    return hashBase.hexdigest()
+# end hash_file_range()
+
+class PeerConnectionPool:
+    """
+    Keeps warm connections to peers, so that messages don't each pay for a new TCP connection.
+
+    A connection is checked out for one send and returned afterwards, so messages sent one
+    after another to the same peer are pipelined over the same socket, while concurrent sends
+    get their own connections. Before reuse, a connection is checked to make sure the peer has
+    not closed it. Connections unused for POOL_IDLE_TIMEOUT seconds are closed by close_idle().
+
+    Only use it for peers that advertise "pipeline", which read many messages per connection.
+    """
+    def __init__(self, idle_timeout=POOL_IDLE_TIMEOUT, max_idle_per_peer=POOL_MAX_IDLE_PER_PEER):
+        self.idle_timeout = idle_timeout
+        self.max_idle_per_peer = max_idle_per_peer
+        self.idle = {} # key: (host, port), value: list of (socket, last_used)
+        self.lock = threading.Lock()
+
+    def send(self, host, port, payload):
+        """Send payload to host:port over a pooled connection. Raises an OSError if it could not be sent"""
+        sock, reused = self.acquire(host, port)
+        try:
+            sock.sendall(payload)
+        except OSError:
+            sock.close()
+            if not reused:
+                raise
+            # the pooled connection went stale, try once more on a new one
+            sock = self.connect(host, port)
+            try:
+                sock.sendall(payload)
+            except OSError:
+                sock.close()
+                raise
+        self.release(host, port, sock)
+
+    def acquire(self, host, port):
+        """Returns a healthy idle connection to host:port, or a new one, and whether it was reused"""
+        with self.lock:
+            connections = self.idle.get((host, port), [])
+            while connections:
+                sock, last_used = connections.pop()
+                if time.time() - last_used < self.idle_timeout and self.is_healthy(sock):
+                    return sock, True
+                sock.close()
+        return self.connect(host, port), False
+
+    def connect(self, host, port):
+        """Open a new connection to host:port"""
+        sock = socket.create_connection((host, port), timeout=5)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def is_healthy(self, sock):
+        """
+        Peers never send anything back on a pooled connection, so if it is readable the peer
+        closed it (or broke protocol) and it can't be reused.
+        """
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def release(self, host, port, sock):
+        """Return a connection to the pool once a send is done"""
+        with self.lock:
+            connections = self.idle.setdefault((host, port), [])
+            if len(connections) < self.max_idle_per_peer:
+                connections.append((sock, time.time()))
+                return
+        sock.close()
+
+    def close_idle(self):
+        """Close connections that have been unused for longer than idle_timeout"""
+        now = time.time()
+        with self.lock:
+            for address in list(self.idle):
+                keep = []
+                for sock, last_used in self.idle[address]:
+                    if now - last_used < self.idle_timeout:
+                        keep.append((sock, last_used))
+                    else:
+                        sock.close()
+                if keep:
+                    self.idle[address] = keep
+                else:
+                    del self.idle[address]
+
+    def close_address(self, host, port):
+        """Close every idle connection to host:port, e.g. once the peer is gone"""
+        with self.lock:
+            for sock, _ in self.idle.pop((host, port), []):
+                sock.close()
+# end PeerConnectionPool
+
+connection_pool = PeerConnectionPool()
+
+def deliver_message(msg, to_host, to_port):
+    """
+    Sends a message to the port and host. Raises an OSError if it could not be sent.
+
+    Peers that support "pipeline" get the message over a pooled connection, other peers get a
+    new connection for every message.
+    """
+    features = address_features(to_host, to_port)
+    payload = encode_message(msg, "framed" in features)
+    try:
+        if "pipeline" in features:
+            connection_pool.send(to_host, to_port, payload)
+        else:
+            with socket.create_connection((to_host, to_port), timeout=5) as sock:
+                sock.sendall(payload)
+    except OSError:
+        metrics.send_failed(tracked_peers.peer_id_at(to_host, to_port))
+        raise
+    metrics.bytes_sent.inc(len(payload))
+# end deliver_message()
+
+broadcast_executor = concurrent.futures.ThreadPoolExecutor(max_workers=BROADCAST_PARALLELISM)
+
+def broadcast(msg, peers, deadline=BROADCAST_DEADLINE):
+    """
+    Sends msg to every (peer_id, peer_info) in peers concurrently, BROADCAST_PARALLELISM at a time,
+    so a broadcast takes about as long as the slowest peer instead of the sum of all of them.
+    Waits until every send is done, or deadline seconds have passed.
+
+    Returns a dict of peer_id to the outcome of its send: "sent", "timed out" if the deadline
+    passed first, or the exception the send failed with.
+    """
+    futures = {}
+    for peer_id, peer_info in peers:
+        future = broadcast_executor.submit(deliver_message, msg, peer_info["host"], peer_info["port"])
+        futures[future] = peer_id
+
+    _, not_done = concurrent.futures.wait(futures, timeout=deadline)
+
+    outcomes = {}
+    for future, peer_id in futures.items():
+        if future in not_done:
+            future.cancel() # don't start sends that are still waiting for a thread
+            outcomes[peer_id] = "timed out"
+        elif future.exception() is not None:
+            outcomes[peer_id] = future.exception()
+        else:
+            outcomes[peer_id] = "sent"
+    return outcomes
+# end broadcast()
+
+def print_broadcast_outcomes(what, outcomes):
+    """
+    Prints a line for each peer a broadcast did not reach, then how many peers it did reach
+    """
+    for peer_id, outcome in outcomes.items():
+        if outcome != "sent":
+            print(f"Failed to send {what} to peer {peer_id}: {outcome}")
+    sent = sum(1 for outcome in outcomes.values() if outcome == "sent")
+    print(f"Sent {what} to {sent}/{len(outcomes)} peers")
+# end print_broadcast_outcomes()
+
 def send_message(msg, to_host, to_port):
     """
     Sends a message to the port and host
     """
     try:
-        with socket.create_connection((to_host, to_port), timeout=5) as sock:
-            sock.sendall(json.dumps(msg).encode())
-            return True
+        deliver_message(msg, to_host, to_port)
+        return True
     except Exception as e:
         print(f"Failed to send message to {to_host}:{to_port}: {e}")
         return False
@@ -277,23 +1518,26 @@ def msg_send_delete(file_id, my_peer_id):
     """
     msg = msg_build_delete(my_peer_id, file_id)
 
-    metadata = load_metadata()
-    file_info = metadata.get(file_id)
+    file_info = metadata_store.get(file_id)
+    if not file_info:
+        print(f"Cannot delete. Unknown file {file_id}")
+        return
     file_owner = file_info.get("file_owner")
 
     if my_peer_id == file_owner: # if we own the file, can attempt to delete locally
         file_path = os.path.join(FILE_UPLOAD_PATH, file_id)
-        if os.path.isfile(file_path): # if we have it
+        had_file = os.path.isfile(file_path)
+        if had_file: # if we have it
             os.remove(file_path) # delete it
             print(f"Deleted local file {file_id} on request from owner {my_peer_id}")
         
-        metadata.pop(file_id)
-        save_metadata(metadata)
+        metadata_store.delete(file_id)
+        if had_file:
+            metadata_store.local_files_changed()
 
     # send a delete request to all tracked peers
-    for peer_id, peer_info in list(tracked_peers.items()):
-        if peer_info:
-            send_message(msg, peer_info["host"], peer_info["port"])
+    outcomes = broadcast(msg, list(tracked_peers.items()))
+    print_broadcast_outcomes(f"delete of {file_id}", outcomes)
 # end msg_send_delete
 
 def msg_send_get(file_id, my_peer_id):
@@ -310,12 +1554,22 @@ def msg_send_get(file_id, my_peer_id):
         print(f"Cannot get file. No tracked peers have file {file_id}")
         return
     
-    peer = random.choice(peers)
+    # prefer peers that can send the file in resumable chunks
+    chunked_peers = [peer for peer in peers if peer_supports(peer, "ranges")]
+    peer = random.choice(chunked_peers or peers)
     peer_info = tracked_peers.get(peer)
     if not peer_info:
         print(f"No connection info for peer {peer}")
         return
     
+    if chunked_peers:
+        # download chunks from every peer that supports it at once
+        try:
+            download_file_swarm(file_id, chunked_peers, my_peer_id)
+        except Exception as e:
+            print(f"Download of {file_id} interrupted: {e}. Use 'get {file_id}' to resume.")
+        return
+
     to_host = peer_info["host"]
     to_port = peer_info["port"]
 
@@ -326,13 +1580,18 @@ def msg_send_get(file_id, my_peer_id):
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
             client_socket.connect((to_host, to_port))
             client_socket.settimeout(30)
-            client_socket.sendall(json.dumps(msg).encode())
+            payload = encode_message(msg, peer_supports(peer, "framed"))
+            client_socket.sendall(payload)
+            metrics.bytes_sent.inc(len(payload))
             print(f"Get request sent to peer {peer}. Awaiting response.")
 
             # Wait to receive file data from them
-            file_msg = receive_message(client_socket)
-            debug(f"received file message: {file_msg} from SOCKET: {client_socket}")
-            if file_msg:
+            file_msg = receive_message(MessageReader(client_socket))
+            debug(f"received file message: {describe_message(file_msg)} from peer {peer}")
+            if file_msg and file_msg.get("type") == "FILE_DATA" and file_msg.get("file_id") is None:
+                print(f"Peer {peer} does not have file {file_id}")
+                holder_filters.miss(peer, file_id)
+            elif file_msg:
                 handle_message(file_msg, my_peer_id, to_host, to_port, client_socket)
             else:
                 print(f"No FILE_DATA received in response to GET for {file_id} from peer {peer}")
@@ -353,9 +1612,8 @@ def load_files_on_join(my_peer_id):
     # checks if we have any missing files, waits some time to make sure we get some gossip info back first
     while waited < timeout:
         with METADATA_LOCK:
-            metadata = load_metadata()
             missing_files = [
-                (file_id, entry) for file_id, entry in metadata.items()
+                (file_id, entry) for file_id, entry in metadata_store.snapshot().items()
                 if file_id not in local_files and entry["peers_with_file"]
             ]
 
@@ -381,75 +1639,172 @@ def push_file(file_path, my_peer_id):
     """
     Pushes a file locally to this peer, and forwards the file to up to 1 other peer.
     Then announces the new file to all tracked peers.
+
+    If file_path is a directory, pushes every file in it. Their announcements are sent to each peer in one batch.
     """
+    if os.path.isdir(file_path):
+        for entry in sorted(os.scandir(file_path), key=lambda entry: entry.name):
+            if entry.is_file():
+                push_file(entry.path, my_peer_id)
+        return
+
     if not os.path.isfile(file_path):
         print(f"File '{file_path}' not found.")
         return
     
     print(f"Pushing file '{file_path}'...")
 
-    # load up the file
-    with open(file_path, "rb") as f:
-        file_contents = f.read()
-
     timestamp = int(time.time())
 
-    file_id = hash_sha256(file_contents, timestamp) # create a file_id
+    # save the file locally, creating the file_id from its contents on the way
+    tmp_path = os.path.join(FILE_UPLOAD_PATH, f".push-{uuid.uuid4()}.tmp")
+    try:
+        file_id, file_bytes = copy_and_hash_file(file_path, tmp_path, timestamp)
+        path = os.path.join(FILE_UPLOAD_PATH, file_id)
+        os.replace(tmp_path, path)
+    except IOError as e:
+        print(f"Failed to save file '{file_path}': {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return
 
     file_metadata = {
         "file_name": os.path.basename(file_path),
-        "file_size": round(len(file_contents) / (1024 * 1024), 2), # saved as MB
+        "file_size": round(file_bytes / (1024 * 1024), 2), # saved as MB
         "file_id": file_id,
         "file_owner": my_peer_id,
         "file_timestamp": timestamp,
         "peers_with_file": [my_peer_id]
     }
 
-    # save the file locally
-    path = os.path.join(FILE_UPLOAD_PATH, file_id)
-    with open(path, "wb") as f:
-        f.write(file_contents)
-
     print(f"File saved locally as: {file_id}")
 
     update_metadata(file_id, file_metadata) # add/update metadata on a file
+    metadata_store.local_files_changed()
 
     if tracked_peers: # if we have a tracked peer, send to 1 of them
         to_peer, peer_info = random.choice(list(tracked_peers.items()))
         to_host = peer_info["host"]
         to_port = peer_info["port"]
-        send_file(file_contents, file_metadata, to_host, to_port, to_peer)
+        send_file(path, file_metadata, to_host, to_port, to_peer)
 
     # ANNOUNCE to all peers
-    for peer_id, peer_info in list(tracked_peers.items()):
-        msg_send_announce(my_peer_id, file_metadata, peer_info["host"], peer_info["port"], peer_id)
+    msg_send_announce(my_peer_id, file_metadata)
 
     print(f"File '{file_metadata['file_name']}' pushed to the network with ID: {file_id}")
 # end push_file()
 
-def send_file(content, file_metadata, to_host, to_port, to_peer):
+def send_file(path, file_metadata, to_host, to_port, to_peer):
     """
-    Sends a file from this peer to a peer
+    Sends the file at path from this peer to a peer, streaming it from disk.
+    Sends raw binary data if the peer supports it, otherwise the data is hex-encoded.
     """
-    msg = msg_build_file_data(content, file_metadata)
-    sent = send_message(msg, to_host, to_port)
-    if sent:
-        print(f"File '{file_metadata['file_name']}' pushed to peer {to_peer} ({to_host}:{to_port})")
+    try:
+        with open(path, "rb") as f, socket.create_connection((to_host, to_port), timeout=5) as sock:
+            file_size = os.fstat(f.fileno()).st_size
+            if peer_supports(to_peer, "binary"):
+                msg = msg_build_file_data_header(file_size, file_metadata)
+                payload = encode_message(msg, peer_supports(to_peer, "framed"))
+                sock.sendall(payload)
+                metrics.bytes_sent.inc(len(payload))
+                stream_file(sock, f, 0, file_size)
+            else:
+                stream_file_hex(sock, f, file_size, file_metadata)
+    except Exception as e:
+        metrics.send_failed(to_peer)
+        print(f"Failed to push file '{file_metadata['file_name']}' to peer {to_peer} ({to_host}:{to_port}): {e}")
+        return
+    print(f"File '{file_metadata['file_name']}' pushed to peer {to_peer} ({to_host}:{to_port})")
 
-def msg_send_announce(my_peer_id, file_metadata, to_host, to_port, to_peer):
+def msg_send_announce(my_peer_id, file_metadata):
     """
-    Sends an announce message with info on a file to the to_host at to_port
+    Announces a file to all tracked peers. Peers that support batches get it in an
+    ANNOUNCE_BATCH a moment later, together with any other files announced meanwhile.
     """
-    msg = msg_build_announce(my_peer_id, file_metadata)
-
-    try:
-        with socket.create_connection((to_host, to_port), timeout=5) as sock:
-            sock.sendall(json.dumps(msg).encode())
-            print(f"Announced file to peer {to_peer} at {to_host}:{to_port}")
-    except Exception as e:
-        print(f"Failed to announce to peer {to_peer} at {to_host}:{to_port}: {e}")
+    announce_coalescer.announce(my_peer_id, file_metadata)
 # end msg_send_announce
 
+class AnnounceCoalescer:
+    """
+    Collects announcements for a short window, and sends each peer one ANNOUNCE_BATCH for all of them.
+
+    Announcing a file adds it to the pending files of every tracked peer that supports
+    "announce_batch". ANNOUNCE_COALESCE_WINDOW seconds after a peer's first pending file, all of
+    its pending files are sent in one message (sooner if it has max_files of them). Peers with the
+    same pending files get their batches in one broadcast. Peers that don't support batches get a
+    plain ANNOUNCE right away.
+    """
+    def __init__(self, window=ANNOUNCE_COALESCE_WINDOW, max_files=ANNOUNCE_BATCH_MAX_FILES):
+        self.window = window
+        self.max_files = max_files
+        self.pending = {} # key: peer_id, value: dict of file_id to file metadata
+        self.due = {} # key: peer_id, value: when its pending files are sent
+        self.my_peer_id = None
+        self.condition = threading.Condition()
+
+    def start(self):
+        """Start the thread that sends batches once their window has passed"""
+        threading.Thread(target=self.flush_loop, daemon=True).start()
+
+    def announce(self, my_peer_id, file_metadata):
+        """Announce file_metadata to every tracked peer"""
+        legacy_peers = []
+        with self.condition:
+            self.my_peer_id = my_peer_id
+            now = time.time()
+            for peer_id, peer_info in list(tracked_peers.items()):
+                if "announce_batch" not in peer_info.get("features", []):
+                    legacy_peers.append((peer_id, peer_info))
+                    continue
+                files = self.pending.setdefault(peer_id, {})
+                files[file_metadata["file_id"]] = file_metadata
+                if len(files) >= self.max_files:
+                    self.due[peer_id] = now # full, send it right away
+                else:
+                    self.due.setdefault(peer_id, now + self.window)
+            self.condition.notify()
+
+        if legacy_peers:
+            outcomes = broadcast(msg_build_announce(my_peer_id, file_metadata), legacy_peers)
+            print_broadcast_outcomes(f"announce of '{file_metadata['file_name']}'", outcomes)
+
+    def flush_loop(self):
+        """Sends each batch once its window has passed, forever"""
+        while True:
+            with self.condition:
+                while not self.due:
+                    self.condition.wait()
+                wait = min(self.due.values()) - time.time()
+                if wait > 0:
+                    self.condition.wait(wait) # woken early if a batch fills up
+                    continue
+            self.flush(everything=False)
+
+    def flush(self, everything=True):
+        """Send the pending batches. Only those whose window has passed, unless everything"""
+        with self.condition:
+            now = time.time()
+            ready = [peer_id for peer_id, due in self.due.items() if everything or due <= now]
+            batches = {peer_id: self.pending.pop(peer_id) for peer_id in ready}
+            for peer_id in ready:
+                del self.due[peer_id]
+
+        # peers waiting on the same files get the same message
+        groups = {} # key: frozenset of file_ids, value: (list of file metadata, list of (peer_id, peer_info))
+        for peer_id, files in batches.items():
+            peer_info = tracked_peers.get(peer_id)
+            if peer_info is None:
+                continue # the peer is gone
+            files_and_peers = groups.setdefault(frozenset(files), (list(files.values()), []))
+            files_and_peers[1].append((peer_id, peer_info))
+
+        for files, peers in groups.values():
+            outcomes = broadcast(msg_build_announce_batch(self.my_peer_id, files), peers)
+            print_broadcast_outcomes(f"announce of {len(files)} file(s)", outcomes)
+# end AnnounceCoalescer
+
+announce_coalescer = AnnounceCoalescer()
+
 def first_gossip(my_host, my_port, my_peer_id):
     """
     Send a first gossip message to a known host to let them know this peer exists
@@ -460,7 +1815,7 @@ def first_gossip(my_host, my_port, my_peer_id):
 
 def n_peer_gossip(n, my_host, my_port, my_peer_id, msg_override=None):
     """
-    Send a message to n tracked peers. If n < len(tracked_peers), the peers are randomly selected.
+    Send a gossip message to n tracked peers at once. If n < len(tracked_peers), the peers are randomly selected.
 
     Parameters:
         n (int): the number of peers to send gossip message to.
@@ -469,13 +1824,24 @@ def n_peer_gossip(n, my_host, my_port, my_peer_id, msg_override=None):
         my_peer_id: the peer id of sender
         msg_override: the msg to send. If None, create new gossip message
     """
-    known_peers = list(tracked_peers.items())
+    known_peers = [(peer_id, peer_info) for peer_id, peer_info in tracked_peers.items() if peer_id != my_peer_id]
     random.shuffle(known_peers)
+    known_peers = known_peers[:n]
+
+    if msg_override is None:
+        gossip_message = msg_build_gossip(my_host, my_port, my_peer_id)
+    else:
+        gossip_message = msg_override
+
+    seen_gossip_ids.add(gossip_message["id"])
 
-    for peer_id, peer_info in known_peers[:n]:
-        if peer_id == my_peer_id:
-            continue # skip this peer
-        msg_send_gossip(my_host, my_port, my_peer_id, peer_info["host"], peer_info["port"], msg_override)
+    # send to all n at once, and drop the peers we could not reach
+    outcomes = broadcast(gossip_message, known_peers)
+    for peer_id, peer_info in known_peers:
+        outcome = outcomes[peer_id]
+        if outcome != "sent" and outcome != "timed out":
+            debug(f"Failed to send gossip to {peer_info['host']}:{peer_info['port']}: {outcome}")
+            remove_peer(peer_info["host"], peer_info["port"])
 # end n_peer_gossip()
 
 def msg_send_gossip(my_host, my_port, my_peer_id, to_host, to_port, msg_override=None):
@@ -492,8 +1858,6 @@ def msg_send_gossip(my_host, my_port, my_peer_id, to_host, to_port, msg_override
 
         msg_override: the msg to send. If None, create new gossip message
     """
-    remove_old_peers() # make sure we only send to active peers
-
     if msg_override is None:
         gossip_message = msg_build_gossip(my_host, my_port, my_peer_id)
     else:
@@ -502,13 +1866,10 @@ def msg_send_gossip(my_host, my_port, my_peer_id, to_host, to_port, msg_override
     seen_gossip_ids.add(gossip_message["id"])
 
     try:
-        with socket.create_connection((to_host, to_port), timeout=5) as sock:
-            sock.sendall(json.dumps(gossip_message).encode())
+        deliver_message(gossip_message, to_host, to_port)
     except Exception as e:
         debug(f"Failed to send gossip to {to_host}:{to_port}: {e}")
         remove_peer(to_host, to_port)
-
-
 # end msg_send_gossip
 
 def interval_send_gossip(my_host, my_port, my_peer_id):
@@ -523,7 +1884,7 @@ def interval_send_gossip(my_host, my_port, my_peer_id):
         time.sleep(GOSSIP_INTERVAL)
 # end interval_send_gossip
 
-def msg_send_gossip_reply(my_host, my_port, my_peer_id, to_host, to_port):
+def msg_send_gossip_reply(my_host, my_port, my_peer_id, to_host, to_port, known=None):
     """
     Sends a gossip reply message.
 
@@ -534,11 +1895,12 @@ def msg_send_gossip_reply(my_host, my_port, my_peer_id, to_host, to_port):
 
         to_host : the host of receiver
         to_port : the port of receiver
+
+        known : the version of our inventory the receiver has seen, if any
     """
-    reply_message = msg_build_gossip_reply(my_host, my_port, my_peer_id) # replace [] with a method to get local files from metadata
+    reply_message = msg_build_gossip_reply(my_host, my_port, my_peer_id, known)
     try:
-        with socket.create_connection((to_host, to_port), timeout=5) as sock:
-            sock.sendall(json.dumps(reply_message).encode())
+        deliver_message(reply_message, to_host, to_port)
     except Exception as e:
         print(f"Failed to send gossip_reply to {to_host}:{to_port}: {e}")
 # end msg_send_gossip_reply()
@@ -548,6 +1910,403 @@ def msg_send_gossip_reply(my_host, my_port, my_peer_id, to_host, to_port):
 
 
 
+#--------------------------#
+#---# Chunked Downloads #---#
+#                           #
+# code related to resumable #
+# downloads in chunks       #
+#---------------------------#
+def partial_paths(file_id):
+    """
+    Returns the paths of the partial file and the progress sidecar for a download of file_id
+    """
+    part_path = os.path.join(FILE_UPLOAD_PATH, file_id + ".part")
+    return part_path, part_path + ".json"
+# end partial_paths()
+
+def load_download_progress(file_id):
+    """
+    Loads the progress of an interrupted download of file_id. Returns None if there is nothing to resume.
+
+    Progress is a dictionary with the file_metadata, the total_size of the file in bytes, the
+    chunk_size, and done, the set of chunk indexes already written to the partial file.
+    """
+    part_path, progress_path = partial_paths(file_id)
+    try:
+        with open(progress_path, "r") as f:
+            progress = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if not os.path.isfile(part_path) or progress.get("chunk_size") != DOWNLOAD_CHUNK_SIZE:
+        return None # can't resume this one, start over
+
+    progress["done"] = set(progress["done"])
+    return progress
+# end load_download_progress()
+
+def save_download_progress(file_id, progress):
+    """
+    Atomically writes the progress of a download of file_id to its sidecar
+    """
+    _, progress_path = partial_paths(file_id)
+    tmp_path = progress_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({**progress, "done": sorted(progress["done"])}, f)
+    os.replace(tmp_path, progress_path)
+# end save_download_progress()
+
+def chunk_count(total_size, chunk_size):
+    """Number of chunks of chunk_size needed for total_size bytes"""
+    return (total_size + chunk_size - 1) // chunk_size
+# end chunk_count()
+
+class PeerBusyError(Exception):
+    """
+    Raised when a peer answers a request with BUSY. retry_after is how many seconds it asked us to wait
+    """
+    def __init__(self, peer, retry_after):
+        super().__init__(f"Peer {peer} is busy")
+        self.retry_after = retry_after
+# end PeerBusyError
+
+def request_chunk(client_socket, reader, peer, file_id, offset, length):
+    """
+    Sends a ranged GET_FILE for length bytes of file_id at offset, and waits for the FILE_DATA reply.
+    Returns the reply, or None if the peer doesn't have the file or sent a bad chunk.
+    Raises PeerBusyError if the peer was too busy to answer.
+    """
+    msg = msg_build_get(file_id, offset, length)
+    payload = encode_message(msg, peer_supports(peer, "framed"))
+    client_socket.sendall(payload)
+    metrics.bytes_sent.inc(len(payload))
+
+    reply = receive_message(reader)
+    if reply and reply.get("type") == "BUSY":
+        raise PeerBusyError(peer, reply.get("retry_after", BUSY_RETRY_AFTER))
+    if not reply or reply.get("type") != "FILE_DATA" or reply.get("file_id") != file_id:
+        debug(f"Peer {peer} does not have {file_id}")
+        if reply and reply.get("type") == "FILE_DATA" and reply.get("file_id") is None:
+            holder_filters.miss(peer, file_id) # the empty FILE_DATA, maybe its file filter was wrong
+        return None
+    if reply.get("offset") != offset or "data" not in reply:
+        debug(f"Peer {peer} sent the wrong chunk of {file_id}")
+        return None
+    if hashlib.sha256(reply["data"]).hexdigest() != reply.get("chunk_sha256"):
+        debug(f"Chunk of {file_id} at offset {offset} from peer {peer} failed verification")
+        return None
+    return reply
+# end request_chunk()
+
+def fetch_first_chunk(file_id, peers):
+    """
+    Requests the first chunk of file_id from each of peers in turn, until one of them answers.
+    Returns the peer and its reply, or (None, None) if none of them sent the chunk.
+    """
+    for peer in peers:
+        peer_info = tracked_peers.get(peer)
+        if not peer_info:
+            continue
+        try:
+            with socket.create_connection((peer_info["host"], peer_info["port"]), timeout=SWARM_CHUNK_TIMEOUT) as client_socket:
+                reply = request_chunk(client_socket, MessageReader(client_socket), peer, file_id, 0, DOWNLOAD_CHUNK_SIZE)
+        except Exception as e:
+            debug(f"Could not get the first chunk of {file_id} from peer {peer}: {e}")
+            continue
+        if reply is not None and len(reply["data"]) == min(DOWNLOAD_CHUNK_SIZE, reply["total_size"]):
+            return peer, reply
+    return None, None
+# end fetch_first_chunk()
+
+class SwarmDownload:
+    """
+    Downloads the missing chunks of a file from several peers at once.
+
+    Each peer gets a worker thread with its own connection. Workers take the next missing chunk,
+    request it, verify it against its chunk_sha256 and write it into the partial file. If a peer
+    fails or times out, its chunk goes back in the queue for the other peers and the worker stops.
+    Once the queue is empty, idle workers also request chunks still in flight on slower peers,
+    and the first copy to arrive is kept.
+    """
+    def __init__(self, file_id, progress, part_file):
+        self.file_id = file_id
+        self.progress = progress
+        self.part_file = part_file
+        self.count = chunk_count(progress["total_size"], DOWNLOAD_CHUNK_SIZE)
+        self.pending = collections.deque(index for index in range(self.count) if index not in progress["done"])
+        self.in_flight = {} # key: chunk index, value: number of workers requesting it
+        self.received_from = {} # key: peer_id, value: number of chunks received from that peer
+        self.active_workers = 0
+        self.lock = threading.Lock()
+        self.finished = threading.Event() # set once every chunk is in, or every worker has stopped
+
+    def run(self, peers):
+        """Download the missing chunks from peers. Returns True if every chunk was received"""
+        if not self.pending:
+            return True
+
+        self.active_workers = len(peers)
+        for peer in peers:
+            threading.Thread(target=self.worker, args=(peer,), daemon=True).start()
+
+        self.finished.wait()
+        return self.is_complete()
+
+    def is_complete(self):
+        return len(self.progress["done"]) == self.count
+
+    def next_chunk(self):
+        """Returns the index of the next chunk a worker should request, or None if there are none left"""
+        with self.lock:
+            if self.is_complete():
+                return None
+            if self.pending:
+                index = self.pending.popleft()
+            else:
+                # endgame: help with a chunk that only one (possibly slow) peer is working on
+                waiting = [index for index, workers in self.in_flight.items() if workers == 1]
+                if not waiting:
+                    return None
+                index = waiting[0]
+            self.in_flight[index] = self.in_flight.get(index, 0) + 1
+            return index
+
+    def release_chunk(self, index):
+        """A worker is done with chunk index. Requeue it if it was not received"""
+        self.in_flight[index] -= 1
+        if self.in_flight[index] == 0:
+            del self.in_flight[index]
+            if index not in self.progress["done"]:
+                self.pending.appendleft(index)
+
+    def chunk_received(self, index, data, peer):
+        """Write a verified chunk into the partial file and record it"""
+        with self.lock:
+            if index not in self.progress["done"]: # the endgame may fetch a chunk twice
+                self.part_file.seek(index * DOWNLOAD_CHUNK_SIZE)
+                self.part_file.write(data)
+                self.progress["done"].add(index)
+                self.received_from[peer] = self.received_from.get(peer, 0) + 1
+                save_download_progress(self.file_id, self.progress)
+                debug(f"Received chunk {index + 1}/{self.count} of {self.file_id} from peer {peer}")
+            self.release_chunk(index)
+            if self.is_complete():
+                self.finished.set()
+
+    def chunk_failed(self, index):
+        """Give chunk index back to the other workers"""
+        with self.lock:
+            self.release_chunk(index)
+
+    def worker(self, peer):
+        """Requests chunks from peer until there are none left or the peer fails"""
+        index = None
+        try:
+            peer_info = tracked_peers.get(peer)
+            if peer_info:
+                with socket.create_connection((peer_info["host"], peer_info["port"]), timeout=SWARM_CHUNK_TIMEOUT) as client_socket:
+                    reader = MessageReader(client_socket)
+                    busy_replies = 0
+                    while True:
+                        index = self.next_chunk()
+                        if index is None:
+                            break
+                        offset = index * DOWNLOAD_CHUNK_SIZE
+                        length = min(DOWNLOAD_CHUNK_SIZE, self.progress["total_size"] - offset)
+                        try:
+                            reply = request_chunk(client_socket, reader, peer, self.file_id, offset, length)
+                        except PeerBusyError as e:
+                            # let the other peers have the chunk while this one catches up
+                            busy_replies += 1
+                            if busy_replies > SWARM_BUSY_RETRIES:
+                                raise
+                            self.chunk_failed(index)
+                            index = None
+                            time.sleep(e.retry_after)
+                            continue
+                        busy_replies = 0
+                        if reply is None or len(reply["data"]) != length:
+                            break # the peer can't give us this file, leave it to the others
+                        self.chunk_received(index, reply["data"], peer)
+                        index = None
+        except Exception as e:
+            debug(f"Dropping peer {peer} from download of {self.file_id}: {e}")
+        finally:
+            with self.lock:
+                if index is not None:
+                    self.release_chunk(index)
+                self.active_workers -= 1
+                if self.active_workers == 0:
+                    self.finished.set()
+# end SwarmDownload
+
+def download_file_swarm(file_id, peers, my_peer_id):
+    """
+    Downloads file_id in DOWNLOAD_CHUNK_SIZE chunks, requested concurrently from up to SWARM_MAX_PEERS of peers.
+
+    Chunks are written to FileUploads/<file_id>.part and the chunks received so far are recorded in a
+    <file_id>.part.json sidecar. If the download is interrupted, the next get of the file resumes from there.
+    The finished file must hash to file_id, otherwise it is thrown away.
+    Returns True once the whole file is saved.
+    """
+    peers = random.sample(peers, min(SWARM_MAX_PEERS, len(peers)))
+    part_path, progress_path = partial_paths(file_id)
+    progress = load_download_progress(file_id)
+
+    if progress is None:
+        # the first chunk tells us how big the file is
+        print(f"Get request sent to peer(s) {', '.join(peers)}. Awaiting response.")
+        peer, reply = fetch_first_chunk(file_id, peers)
+        if reply is None:
+            print(f"No FILE_DATA received in response to GET for {file_id}")
+            return False
+
+        progress = {
+            "file_metadata": {field: reply[field] for field in ("file_name", "file_size", "file_id", "file_owner", "file_timestamp")},
+            "total_size": reply["total_size"],
+            "chunk_size": DOWNLOAD_CHUNK_SIZE,
+            "done": {0},
+        }
+        with open(part_path, "wb") as f:
+            f.truncate(progress["total_size"])
+            f.write(reply["data"])
+        save_download_progress(file_id, progress)
+    else:
+        print(f"Resuming download of {file_id}: {len(progress['done'])} chunk(s) already received.")
+
+    with open(part_path, "r+b") as part_file:
+        swarm = SwarmDownload(file_id, progress, part_file)
+        complete = swarm.run(peers)
+        with swarm.lock: # stragglers from the endgame may still be finishing
+            part_file.flush()
+
+    if not complete:
+        print(f"Download of {file_id} stopped at {len(progress['done'])}/{swarm.count} chunks. Use 'get {file_id}' to resume.")
+        return False
+
+    # all chunks are in. The chunk hashes come from the peers that sent the chunks, so check
+    # the whole file against its file_id before we keep it and serve it to others
+    file_metadata = progress["file_metadata"]
+    if hash_file(part_path, file_metadata["file_timestamp"]) != file_id:
+        print(f"Download of {file_id} does not match its file_id. Discarding it.")
+        os.remove(part_path)
+        os.remove(progress_path)
+        return False
+
+    # move the file into place
+    os.replace(part_path, os.path.join(FILE_UPLOAD_PATH, file_id))
+    os.remove(progress_path)
+    sources = ", ".join(f"{peer} ({chunks})" for peer, chunks in swarm.received_from.items())
+    print(f"Downloaded {progress['total_size']/1024:.2f} KB for file '{file_metadata['file_name']}' from {sources or 'earlier attempts'}")
+
+    file_received(file_metadata, my_peer_id)
+    return True
+# end download_file_swarm()
+#---------------------------#
+# end of Chunked Downloads  #
+#---------------------------#
+
+
+
+#-----------------------#
+#---# Metadata Sync #---#
+#                       #
+# code related to       #
+# finding and fixing    #
+# metadata differences  #
+#-----------------------#
+def sync_start():
+    """
+    Return the fields of the SYNC that starts a sync: our root hash, and all our entries
+    if there are only a few of them.
+    """
+    with METADATA_LOCK:
+        digest = metadata_store.digest
+        step = {"nodes": {"": digest.hash("")}}
+        if digest.count("") <= SYNC_LEAF_ENTRIES:
+            step["covers"] = [""]
+            step["entries"] = [metadata_store.export(file_id) for file_id in digest.file_ids("")]
+        return step
+# end sync_start()
+
+def sync_step(msg):
+    """
+    Compare the nodes of a SYNC with our metadata digest. Returns the fields of our answer,
+    or None once we agree. The entries of msg must be merged first.
+
+    For each node that differs:
+        if it is a leaf, or small, or the sender sent all its entries under it (covers),
+        we send all of our entries under it. Unless the sender already sent its own, we
+        mark it as covered so the sender sends back whatever we still lack.
+        Otherwise we send the hashes of its children (expanded) to compare next.
+    """
+    their_covers = set(msg.get("covers") or ())
+    nodes, expanded, covers, entries = {}, [], [], []
+
+    with METADATA_LOCK:
+        digest = metadata_store.digest
+
+        # every child of an expanded node gets compared, also the ones only we have
+        to_check = dict(msg.get("nodes") or {})
+        for prefix in msg.get("expanded") or ():
+            for child in digest.child_hashes(prefix):
+                to_check.setdefault(child, format(0, "032x"))
+
+        for prefix, their_hash in to_check.items():
+            if len(prefix) > digest.depth or digest.hash(prefix) == their_hash:
+                continue
+            if prefix in their_covers or len(prefix) == digest.depth or digest.count(prefix) <= SYNC_LEAF_ENTRIES:
+                entries.extend(metadata_store.export(file_id) for file_id in digest.file_ids(prefix))
+                if prefix not in their_covers:
+                    covers.append(prefix)
+                    nodes[prefix] = digest.hash(prefix)
+            else:
+                expanded.append(prefix)
+                nodes.update(digest.child_hashes(prefix))
+
+    if not nodes and not entries:
+        return None
+    return {"nodes": nodes, "expanded": expanded, "covers": covers, "entries": entries}
+# end sync_step()
+
+def msg_send_sync(my_host, my_port, my_peer_id, to_host, to_port, step):
+    """
+    Sends a SYNC message with the fields in step.
+
+    Parameters:
+        my_host : the host of sender
+        my_port : the port of sender
+        my_peer_id : the peer id of the sender
+
+        to_host : the host of receiver
+        to_port : the port of receiver
+
+        step : the nodes, expanded, covers and entries to send
+    """
+    try:
+        deliver_message(msg_build_sync(my_host, my_port, my_peer_id, **step), to_host, to_port)
+    except Exception as e:
+        debug(f"Failed to send sync to {to_host}:{to_port}: {e}")
+# end msg_send_sync()
+
+def interval_sync(my_host, my_port, my_peer_id):
+    """
+    Every SYNC_INTERVAL, compare our metadata with a random tracked peer that supports SYNC.
+    Runs on a thread to happen while other things run
+    """
+    while True:
+        time.sleep(SYNC_INTERVAL)
+        peers = [peer_info for peer_id, peer_info in tracked_peers.items() if "sync" in peer_info.get("features", [])]
+        if peers:
+            peer_info = random.choice(peers)
+            msg_send_sync(my_host, my_port, my_peer_id, peer_info["host"], peer_info["port"], sync_start())
+# end interval_sync()
+#-----------------------#
+# end of Metadata Sync  #
+#-----------------------#
+
+
+
 #--------------------------#
 #---# Message Building #---#
 #                          #
@@ -562,23 +2321,26 @@ def msg_build_gossip(host, port, peer_id):
         "host": host,
         "port": port,
         "id": str(uuid.uuid4()),
-        "peerId": peer_id 
+        "peerId": peer_id,
+        "features": PROTOCOL_FEATURES,
+        "inventory_versions": inventory.known_versions(),
+        "file_filter": inventory.filter_version()
     }
 # end msg_build_gossip()
 
-def msg_build_gossip_reply(host, port, peer_id):
-    """Build a message for GOSSIP_REPLY format"""
-
-    # make sure we include the files known to us
-    metadata = load_metadata()
-    local_files = get_local_file_entries(metadata)
-
+def msg_build_gossip_reply(host, port, peer_id, known=None):
+    """
+    Build a message for GOSSIP_REPLY format. known is the version of our inventory the
+    receiver has seen, if any, and the reply only carries the files changed since then.
+    """
     return {
         "type": "GOSSIP_REPLY",
         "host": host,
         "port": port,
         "peerId": peer_id,
-        "files": local_files
+        "features": PROTOCOL_FEATURES,
+        "file_filter": inventory.file_filter(known),
+        **inventory.reply_files(known)
     }
 # end msg_build_gossip_reply()
 
@@ -591,6 +2353,33 @@ def msg_build_announce(peer_id, file_metadata):
     }
 # end msg_build_announce()
 
+def msg_build_announce_batch(peer_id, file_entries):
+    """Build a message for ANNOUNCE_BATCH format: the file metadata of several ANNOUNCEs in one message"""
+    return {
+        "type": "ANNOUNCE_BATCH",
+        "from": peer_id,
+        "files": file_entries
+    }
+# end msg_build_announce_batch()
+
+def msg_build_sync(host, port, peer_id, nodes, expanded=(), covers=(), entries=()):
+    """
+    Build a message for SYNC format: hashes of nodes of our metadata digest to compare,
+    and the file metadata under the covered or differing nodes.
+    """
+    return {
+        "type": "SYNC",
+        "host": host,
+        "port": port,
+        "peerId": peer_id,
+        "features": PROTOCOL_FEATURES,
+        "nodes": nodes,
+        "expanded": list(expanded),
+        "covers": list(covers),
+        "entries": list(entries)
+    }
+# end msg_build_sync()
+
 def msg_build_file_data(content, file_metadata):
     """Build a message for FILE_DATA format"""
     return {
@@ -600,6 +2389,44 @@ def msg_build_file_data(content, file_metadata):
     }
 # end msg_build_file_data()
 
+def msg_build_file_data_header(data_length, file_metadata):
+    """
+    Build the header for a binary FILE_DATA message.
+    The data_length bytes of the file are sent raw, right after the header.
+    """
+    return {
+        "type": "FILE_DATA",
+        **file_metadata,
+        "encoding": "binary",
+        "data_length": data_length
+    }
+# end msg_build_file_data_header()
+
+def msg_build_file_chunk_header(data_length, file_metadata, offset, total_size, chunk_sha256):
+    """
+    Build the header for a binary FILE_DATA message carrying one chunk of a file.
+    total_size is the size of the whole file in bytes, chunk_sha256 the sha256 of the chunk.
+    """
+    return {
+        **msg_build_file_data_header(data_length, file_metadata),
+        "offset": offset,
+        "total_size": total_size,
+        "chunk_sha256": chunk_sha256
+    }
+# end msg_build_file_chunk_header()
+
+def empty_file_metadata():
+    """File metadata sent in a FILE_DATA when we don't have the requested file"""
+    return {
+        "file_name": None,
+        "file_size": None,
+        "file_id": None,
+        "file_owner": None,
+        "file_timestamp": None,
+        "peers_with_file": None
+    }
+# end empty_file_metadata()
+
 def msg_build_delete(peer_id, file_id):
     """Build a message for DELETE format"""
     return {
@@ -609,12 +2436,27 @@ def msg_build_delete(peer_id, file_id):
     }
 # end msg_build_delete()
 
-def msg_build_get(file_id):
-    """Build a message for GET format"""
-    return {
+def msg_build_get(file_id, offset=None, length=None):
+    """Build a message for GET format. With an offset and length, only asks for that chunk of the file"""
+    msg = {
         "type": "GET_FILE",
-        "file_id": file_id
+        "file_id": file_id,
+        "features": PROTOCOL_FEATURES
+    }
+    if offset is not None:
+        msg["offset"] = offset
+        msg["length"] = length
+    return msg
+# end msg_build_get()
+
+def msg_build_busy(msg_type):
+    """Build a message for BUSY format, telling a peer we were too busy for its msg_type request"""
+    return {
+        "type": "BUSY",
+        "rejected": msg_type,
+        "retry_after": BUSY_RETRY_AFTER
     }
+# end msg_build_busy()
 #--------------------------#
 # end of Message Building  #
 #--------------------------#
@@ -627,23 +2469,365 @@ def msg_build_get(file_id):
 # code related to       #
 # tracking peers        #
 #-----------------------#
-def update_tracked_peer(host, port, peer_id):
+class GossipIdCache:
+    """
+    Remembers gossip ids for about ttl seconds, so each gossip is handled once, in bounded memory.
+
+    The ids are split into generation buckets, each covering ttl / buckets seconds. New ids go in
+    the newest bucket, and the oldest bucket is dropped whole once it is more than ttl old, so
+    expiring ids costs nothing per id. A bucket holds at most max_ids / buckets ids. When the
+    newest one is full, the next bucket starts early and the oldest may be dropped early, so
+    memory stays bounded even if gossip arrives faster than expected.
+
+    Counts hits (gossip seen before), misses (new gossip) and evictions (ids forgotten).
     """
-    Update the tracked_peers dictionary with new info on a peer
+    def __init__(self, ttl=GOSSIP_ID_TTL, buckets=GOSSIP_ID_BUCKETS, max_ids=GOSSIP_ID_MAX):
+        self.bucket_span = ttl / buckets
+        self.bucket_count = buckets
+        self.max_ids = max_ids
+        self.buckets = collections.deque([set()]) # oldest first
+        self.bucket_start = time.monotonic() # when the newest bucket started
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def check_and_add(self, gossip_id):
+        """Returns True if gossip_id was seen before. Otherwise remembers it and returns False"""
+        with self.lock:
+            self.rotate()
+            if self.contains(gossip_id):
+                self.hits += 1
+                return True
+            self.misses += 1
+            self.insert(gossip_id)
+            return False
+
+    def add(self, gossip_id):
+        """Remember gossip_id, such as the id of gossip we send ourselves"""
+        with self.lock:
+            self.rotate()
+            if not self.contains(gossip_id):
+                self.insert(gossip_id)
+
+    def contains(self, gossip_id):
+        return any(gossip_id in bucket for bucket in self.buckets)
+
+    def insert(self, gossip_id):
+        if len(self.buckets[-1]) >= self.max_ids // self.bucket_count:
+            # the newest bucket is full, so start the next one early and forget the oldest ids if needed
+            self.start_bucket()
+            if len(self.buckets) > self.bucket_count:
+                self.drop_oldest()
+        self.buckets[-1].add(gossip_id)
+        self.size += 1
+
+    def rotate(self):
+        """Start a new bucket for each bucket_span that has passed, and drop the buckets older than the ttl"""
+        elapsed = int((time.monotonic() - self.bucket_start) // self.bucket_span)
+        if elapsed == 0:
+            return
+        for _ in range(min(elapsed, self.bucket_count)):
+            self.start_bucket()
+        self.bucket_start += elapsed * self.bucket_span
+        while len(self.buckets) > self.bucket_count:
+            self.drop_oldest()
+
+    def start_bucket(self):
+        self.buckets.append(set())
+
+    def drop_oldest(self):
+        dropped = self.buckets.popleft()
+        self.size -= len(dropped)
+        self.evictions += len(dropped)
+
+    def stats(self):
+        """Returns the size and hit, miss and eviction counts of the cache"""
+        with self.lock:
+            self.rotate()
+            return {
+                "size": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def __len__(self):
+        return self.size
+# end GossipIdCache
+
+seen_gossip_ids = GossipIdCache() # gossip ids we have already handled, to avoid repeats
+
+class PeerRegistry:
     """
-    tracked_peers[peer_id] = {
-        "host": host,
-        "port": port,
-        "last_seen": time.time(),
-    }
+    The peers we are tracking. Safe to use from any thread.
+
+    Peers are kept by peer_id, with an index from (host, port) to peer_id so looking a peer up by
+    address doesn't scan every peer. A min-heap of (last_seen, peer_id) lets expire() look only at
+    the peers that timed out. Updating a peer pushes a new heap entry and leaves the old one behind;
+    old entries are skipped when they come up, and the heap is rebuilt once they pile up.
+
+    A peer's info is a dict with host, port, last_seen and features. It is replaced on every
+    update, never changed in place, so callers can keep using one without holding the lock.
+    """
+    def __init__(self):
+        self.peers = {} # key: peerId, value: dict with host, port, last_seen, features
+        self.by_address = {} # key: (host, port), value: peerId
+        self.expiry_heap = [] # (last_seen, peerId), oldest first
+        self.version = 0 # counts updates and removals, so readers can cheaply tell whether anything changed
+        self.members_version = 0 # counts peers joining, moving and leaving, but not a known peer being seen again
+        self.lock = threading.RLock()
+
+    def update(self, host, port, peer_id, features=None):
+        """Track peer_id at host:port as seen now. If features is None, keep the features we know"""
+        with self.lock:
+            old = self.peers.get(peer_id)
+            if features is None:
+                features = old["features"] if old else []
+            if old is not None:
+                self.unindex(peer_id, old)
+
+            info = {
+                "host": host,
+                "port": port,
+                "last_seen": time.time(),
+                "features": features,
+            }
+            self.peers[peer_id] = info
+            self.by_address[(host, port)] = peer_id
+            self.version += 1
+            if old is None or (old["host"], old["port"]) != (host, port):
+                self.members_version += 1
+            heapq.heappush(self.expiry_heap, (info["last_seen"], peer_id))
+            if len(self.expiry_heap) > 2 * len(self.peers) + 64:
+                self.rebuild_heap()
+
+    def rebuild_heap(self):
+        """Drop the old heap entries left behind by updates and removals"""
+        self.expiry_heap = [(info["last_seen"], peer_id) for peer_id, info in self.peers.items()]
+        heapq.heapify(self.expiry_heap)
+
+    def unindex(self, peer_id, info):
+        address = (info["host"], info["port"])
+        if self.by_address.get(address) == peer_id:
+            del self.by_address[address]
+
+    def remove(self, peer_id):
+        """Stop tracking peer_id. Returns its info, or None if it was not tracked"""
+        with self.lock:
+            info = self.peers.pop(peer_id, None)
+            if info is not None:
+                self.unindex(peer_id, info)
+                self.version += 1
+                self.members_version += 1
+            return info
+
+    def remove_address(self, host, port):
+        """Stop tracking the peer at host:port. Returns its peer_id, or None if no peer is tracked there"""
+        with self.lock:
+            peer_id = self.by_address.get((host, port))
+            if peer_id is not None:
+                self.remove(peer_id)
+            return peer_id
+
+    def expire(self, timeout):
+        """
+        Stop tracking the peers not heard from in timeout seconds.
+        Returns a list of (peer_id, info) for the peers removed.
+        """
+        cutoff = time.time() - timeout
+        expired = []
+        with self.lock:
+            while self.expiry_heap and self.expiry_heap[0][0] < cutoff:
+                last_seen, peer_id = heapq.heappop(self.expiry_heap)
+                info = self.peers.get(peer_id)
+                if info is None or info["last_seen"] != last_seen:
+                    continue # left behind by an update or removal
+                self.remove(peer_id)
+                expired.append((peer_id, info))
+        return expired
+
+    def get(self, peer_id, default=None):
+        return self.peers.get(peer_id, default)
+
+    def peer_id_at(self, host, port):
+        """Returns the peer_id tracked at host:port, or None"""
+        with self.lock:
+            return self.by_address.get((host, port))
+
+    def get_by_address(self, host, port):
+        """Returns the info of the peer tracked at host:port, or None"""
+        with self.lock:
+            peer_id = self.by_address.get((host, port))
+            return None if peer_id is None else self.peers.get(peer_id)
+
+    def items(self):
+        """Returns a list of (peer_id, info) for every tracked peer"""
+        with self.lock:
+            return list(self.peers.items())
+
+    def values(self):
+        with self.lock:
+            return list(self.peers.values())
+
+    def __contains__(self, peer_id):
+        return peer_id in self.peers
+
+    def __len__(self):
+        return len(self.peers)
+# end PeerRegistry
+
+tracked_peers = PeerRegistry()
+
+class BloomFilter:
+    """
+    Bloom filter of strings: says for sure when a key was never added, and may wrongly say
+    a key was added. Bit positions come from double hashing the SHA-256 of the key.
+    """
+    def __init__(self, size, hashes, bits=None):
+        self.size = size # bits
+        self.hashes = hashes
+        self.bits = bytearray(bits) if bits is not None else bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, count, false_positive_rate):
+        """Return an empty filter sized for count keys at false_positive_rate"""
+        count = max(count, 1)
+        size = max(8, math.ceil(-count * math.log(false_positive_rate) / math.log(2) ** 2))
+        hashes = max(1, round(size / count * math.log(2)))
+        return cls(size, hashes)
+
+    def positions(self, key):
+        digest = hashlib.sha256(key.encode()).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+    def encode(self):
+        """Return the filter as a JSON-friendly dictionary"""
+        return {"size": self.size, "hashes": self.hashes, "bits": base64.b64encode(self.bits).decode()}
+
+    @classmethod
+    def decode(cls, data):
+        """Return the filter encoded in data, or None if data is not a valid filter"""
+        try:
+            size = int(data["size"])
+            hashes = int(data["hashes"])
+            bits = base64.b64decode(data["bits"], validate=True)
+        except (TypeError, KeyError, ValueError):
+            return None
+        if size <= 0 or not 0 < hashes <= 64 or len(bits) != (size + 7) // 8:
+            return None
+        return cls(size, hashes, bits)
+# end BloomFilter
+
+class HolderFilters:
+    """
+    The Bloom filters of local files the peers send in their GOSSIP and GOSSIP_REPLY messages,
+    so we know who may have a file without keeping a full list of every peer's files.
+
+    A filter can claim a file the peer doesn't have. The peer then answers our GET_FILE with an
+    empty FILE_DATA, and the miss is remembered so we don't ask that peer again, until it sends
+    a different filter.
+    """
+    def __init__(self):
+        self.filters = {} # key: peer_id, value: (epoch, version, BloomFilter)
+        self.misses = {} # key: peer_id, value: set of the file_ids its filter claims but it doesn't have
+        self.false_positives = 0
+        self.lock = threading.Lock()
+
+    def update(self, peer_id, data):
+        """
+        Store the filter a peer sent, if it is new. data may only carry the version of the peer's
+        filter, when the peer thinks we have it. Returns True if we have the filter of that version
+        """
+        if not isinstance(data, dict):
+            return False
+        with self.lock:
+            current = self.filters.get(peer_id)
+            if current and (current[0], current[1]) == (data.get("epoch"), data.get("version")):
+                return True # same inventory as last time
+        if "bits" not in data:
+            return False # a version we don't have the filter of. A GOSSIP_REPLY brings it when we ask with an older version
+        bloom = BloomFilter.decode(data)
+        if bloom is None:
+            debug(f"Ignoring bad file filter from peer {peer_id}")
+            return False
+        with self.lock:
+            self.filters[peer_id] = (data.get("epoch"), data.get("version"), bloom)
+            self.misses.pop(peer_id, None)
+        return True
+
+    def may_hold(self, peer_id, file_id):
+        """Return True if peer_id's filter says it may have file_id, and it never told us otherwise"""
+        with self.lock:
+            current = self.filters.get(peer_id)
+            return current is not None and file_id in current[2] and file_id not in self.misses.get(peer_id, ())
+
+    def miss(self, peer_id, file_id):
+        """peer_id answered that it doesn't have file_id"""
+        with self.lock:
+            current = self.filters.get(peer_id)
+            if current is not None and file_id in current[2]:
+                self.false_positives += 1
+                self.misses.setdefault(peer_id, set()).add(file_id)
+
+    def forget(self, peer_id):
+        with self.lock:
+            self.filters.pop(peer_id, None)
+            self.misses.pop(peer_id, None)
+# end HolderFilters
+
+holder_filters = HolderFilters()
+
+def update_tracked_peer(host, port, peer_id, features=None):
+    """
+    Update tracked_peers with new info on a peer
+
+    features is the list of optional protocol features the peer advertised. If None, the
+    features we already know for the peer are kept.
+    """
+    tracked_peers.update(host, port, peer_id, features)
 # end update_tracked_peer()
 
+def peer_supports(peer_id, feature):
+    """
+    Returns True if the tracked peer peer_id advertised support for feature
+    """
+    peer_info = tracked_peers.get(peer_id)
+    return bool(peer_info) and feature in peer_info.get("features", [])
+# end peer_supports()
+
+def address_features(host, port):
+    """
+    Returns the protocol features advertised by the tracked peer at host:port
+    """
+    peer_info = tracked_peers.get_by_address(host, port)
+    return peer_info["features"] if peer_info else []
+# end address_features()
+
+def address_supports(host, port, feature):
+    """
+    Returns True if the tracked peer at host:port advertised support for feature
+    """
+    return feature in address_features(host, port)
+# end address_supports()
+
 def peer_cleanup():
     """
     Periodically checks our tracked peers to see if any are inactive. Interval set by PEER_CLEANUP_INTERVAL
     """
     while True:
         remove_old_peers()
+        connection_pool.close_idle()
         time.sleep(PEER_CLEANUP_INTERVAL)
 # end peer_cleanup()
 
@@ -651,41 +2835,49 @@ def remove_peer(host, port):
     """
     Remove a peer from tracked peers right away
     """
-    for peer_id, peer_info in list(tracked_peers.items()):
-        if peer_info["host"] == host and peer_info["port"] == port:
-            print(f"Removing unreachable peer {peer_id} at {host}:{port}")
-            del tracked_peers[peer_id]
-            remove_peer_from_files(peer_id)
-            break
+    peer_id = tracked_peers.remove_address(host, port)
+    if peer_id is not None:
+        print(f"Removing unreachable peer {peer_id} at {host}:{port}")
+        connection_pool.close_address(host, port)
+        remove_peer_from_files(peer_id)
+        inventory.forget(peer_id)
+        holder_filters.forget(peer_id)
+        metrics.peer_removed(peer_id)
 # end remove_peer()
 
 def remove_old_peers(timeout=PEER_TIMEOUT):
     """
-    Removes peers from tracked peers that have not been heard from in timeout seconds
+    Removes peers from tracked peers that have not been heard from in timeout seconds.
+    Only looks at the peers that timed out, so it is cheap to run with many peers.
     """
-    now = time.time()
-    for peer_id in list(tracked_peers.keys()):
-        if now - tracked_peers[peer_id]["last_seen"] > timeout:
-            debug(f"Removing old peer {peer_id}")
-            del tracked_peers[peer_id]
-            remove_peer_from_files(peer_id)
+    for peer_id, peer_info in tracked_peers.expire(timeout):
+        debug(f"Removing old peer {peer_id}")
+        connection_pool.close_address(peer_info["host"], peer_info["port"])
+        remove_peer_from_files(peer_id)
+        inventory.forget(peer_id)
+        holder_filters.forget(peer_id)
+        metrics.peer_removed(peer_id)
 # end remove_old_peers()
 
 def peers_with_file(file_id):
     """
-    Returns a list of tracked peers that have file_id
+    Returns a list of tracked peers that have file_id. Peers whose file filter says they
+    may have it come after the ones we know have it.
+
+    Probes the filter of every tracked peer, O(peers) SHA-256 lookups. Only the get command
+    calls it, once per download, so keep it off the paths that run for every message.
     """
-    metadata = load_metadata()
-    file_info = metadata.get(file_id)
-    if not file_info or "peers_with_file" not in file_info:
-        return []
-    
     # make sure to only return peers that we are still tracking
     peers = [
-        peer_id for peer_id in file_info["peers_with_file"]
+        peer_id for peer_id in metadata_store.holders_of(file_id)
         if peer_id in tracked_peers
     ]
 
+    known = set(peers)
+    peers.extend(
+        peer_id for peer_id, _ in tracked_peers.items()
+        if peer_id not in known and holder_filters.may_hold(peer_id, file_id)
+    )
     return peers
 # end peers_with_file()
 #-----------------------#
@@ -700,33 +2892,188 @@ def peers_with_file(file_id):
 # code related to managing        #
 # the p2p server                  #
 #---------------------------------#
-def receive_message(client_socket):
+class MessageReader:
     """
-    Receive in a valid-formatted JSON message from client_socket
+    Reads messages from a socket.
+
+    Understands two formats:
+        framed: FRAME_MAGIC + 4 byte length + JSON payload. The payload is read into a buffer
+            of exactly that length and parsed once.
+        legacy: a bare JSON object, from peers that do not support framing. A brace scanner
+            tracks the nesting depth over new bytes only, and the JSON is parsed once, when
+            the depth gets back to zero.
+
+    Bytes received past the end of a message are kept for the next read, so a message can be
+    followed by raw binary data (binary FILE_DATA) or by another message.
+
+    The parse_*() generators do the parsing and never touch the socket. When they need more
+    bytes they yield: None to have the buffer filled (sent back: False if the connection closed),
+    or a memoryview to receive raw bytes straight into (sent back: how many were received).
+    run() answers them from the socket, and AsyncMessageReader answers the same generators
+    from an asyncio stream.
     """
-    buffer = b""
-    decoder = json.JSONDecoder()
-    while True:
-        data = client_socket.recv(4096)
-        debug(f"receive_message: recv returned {len(data)} bytes: {data}")
+    RECV_SIZE = 65536
+    LEGACY_TOKENS = re.compile(rb'[{}\[\]"\\]') # the only bytes the brace scanner cares about
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.reset_scanner()
+
+    def reset_scanner(self):
+        """Reset the legacy brace scanner for a new message"""
+        self.scan_pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False # the last scanned byte was a backslash inside a string
+
+    def fill(self):
+        """Receive more bytes into the buffer. Returns False if the connection closed"""
+        data = self.sock.recv(self.RECV_SIZE)
+        debug(f"receive_message: recv returned {len(data)} bytes")
         if not data:
-            break
-        buffer += data
+            return False
+        metrics.bytes_received.inc(len(data))
+        self.buffer += data
+        return True
+
+    def recv_into(self, view):
+        """Receive raw bytes into view. Returns how many were received, 0 if the connection closed"""
+        count = self.sock.recv_into(view)
+        metrics.bytes_received.inc(count)
+        return count
+
+    def run(self, parser):
+        """Run the parse_*() generator parser, receiving the bytes it asks for. Returns what it parsed"""
         try:
-            msg, index = decoder.raw_decode(buffer.decode())
-            return msg
-        except json.JSONDecodeError:
-            continue  # need more data
+            request = next(parser)
+            while True:
+                request = parser.send(self.fill() if request is None else self.recv_into(request))
+        except StopIteration as done:
+            return done.value
+
+    def read_message(self):
+        """
+        Receive in a valid-formatted JSON message, and the raw bytes of a binary FILE_DATA.
+        Returns None if the connection closed first.
+        """
+        return self.run(self.parse_message())
+
+    def parse_message(self):
+        """Parse a message, and for a binary FILE_DATA the raw file bytes following it into its "data" field"""
+        msg = yield from self.parse_json()
+        if msg and msg.get("type") == "FILE_DATA" and msg.get("encoding") == "binary":
+            length = msg.get("data_length")
+            if not isinstance(length, int) or isinstance(length, bool) or length < 0:
+                raise ConnectionError(f"Received a FILE_DATA with a bad data_length: {length!r}.")
+            if length > MAX_FILE_DATA_SIZE:
+                raise ConnectionError(f"Received a {length} byte FILE_DATA, larger than {MAX_FILE_DATA_SIZE} bytes.")
+            msg["data"] = yield from self.parse_exact(length)
+        return msg
+
+    def parse_json(self):
+        """
+        Parse a valid-formatted JSON message. Returns None if the connection closed first.
+        """
+        # skip whitespace between legacy messages, and find out which format this one is
+        while not self.buffer.lstrip():
+            self.buffer.clear()
+            if not (yield None):
+                return None
+        if self.buffer[0:1].isspace():
+            del self.buffer[:len(self.buffer) - len(self.buffer.lstrip())]
+
+        if self.buffer[0] == FRAME_MAGIC[0]:
+            return (yield from self.parse_framed())
+        return (yield from self.parse_legacy())
+
+    def parse_framed(self):
+        """Parse a length-prefixed message"""
+        header = yield from self.parse_exact(FRAME_HEADER.size)
+        magic, length = FRAME_HEADER.unpack(header)
+        if magic != FRAME_MAGIC:
+            raise ConnectionError("Received a message with a bad frame header.")
+        if length > MAX_FRAME_SIZE:
+            raise ConnectionError(f"Received a {length} byte message, larger than {MAX_FRAME_SIZE} bytes.")
+        return json.loads((yield from self.parse_exact(length)))
+
+    def parse_legacy(self):
+        """Parse a bare JSON object"""
+        if self.buffer[0:1] not in (b"{", b"["):
+            raise ConnectionError("Received data that is not a JSON message.")
+
+        self.reset_scanner()
+        while True:
+            end = self.scan()
+            if end is not None:
+                msg = json.loads(self.buffer[:end])
+                del self.buffer[:end]
+                return msg
+            if not (yield None):
+                raise ConnectionError("Connection closed before valid JSON was received.")
+
+    def scan(self):
+        """
+        Advance the brace scanner over the bytes received since the last scan.
+        Returns the end index of the JSON value once its braces balance, otherwise None.
+        """
+        buffer = self.buffer
+        pos = self.scan_pos
+        if self.escaped and pos < len(buffer):
+            pos += 1 # skip the escaped byte
+            self.escaped = False
+
+        while True:
+            match = self.LEGACY_TOKENS.search(buffer, pos)
+            if match is None:
+                self.scan_pos = len(buffer)
+                return None
+
+            token = buffer[match.start()]
+            pos = match.end()
+            if self.in_string:
+                if token == ord("\\"):
+                    if pos < len(buffer):
+                        pos += 1 # skip the escaped byte
+                    else:
+                        self.escaped = True
+                        self.scan_pos = pos
+                        return None
+                elif token == ord('"'):
+                    self.in_string = False
+            elif token == ord('"'):
+                self.in_string = True
+            elif token in b"{[":
+                self.depth += 1
+            elif token in b"}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    return pos
+
+    def parse_exact(self, length):
+        """Parse exactly length raw bytes, into a preallocated buffer"""
+        data = bytearray(length)
+        view = memoryview(data)
+        received = min(length, len(self.buffer))
+        view[:received] = self.buffer[:received]
+        del self.buffer[:received]
+
+        while received < length:
+            count = yield view[received:]
+            if count == 0:
+                raise ConnectionError(f"Connection closed after {received} of {length} bytes of data.")
+            received += count
+        return data
+# end MessageReader
+
+def receive_message(reader):
+    """
+    Receive in a valid-formatted JSON message from the MessageReader reader
 
-    if buffer:
-        # final attempt to parse
-        try:
-            msg, _ = decoder.raw_decode(buffer.decode())
-            return msg
-        except json.JSONDecodeError:
-            raise ConnectionError("Connection closed before valid JSON was received.")
-    else:
-        return None
+    For a binary FILE_DATA message the raw file bytes following it are received too, and
+    stored in the message's "data" field.
+    """
+    return reader.read_message()
 # end receive_message()
 
 def receive_msg_gossip(msg, my_peer_id, my_host, my_port):
@@ -738,37 +3085,77 @@ def receive_msg_gossip(msg, my_peer_id, my_host, my_port):
     gossip_id = msg["id"]
     the_peer_id = msg["peerId"]
 
-    if gossip_id in seen_gossip_ids:
+    if seen_gossip_ids.check_and_add(gossip_id):
         return # we have seen the gossip so do no more
-    
-    seen_gossip_ids.add(gossip_id) # new gossip to us, so add and process
-    update_tracked_peer(the_host, the_port, the_peer_id) # track the peer who gossiped to us
+    # new gossip to us, so process it
+    update_tracked_peer(the_host, the_port, the_peer_id, msg.get("features", [])) # track the peer who gossiped to us
+    holder_filters.update(the_peer_id, msg.get("file_filter"))
 
-    msg_send_gossip_reply(my_host, my_port, my_peer_id, the_host, the_port)
+    # the gossip says which version of our inventory its sender has, so we can send just the changes
+    known_versions = msg.get("inventory_versions")
+    known = known_versions.get(my_peer_id) if isinstance(known_versions, dict) else None
+    msg_send_gossip_reply(my_host, my_port, my_peer_id, the_host, the_port, known)
 
     # Forward the message to some of my known peers
     n_peer_gossip(GOSSIP_PEER_COUNT, my_host, my_port, my_peer_id, msg)
 # end receive_msg_gossip()
 
-def receive_msg_gossip_reply(msg, my_peer_id, my_host, my_port):
+def receive_msg_gossip_reply(msg, my_peer_id, my_host, my_port):
+    """
+    Handles a GOSSIP_REPLY message received by this peer.
+    """
+    the_host = msg["host"]
+    the_port = msg["port"]
+    the_peer_id = msg["peerId"]
+    the_local_files = msg["files"]
+
+    update_tracked_peer(the_host, the_port, the_peer_id, msg.get("features", [])) # track the peer who gossiped a reply to us
+    has_filter = holder_filters.update(the_peer_id, msg.get("file_filter"))
+
+    # update metadata of all the received files in one batch, and drop the files the peer no longer has.
+    # A delta reply lists those. A full reply from a peer that versions its inventory has every file it holds.
+    if msg.get("delta"):
+        removed = msg.get("removed", ())
+    elif "inventory" in msg:
+        removed = metadata_store.files_held_by(the_peer_id) - {entry.get("file_id") for entry in the_local_files}
+    else:
+        removed = ()
+    updated_files = metadata_store.merge(the_local_files, the_peer_id, removed)
+    if "file_filter" in msg and not has_filter:
+        inventory.forget(the_peer_id) # we missed its filter, ask for everything again
+    else:
+        inventory.saw(the_peer_id, msg)
+    if updated_files:
+        print(f"Updated metadata for {len(updated_files)} file(s) from peer {the_peer_id}")
+        for file_id in updated_files:
+            debug(f"Updated metadata for file '{file_id}'")
+# end receive_msg_gossip_reply()
+
+def receive_msg_sync(msg, my_peer_id, my_host, my_port):
     """
-    Handles a GOSSIP_REPLY message received by this peer.
+    Handles a SYNC message: merges the metadata it carries, then answers with ours where we still differ.
     """
     the_host = msg["host"]
     the_port = msg["port"]
     the_peer_id = msg["peerId"]
-    the_local_files = msg["files"]
 
-    update_tracked_peer(the_host, the_port, the_peer_id) # track the peer who gossiped a reply to us
+    update_tracked_peer(the_host, the_port, the_peer_id, msg.get("features", []))
 
-    # update metadata of all the received files
-    for file_metadata in the_local_files:
-        file_id = file_metadata["file_id"]
-        add_peer_to_file(file_id, the_peer_id)
-        updated_file = update_metadata(file_id, file_metadata)
-        if updated_file:
-            print(f"Updated metadata for file '{file_id}'")
-# end receive_msg_gossip_reply()
+    # files deleted here stay deleted, even if the peer missed the DELETE
+    entries = [
+        entry for entry in msg.get("entries") or ()
+        if isinstance(entry, dict) and not metadata_store.was_deleted(entry.get("file_id"))
+    ]
+    updated_files = metadata_store.merge(entries, None)
+    if updated_files:
+        print(f"Synced metadata for {len(updated_files)} file(s) with peer {the_peer_id}")
+
+    step = sync_step(msg)
+    if step is None:
+        debug(f"Metadata in sync with peer {the_peer_id}")
+        return
+    msg_send_sync(my_host, my_port, my_peer_id, the_host, the_port, step)
+# end receive_msg_sync()
 
 def receive_msg_announce(msg):
     """
@@ -792,6 +3179,22 @@ def receive_msg_announce(msg):
         print(f"Metadata updated for announced file: '{file_name}'")
 # end receive_msg_announce()
 
+def receive_msg_announce_batch(msg):
+    """
+    Handles an ANNOUNCE_BATCH message by updating this peers known metadata for all of its files at once
+    """
+    peer_id = msg["from"]
+    file_entries = msg.get("files", [])
+    print(f"Received {len(file_entries)} file announcement(s) from {peer_id}")
+
+    # one metadata transaction and journal record for the whole batch
+    updated_files = metadata_store.merge(file_entries, peer_id)
+    if updated_files:
+        print(f"Metadata updated for {len(updated_files)} announced file(s)")
+        for file_id in updated_files:
+            debug(f"Updated metadata for file '{file_id}'")
+# end receive_msg_announce_batch()
+
 def receive_msg_delete(msg):
     """
     Handles a DELETE message by deleting the file locally if the sender owns the file.
@@ -799,8 +3202,7 @@ def receive_msg_delete(msg):
     from_peer = msg["from"]
     file_id = msg["file_id"]
 
-    metadata = load_metadata()
-    file_info = metadata.get(file_id)
+    file_info = metadata_store.get(file_id)
 
     if not file_info:
         return # nothing to delete
@@ -812,49 +3214,105 @@ def receive_msg_delete(msg):
     
     # Remove file if this peer has it
     file_path = os.path.join(FILE_UPLOAD_PATH, file_id)
-    if os.path.isfile(file_path):
+    had_file = os.path.isfile(file_path)
+    if had_file:
         os.remove(file_path)
         print(f"Deleted local file {file_id} on request from owner {from_peer}")
 
     # update metadata
-    metadata.pop(file_id)
-    save_metadata(metadata)
+    metadata_store.delete(file_id)
+    if had_file:
+        metadata_store.local_files_changed()
 # end receive_msg_delete()
 
 def receive_msg_get(msg, client_socket):
     """
     Handles a GET message by checking if I still have the file that's been requested, then sending it.
     Maintains a TCP connection
+
+    The file is streamed from disk, it is never read into memory as a whole.
+    """
+    f, parts = build_get_reply(msg)
+    try:
+        for part in parts:
+            if isinstance(part, tuple):
+                stream_file(client_socket, f, *part)
+            else:
+                client_socket.sendall(part)
+                metrics.bytes_sent.inc(len(part))
+    finally:
+        if f is not None:
+            f.close()
+
+    debug(f"FILE_DATA sent on socket: {client_socket.getsockname()} -> {client_socket.getpeername()}")
+# end receive_msg_get()
+
+def build_get_reply(msg):
+    """
+    Works out the reply to a GET message. Used by both the threaded and the asyncio server.
+
+    Sends raw binary data if the requester supports it, otherwise the data is hex-encoded.
+    A GET with an offset and length is answered with just that chunk of the file.
+
+    Returns (f, parts): the open file being sent, or None, and an iterator over the parts of the
+    reply in order. A part is either bytes to send, or an (offset, count) range of f to send
+    straight from disk. The caller closes f once the reply is sent.
     """
     file_id = msg["file_id"]
+    features = msg.get("features", [])
+    framed = "framed" in features
 
     file_path = os.path.join(FILE_UPLOAD_PATH, file_id)
+    file_metadata = metadata_store.get(file_id) if os.path.isfile(file_path) else None
 
-    if not os.path.isfile(file_path):
+    if "offset" in msg:
+        return build_get_chunk_reply(msg, file_path, file_metadata)
+
+    if file_metadata is None:
         # We don't have the file, so send a None type FILE_DATA
-        file_contents = b""
-        file_metadata = {
-            "file_name": None,
-            "file_size": None,
-            "file_id": None,
-            "file_owner": None,
-            "file_timestamp": None,
-            "peers_with_file": None
-        }
-    else:
-        # We have the file, so send it
-        # load up the file
-        metadata = load_metadata()
-        file_metadata = metadata.get(file_id)
-        with open(file_path, "rb") as f:
-            file_contents = f.read()
-    
-    response = msg_build_file_data(file_contents, file_metadata)
+        if "binary" in features:
+            response = msg_build_file_data_header(0, empty_file_metadata())
+        else:
+            response = msg_build_file_data(b"", empty_file_metadata())
+        return None, iter([encode_message(response, framed)])
+
+    # We have the file, so send it
+    f = open(file_path, "rb")
+    file_size = os.fstat(f.fileno()).st_size
+    if "binary" in features:
+        response = msg_build_file_data_header(file_size, file_metadata)
+        return f, iter([encode_message(response, framed), (0, file_size)])
+    return f, hex_file_blocks(f, file_size, file_metadata)
+# end build_get_reply()
+
+def build_get_chunk_reply(msg, file_path, file_metadata):
+    """
+    Works out the reply to a ranged GET message: the requested chunk of the file as a binary FILE_DATA.
+    Sends an empty FILE_DATA if we don't have the file. Returns (f, parts) like build_get_reply()
+    """
+    file_id = msg["file_id"]
+    offset = int(msg["offset"])
+    length = min(int(msg.get("length", DOWNLOAD_CHUNK_SIZE)), MAX_CHUNK_SIZE)
+    framed = "framed" in msg.get("features", [])
 
-    client_socket.sendall(json.dumps(response).encode())
+    if file_metadata is None or offset < 0 or length < 0:
+        # We don't have the file, so send a None type FILE_DATA
+        response = msg_build_file_chunk_header(0, empty_file_metadata(), offset, 0, None)
+        return None, iter([encode_message(response, framed)])
 
-    debug(f"FILE_DATA sent on socket: {client_socket.getsockname()} -> {client_socket.getpeername()}")
-# end receive_msg_get()
+    f = open(file_path, "rb")
+    try:
+        total_size = os.fstat(f.fileno()).st_size
+        length = max(0, min(length, total_size - offset))
+        chunk_sha256 = hash_file_range(f, offset, length)
+    except Exception:
+        f.close()
+        raise
+
+    response = msg_build_file_chunk_header(length, file_metadata, offset, total_size, chunk_sha256)
+    debug(f"Sending {length} bytes of {file_id} at offset {offset}")
+    return f, iter([encode_message(response, framed), (offset, length)])
+# end build_get_chunk_reply()
 
 def receive_msg_file_data(msg, my_peer_id):
     """
@@ -867,17 +3325,20 @@ def receive_msg_file_data(msg, my_peer_id):
     file_id = msg["file_id"]
     file_owner = msg["file_owner"]
     file_timestamp = msg["file_timestamp"]
-    data_hex = msg["data"]
+    data = msg["data"]
 
     if file_id is None:
         return # they sent a bad file
 
-    # decode hex back into bytes
-    try:
-        file_bytes = bytes.fromhex(data_hex)
-    except ValueError:
-        debug("Received FILE_DATA with invalid hex data.")
-        return
+    if isinstance(data, str):
+        # decode hex back into bytes
+        try:
+            file_bytes = bytes.fromhex(data)
+        except ValueError:
+            debug("Received FILE_DATA with invalid hex data.")
+            return
+    else:
+        file_bytes = data # binary FILE_DATA, already raw bytes
 
     # save the file locally
     file_path = os.path.join(FILE_UPLOAD_PATH, file_id)
@@ -899,65 +3360,219 @@ def receive_msg_file_data(msg, my_peer_id):
         "file_timestamp": file_timestamp
     }
 
+    file_received(file_metadata, my_peer_id)
+# end receive_msg_file_data()
+
+def file_received(file_metadata, my_peer_id):
+    """
+    Updates our metadata for a file we just saved locally, then announces it to all peers
+    """
+    file_id = file_metadata["file_id"]
+
     # update our metadata
     update_metadata(file_id, file_metadata)
-    add_peer_to_file(file_id, file_owner)
+    add_peer_to_file(file_id, file_metadata["file_owner"])
     add_peer_to_file(file_id, my_peer_id)
+    metadata_store.local_files_changed()
 
-    #reload and make sure we have up-to-date metadata before we announce to peers
-    metadata = load_metadata()
-    file_info = metadata.get(file_id)
+    # make sure we have up-to-date metadata before we announce to peers
+    file_info = metadata_store.get(file_id)
 
     # ANNOUNCE to all peers
-    for peer_id, peer_info in list(tracked_peers.items()):
-        msg_send_announce(my_peer_id, file_info, peer_info["host"], peer_info["port"], peer_id)
-
-# end receive_msg_file_data()
+    msg_send_announce(my_peer_id, file_info)
+# end file_received()
 
 def handle_message(msg, my_peer_id, my_host, my_port, client_socket):
     """
     Takes in a msg message and parses the info to pass it off to the correct message type handler
     """
     type = msg["type"]
+    start = time.perf_counter()
 
-    if type == "GOSSIP":
-        debug("Handling GOSSIP")
-        receive_msg_gossip(msg, my_peer_id, my_host, my_port)
-    elif type == "GOSSIP_REPLY":
-        debug("Handling GOSSIP_REPLY")
-        receive_msg_gossip_reply(msg, my_peer_id, my_host, my_port)
-    elif type == "ANNOUNCE":
-        debug("Handling ANNOUNCE")
-        receive_msg_announce(msg)
-    elif type == "FILE_DATA":
-        debug("Handling file_data")
-        receive_msg_file_data(msg, my_peer_id)
-    elif type == "DELETE":
-        debug("Handling DELETE")
-        receive_msg_delete(msg)
-    elif type == "GET_FILE":
-        debug("Handling GET")
-        receive_msg_get(msg, client_socket)
-    else:
-        print(f"Unhandled Message Type: {type}")
+    try:
+        if type == "GOSSIP":
+            debug("Handling GOSSIP")
+            receive_msg_gossip(msg, my_peer_id, my_host, my_port)
+        elif type == "GOSSIP_REPLY":
+            debug("Handling GOSSIP_REPLY")
+            receive_msg_gossip_reply(msg, my_peer_id, my_host, my_port)
+        elif type == "SYNC":
+            debug("Handling SYNC")
+            receive_msg_sync(msg, my_peer_id, my_host, my_port)
+        elif type == "ANNOUNCE":
+            debug("Handling ANNOUNCE")
+            receive_msg_announce(msg)
+        elif type == "ANNOUNCE_BATCH":
+            debug("Handling ANNOUNCE_BATCH")
+            receive_msg_announce_batch(msg)
+        elif type == "FILE_DATA":
+            debug("Handling file_data")
+            receive_msg_file_data(msg, my_peer_id)
+        elif type == "DELETE":
+            debug("Handling DELETE")
+            receive_msg_delete(msg)
+        elif type == "GET_FILE":
+            debug("Handling GET")
+            receive_msg_get(msg, client_socket)
+        elif type == "BUSY":
+            print(f"Peer was too busy to handle our {msg.get('rejected')}. Try again in {msg.get('retry_after')} seconds.")
+        else:
+            print(f"Unhandled Message Type: {type}")
+    finally:
+        metrics.handled(type, time.perf_counter() - start)
 # end handle_message()
 
+class MessageWorkerPool:
+    """
+    Runs the handlers for incoming messages on a fixed number of worker threads.
+
+    Each message type has its own bounded queue. Workers always take from the queue with the
+    highest priority (lowest MESSAGE_PRIORITIES value) that has work in it, so gossip goes ahead
+    of announcements, and those go ahead of bulk file transfers. Bulk messages never use more than
+    workers - reserved workers at once, so a slow FILE_DATA can't hold up gossip.
+
+    When the queue for a message type is full, submit() refuses the message and the caller sheds it.
+    Except for UNSHED_MESSAGE_TYPES: a pushed FILE_DATA is the only copy of its file coming our way,
+    and is already in memory, so submit() waits for room in the queue instead.
+    """
+    def __init__(self, workers=MESSAGE_WORKERS, reserved=MESSAGE_RESERVED_WORKERS):
+        self.workers = workers
+        self.bulk_workers = workers - reserved
+        self.queues = {} # key: message type, value: deque of (future, fn, args)
+        self.active_bulk = 0
+        self.idle = 0 # workers waiting for a task
+        self.rejected = collections.Counter() # key: message type, value: number of messages shed
+        lock = threading.Lock()
+        self.condition = threading.Condition(lock) # notified when a task is queued
+        self.space = threading.Condition(lock) # notified when an UNSHED_MESSAGE_TYPES queue has room
+
+    def start(self):
+        """Start the worker threads"""
+        for _ in range(self.workers):
+            threading.Thread(target=self.worker, daemon=True).start()
+
+    def submit(self, msg_type, fn, *args):
+        """
+        Queue fn(*args) to handle a message of msg_type.
+        Returns a concurrent.futures.Future for its result, or None if the queue for msg_type is full.
+        For UNSHED_MESSAGE_TYPES it blocks until the queue has room, and never returns None.
+        """
+        with self.condition:
+            queue = self.queues.setdefault(msg_type, collections.deque())
+            limit = MESSAGE_QUEUE_LIMITS.get(msg_type, DEFAULT_MESSAGE_QUEUE_LIMIT)
+            if msg_type in UNSHED_MESSAGE_TYPES:
+                while len(queue) >= limit:
+                    self.space.wait()
+            elif len(queue) >= limit:
+                self.rejected[msg_type] += 1
+                return None
+            future = concurrent.futures.Future()
+            queue.append((future, fn, args))
+            self.condition.notify()
+            return future
+
+    def priority(self, msg_type):
+        return MESSAGE_PRIORITIES.get(msg_type, 1)
+
+    def next_task(self):
+        """Returns (msg_type, task) for the task a free worker should run next, or None if it should wait"""
+        for msg_type in sorted(self.queues, key=self.priority):
+            if not self.queues[msg_type]:
+                continue
+            if self.priority(msg_type) >= BULK_MESSAGE_PRIORITY and self.active_bulk >= self.bulk_workers:
+                continue # leave the reserved workers for the other messages
+            if msg_type in UNSHED_MESSAGE_TYPES:
+                self.space.notify_all() # a waiting submit() may queue its message now
+            return msg_type, self.queues[msg_type].popleft()
+        return None
+
+    def worker(self):
+        """Runs queued tasks, highest priority first, forever"""
+        while True:
+            with self.condition:
+                task = self.next_task()
+                while task is None:
+                    self.idle += 1
+                    self.condition.wait()
+                    self.idle -= 1
+                    task = self.next_task()
+                msg_type, (future, fn, args) = task
+                bulk = self.priority(msg_type) >= BULK_MESSAGE_PRIORITY
+                if bulk:
+                    self.active_bulk += 1
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except Exception as e:
+                    future.set_exception(e)
+
+            if bulk:
+                with self.condition:
+                    self.active_bulk -= 1
+                    self.condition.notify() # a waiting bulk task may run now
+# end MessageWorkerPool
+
+message_pool = MessageWorkerPool()
+
+def shed_message(msg, addr):
+    """
+    Called when msg was refused because the queue for its type is full.
+    Returns the bytes to reply with, or None if the message is just dropped.
+
+    A GET_FILE gets a BUSY reply if the requester understands it, otherwise the empty FILE_DATA
+    older peers already take to mean the file can't be sent. Other messages expect no reply, so
+    they are dropped: gossip is sent again every GOSSIP_INTERVAL, and gossip replies bring back
+    any announcement we missed. FILE_DATA is never shed, see MessageWorkerPool.
+    """
+    msg_type = msg.get("type")
+    debug(f"Too busy, shedding {msg_type} from {addr}")
+    if msg_type != "GET_FILE":
+        return None
+
+    features = msg.get("features", [])
+    if "busy" in features:
+        response = msg_build_busy(msg_type)
+    elif "binary" in features:
+        response = msg_build_file_data_header(0, empty_file_metadata())
+    else:
+        response = msg_build_file_data(b"", empty_file_metadata())
+    return encode_message(response, "framed" in features)
+# end shed_message()
+
 def handle_client(client_socket, addr, peer_id, host, port):
     """
-    Handles receiving messages from a client and passing off responsibility to the correct handlers
+    Handles receiving messages from a client and passing off responsibility to the correct handlers,
+    which run on the message_pool workers
+
+    Peers may keep the connection open to send more messages. It is closed after SERVER_IDLE_TIMEOUT
+    seconds without a message.
     """
     debug(f"Accepted connection from {addr}")
+    client_socket.settimeout(SERVER_IDLE_TIMEOUT)
+    reader = MessageReader(client_socket)
     try:
         while True: # loop in case of multiple messages
-            msg = receive_message(client_socket)
+            msg = receive_message(reader)
             if not msg:
                 debug(f"Connection close by peer at {addr}")
                 break
             if msg.get("peerId") == peer_id:
                 debug(f"Received connection my myself. Ignoring.")
                 continue # ignore because it's my own message
-            debug(f"Received from {addr}: {msg}")
-            handle_message(msg, peer_id, host, port, client_socket)
+            debug(f"Received from {addr}: {describe_message(msg)}")
+            metrics.received.inc(label_value=metrics.message_type(msg.get("type")))
+            # wait for the handler, so messages from one connection are handled in order
+            future = message_pool.submit(msg.get("type"), handle_message, msg, peer_id, host, port, client_socket)
+            if future is None:
+                reply = shed_message(msg, addr)
+                if reply:
+                    client_socket.sendall(reply)
+                    metrics.bytes_sent.inc(len(reply))
+                continue
+            future.result()
+    except socket.timeout:
+        debug(f"Closing idle connection from {addr}")
     except Exception as e:
         print(f"Exception while communicating with {addr}: {e}")
     finally:
@@ -970,7 +3585,7 @@ def p2p_help_commands():
     Helper function to print the list of commands and how to use them
     """
     print(f"Use 'get <file_id> [destination]' to download files\n" + 
-          "Use 'push <filepath>' to upload files\n" + 
+          "Use 'push <filepath>' to upload files, or 'push <directory>' to upload every file in a directory\n" + 
           "Use 'list' to view available files. Can also use 'list local', 'list remote', or 'list both' to show known files.\n" +
           "Use 'peers' to view connected peers\n" + 
           "User 'ls' to list the contents of your current directory\n" +
@@ -984,6 +3599,8 @@ def p2p_server(peer_id, host, port, http_port):
     Start the p2p server on the host and port with peer_id
     """
     server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # pooled connections are closed on our side when we exit, don't let TIME_WAIT block a restart
+    server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_sock.bind((host, port))
     server_sock.listen()
     server_sock.settimeout(1) # seconds
@@ -994,6 +3611,8 @@ def p2p_server(peer_id, host, port, http_port):
     while True:
         try:
             client_socket, addr = server_sock.accept()
+            # replies are often a small header then data, don't let Nagle hold the data back
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             threading.Thread(target=handle_client, args=(client_socket, addr, peer_id, host, port), daemon=True).start()
         except socket.timeout:
             continue # no connection, so we check again
@@ -1017,6 +3636,7 @@ def webserver(host, http_port, my_peer_id):
     Starts a webserver at host and http_port
     """
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.bind((host, http_port))
     server_socket.listen()
     print(f"Web server running at http://{host}:{http_port}")
@@ -1028,132 +3648,996 @@ def webserver(host, http_port, my_peer_id):
 
 def handle_http_client(client_socket, my_peer_id):
     """
-    Parses HTTP requests then serves files to the client socket
+    Parses HTTP requests then serves files to the client socket.
+    Keeps serving requests on the connection while the client keeps it alive, until it has
+    been idle for HTTP_KEEPALIVE_TIMEOUT seconds.
     """
+    client_socket.settimeout(HTTP_KEEPALIVE_TIMEOUT)
+    buffer = b""
     try:
-        request = client_socket.recv(1024).decode()
-        if not request:
-            client_socket.close()
-            return
-        
-        # Parse request
-        lines = request.splitlines()
-        if len(lines) == 0:
-            client_socket.close()
-            return
-        
-        request_line = lines[0]
-        tokens = request_line.split()
-        if len(tokens) < 2:
-            client_socket.close()
-            return
-        
-        method, path = tokens[0], tokens[1]
-        if method != 'GET':
-            client_socket.close()
-            return
-        
-        if path == '/' or path == 'index.html':
-            serve_file(client_socket, 'index.html', 'text/html')
-        elif path == '/stats.js':
-            serve_file(client_socket, 'stats.js', 'application/javascript')
-        elif path == '/style.css':
-            serve_file(client_socket, 'style.css', 'text/css')
-        elif path == '/stats.json':
-            serve_stats(client_socket, my_peer_id)
-        else:
-            send_404(client_socket)
+        while True:
+            request, buffer = read_http_request(client_socket, buffer)
+            if request is None:
+                break
+            events_query = http_wants_events(request)
+            if events_query is not None:
+                client_socket.settimeout(None)
+                serve_events(client_socket, my_peer_id, events_query)
+                break
+            response, keep_alive = http_response(request, my_peer_id)
+            if response is None:
+                break
+            client_socket.sendall(response)
+            if not keep_alive:
+                break
+    except socket.timeout:
+        pass # idle connection, the client can open a new one
     except Exception as e:
         print(f"HTTP error: {e}")
     finally:
         client_socket.close()
 # end handle_http_client()
 
-def serve_file(client_socket, file_name, content_type):
+def read_http_request(client_socket, buffer):
     """
-    Serves a file_name to the client_socket
+    Reads one HTTP request head from client_socket. buffer holds bytes already read past the
+    previous request. Returns the request and the bytes read past it, or None for the request
+    if the client closed the connection or sent too much.
     """
-    try:
-        with open(file_name, 'rb') as f:
-            content = f.read()
-        header = (
-            f"HTTP/1.1 200 OK\r\n"
-            f"Content-Type: {content_type}\r\n"
-            f"Content-Length: {len(content)}\r\n"
-            f"Connection: close\r\n"
-            f"\r\n"
-        )
-        client_socket.sendall(header.encode() + content)
-    except FileNotFoundError:
-        send_404(client_socket)
-# end serve_file
-
-def serve_stats(client_socket, my_peer_id):
-    """
-    Serves the peer and file statistics as a formatted json to the client_socket
-    """
-    metadata = load_metadata()
-
-    # Format peers list from tracked_peers
-    peers = []
-    for peer_id, peer_info in tracked_peers.items():
-        peers.append({
-            "peerId": peer_id,
-            "host": peer_info.get("host", ""),
-            "port": peer_info.get("port", ""),
-            "last_seen": peer_info.get("last_seen", 0)
-        })
-
-    # Format files from metadata
-    files = []
-    for file_id, file_info in metadata.items():
-        files.append({
+    while b"\r\n\r\n" not in buffer:
+        if len(buffer) > HTTP_MAX_REQUEST_SIZE:
+            return None, b""
+        data = client_socket.recv(4096)
+        if not data:
+            return None, b""
+        buffer += data
+    head, _, rest = buffer.partition(b"\r\n\r\n")
+    return head.decode(), rest
+# end read_http_request()
+
+def http_parse_request(request):
+    """
+    Parses an HTTP GET request. Returns its path, query (a dictionary of lists), headers
+    (with lowercase names) and HTTP version, or None if the request is bad.
+    """
+    if not request:
+        return None
+
+    # Parse request
+    lines = request.splitlines()
+    if len(lines) == 0:
+        return None
+
+    request_line = lines[0]
+    tokens = request_line.split()
+    if len(tokens) < 2:
+        return None
+
+    method, path = tokens[0], tokens[1]
+    version = tokens[2] if len(tokens) > 2 else 'HTTP/1.0'
+    if method != 'GET':
+        return None
+
+    path, _, query = path.partition('?')
+    query = urllib.parse.parse_qs(query)
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return path, query, headers, version
+# end http_parse_request()
+
+def http_wants_events(request):
+    """
+    Returns the query of request if it is for the /events stream, which is served by serve_events(),
+    otherwise None
+    """
+    parsed = http_parse_request(request)
+    if parsed is None or parsed[0] != '/events':
+        return None
+    return parsed[1]
+# end http_wants_events()
+
+def http_response(request, my_peer_id):
+    """
+    Parses an HTTP request and returns the full response to send, as bytes, and whether to
+    keep the connection open for another request.
+    Returns None for the response if the request is bad and the connection should just be closed.
+
+    Used by both the threaded and the asyncio webserver.
+    """
+    parsed = http_parse_request(request)
+    if parsed is None:
+        return None, False
+    path, query, headers, version = parsed
+
+    if path == '/' or path == 'index.html':
+        status, response_headers, body = http_build_file('index.html', headers)
+    elif path == '/stats.js':
+        status, response_headers, body = http_build_file('stats.js', headers)
+    elif path == '/style.css':
+        status, response_headers, body = http_build_file('style.css', headers)
+    elif path == '/stats.json':
+        status, response_headers, body = http_build_stats(my_peer_id, query, headers)
+    elif path == '/metrics':
+        status, response_headers, body = http_build_metrics(headers)
+    else:
+        status, response_headers, body = http_build_404()
+
+    # HTTP/1.1 connections stay open unless the client says otherwise, HTTP/1.0 ones only if it asks
+    connection = headers.get('connection', '').lower()
+    keep_alive = connection == 'keep-alive' or (version == 'HTTP/1.1' and connection != 'close')
+    return http_build_response(status, response_headers, body, keep_alive), keep_alive
+# end http_response()
+
+def http_build_response(status, headers, body, keep_alive):
+    """
+    Builds the full response from its status, a dictionary of headers and the body
+    """
+    lines = [f"HTTP/1.1 {status}"]
+    lines.extend(f"{name}: {value}" for name, value in headers.items())
+    if not status.startswith("304"):
+        lines.append(f"Content-Length: {len(body)}")
+    lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode() + body
+# end http_build_response
+
+def http_accepts_gzip(headers):
+    """Returns True if the request headers say the client takes gzip-encoded responses"""
+    for coding in headers.get('accept-encoding', '').split(','):
+        name, _, params = coding.strip().partition(';')
+        if name.strip().lower() in ('gzip', '*'):
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+# end http_accepts_gzip()
+
+def http_etag_matches(headers, etags):
+    """Returns True if the If-None-Match header of the request names one of etags. W/ (weak) prefixes are ignored, as If-None-Match does"""
+    wanted = [tag.strip().removeprefix('W/') for tag in headers.get('if-none-match', '').split(',')]
+    return '*' in wanted or any(etag.removeprefix('W/') in wanted for etag in etags)
+# end http_etag_matches()
+
+class StaticAssets:
+    """
+    The files of the stats page (STATIC_FILES), read once and kept in memory with a gzipped copy.
+
+    Each copy has a strong ETag from the file's SHA-256, so a browser that has it is answered
+    with a bodyless 304. The files are read when the webserver starts, or on the first request.
+    """
+    def __init__(self):
+        self.assets = {} # key: file name, value: dict with content_type, body, etag, gzip_body, gzip_etag
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Read every static file into memory"""
+        with self.lock:
+            for file_name, content_type in STATIC_FILES.items():
+                try:
+                    with open(file_name, 'rb') as f:
+                        body = f.read()
+                except OSError as e:
+                    debug(f"Could not load {file_name}: {e}")
+                    continue
+                etag = hashlib.sha256(body).hexdigest()[:32]
+                self.assets[file_name] = {
+                    "content_type": content_type,
+                    "body": body,
+                    "etag": f'"{etag}"',
+                    "gzip_body": gzip.compress(body, compresslevel=HTTP_GZIP_LEVEL, mtime=0),
+                    "gzip_etag": f'"{etag}-gzip"',
+                }
+            self.loaded = True
+
+    def get(self, file_name):
+        """Returns the cached asset for file_name, or None if there is no such file"""
+        if not self.loaded:
+            self.load()
+        return self.assets.get(file_name)
+# end StaticAssets
+
+static_assets = StaticAssets()
+
+def http_build_file(file_name, headers):
+    """
+    Builds the response serving file_name from memory, gzipped if the client takes it,
+    or 304 Not Modified if the client already has it. Returns its status, headers and body
+    """
+    asset = static_assets.get(file_name)
+    if asset is None:
+        return http_build_404()
+
+    response_headers = {"Content-Type": asset["content_type"], "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if http_accepts_gzip(headers):
+        body, etag = asset["gzip_body"], asset["gzip_etag"]
+        response_headers["Content-Encoding"] = "gzip"
+    else:
+        body, etag = asset["body"], asset["etag"]
+    response_headers["ETag"] = etag
+
+    if http_etag_matches(headers, (asset["etag"], asset["gzip_etag"])):
+        return "304 Not Modified", {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}, b""
+    return "200 OK", response_headers, body
+# end http_build_file
+
+class StatsCache:
+    """
+    The /stats.json document, rebuilt only when the metadata or the tracked peers change,
+    instead of on every poll from a dashboard. Only the rows of the files the metadata store
+    logged as changed are rebuilt.
+
+    The document has a version, "<epoch>.<n>", that is also its ETag. Peers joining and leaving
+    are a new version, a peer being seen again is not: peers gossip every GOSSIP_INTERVAL, and
+    that would make every poll a new version. The peers and their last_seen are added to the
+    encoded files as they are when the document is served. The changelog keeps the
+    version of the last change to each file, for at most changelog_size files, so a client that
+    has version v can be sent only the files changed since v. The epoch is new each time we start.
+
+    Queries for one page of the files use indexes built on first use after each change: the
+    files sorted by each of STATS_SORT_KEYS (the name one also finds name prefixes), the files
+    of each owner, and our local files.
+    """
+    def __init__(self, changelog_size=STATS_CHANGELOG_SIZE):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.store_version = None # metadata_store.version the files are from
+        self.members_version = None # tracked_peers.members_version of the current version
+        self.files = {} # key: file_id, value: its row in the document
+        self.changelog = collections.OrderedDict() # key: file_id, value: version of its last change
+        self.changelog_size = changelog_size
+        self.forgotten = 0 # newest version dropped from the changelog. Deltas must start at or after it
+        self.files_body = None # the rows of all the files, encoded
+        self.gzipped = (None, None) # the last body compressed, and its gzipped copy
+        self.indexes = {} # key: index name, value: the index, for the current files
+        self.lock = threading.Lock()
+
+    def refresh(self, my_peer_id):
+        """
+        Rebuild the parts that changed since the last request. Only the rows of the files the
+        metadata store logged as changed are rebuilt. Called with self.lock held
+        """
+        members_version = tracked_peers.members_version
+        if members_version != self.members_version:
+            self.members_version = members_version
+            self.version += 1
+
+        with METADATA_LOCK:
+            store_version = metadata_store.version
+            if store_version == self.store_version:
+                return
+            file_ids = metadata_store.changed_since(self.store_version)
+            self.store_version = store_version
+            if file_ids is None:
+                # too far behind, rebuild every row
+                files = {file_id: self.row(file_id, my_peer_id) for file_id in metadata_store.entries}
+                changed = [file_id for file_id, row in files.items() if self.files.get(file_id) != row]
+                changed.extend(file_id for file_id in self.files if file_id not in files)
+                self.files = files
+            else:
+                changed = []
+                for file_id in file_ids:
+                    row = self.row(file_id, my_peer_id) if file_id in metadata_store.entries else None
+                    if row == self.files.get(file_id):
+                        continue # e.g. a holder added and removed again
+                    if row is None:
+                        del self.files[file_id]
+                    else:
+                        self.files[file_id] = row
+                    changed.append(file_id)
+        if not changed:
+            return
+
+        self.version += 1
+        self.files_body = None
+        self.indexes = {}
+        for file_id in changed:
+            self.changelog[file_id] = self.version
+            self.changelog.move_to_end(file_id)
+        while len(self.changelog) > self.changelog_size:
+            _, version = self.changelog.popitem(last=False)
+            self.forgotten = version
+
+    def row(self, file_id, my_peer_id):
+        """Build the row of file_id in the document. Called with METADATA_LOCK held"""
+        file_info = metadata_store.entries[file_id]
+        holders = list(metadata_store.holders.get(file_id, ()))
+        return {
             "file_name": file_info.get("file_name", ""),
             "file_size": file_info.get("file_size", 0),
             "file_id": file_id,
             "file_owner": file_info.get("file_owner", ""),
             "file_timestamp": file_info.get("file_timestamp", 0),
-            "has_copy": my_peer_id in file_info.get("peers_with_file"),
-            "peers_with_file": file_info.get("peers_with_file", []),
-        })
-
-    stats_data = {
-        "peerId": my_peer_id,
-        "peers": peers,
-        "files": files,
-    }
+            "has_copy": my_peer_id in holders,
+            "peers_with_file": holders,
+        }
+
+    def current_version(self, my_peer_id):
+        """Return the current version, without encoding anything"""
+        with self.lock:
+            self.refresh(my_peer_id)
+            return f"{self.epoch}.{self.version}"
+
+    def peers(self):
+        """Return the rows of the tracked peers, with their last_seen as of now"""
+        return [
+            {
+                "peerId": peer_id,
+                "host": peer_info.get("host", ""),
+                "port": peer_info.get("port", ""),
+                "last_seen": peer_info.get("last_seen", 0)
+            }
+            for peer_id, peer_info in tracked_peers.items()
+        ]
+
+    def changes(self, since):
+        """
+        Return the rows of the files changed since version number since, and the file_ids removed
+        since then. None if the changelog no longer covers since. Called with self.lock held
+        """
+        if not self.forgotten <= since <= self.version:
+            return None
+        changed = []
+        for file_id in reversed(self.changelog):
+            if self.changelog[file_id] <= since:
+                break
+            changed.append(file_id)
+        files = [self.files[file_id] for file_id in changed if file_id in self.files]
+        removed = [file_id for file_id in changed if file_id not in self.files]
+        return files, removed
+
+    def document(self, my_peer_id, since=None):
+        """
+        Return the current version and the encoded document. When since is a version the
+        changelog still covers, the document only has the files changed since then.
+        """
+        with self.lock:
+            self.refresh(my_peer_id)
+            version = f"{self.epoch}.{self.version}"
+
+            epoch, _, number = (since or "").partition(".")
+            changes = self.changes(int(number)) if epoch == self.epoch and number.isdigit() else None
+            if changes is not None:
+                files, removed = changes
+                return version, json.dumps({
+                    "peerId": my_peer_id,
+                    "version": version,
+                    "since": since,
+                    "delta": True,
+                    "peers": self.peers(),
+                    "files": files,
+                    "removed": removed,
+                    "gossip_id_cache": seen_gossip_ids.stats(),
+                }).encode()
+
+            if self.files_body is None:
+                self.files_body = json.dumps(list(self.files.values())).encode()
+            head = json.dumps({
+                "peerId": my_peer_id,
+                "version": version,
+                "peers": self.peers(),
+                "gossip_id_cache": seen_gossip_ids.stats(),
+            }).encode()
+            return version, head[:-1] + b', "files": ' + self.files_body + b"}"
+
+    def sort_value(self, sort, row):
+        """Return the value of row the files are sorted by. Names sort as strings, the rest as numbers"""
+        value = row.get(STATS_SORT_KEYS[sort])
+        if sort == "name":
+            return str(value)
+        if sort == "replicas":
+            return len(value or ())
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return 0.0
+
+    def index(self, name):
+        """Return the index called name, building it if the files changed since it was last used. Called with self.lock held"""
+        if name not in self.indexes:
+            if name in STATS_SORT_KEYS:
+                self.indexes[name] = sorted((self.sort_value(name, row), file_id) for file_id, row in self.files.items())
+            elif name == "owner":
+                owners = {}
+                for file_id, row in self.files.items():
+                    owners.setdefault(row["file_owner"], set()).add(file_id)
+                self.indexes[name] = owners
+            elif name == "local":
+                self.indexes[name] = inventory.local_file_ids() & self.files.keys()
+        return self.indexes[name]
+
+    def query(self, my_peer_id, query):
+        """
+        Return the current version and the encoded document with one page of the files matching query,
+        a dictionary of lists like urllib.parse.parse_qs() returns:
+            limit: files in the page, at most STATS_MAX_PAGE_SIZE (default STATS_PAGE_SIZE)
+            cursor: the next_cursor of the previous page
+            location: local, remote or both (default), like the list command
+            owner: only the files of this owner
+            prefix: only the files whose name starts with this
+            sort: one of STATS_SORT_KEYS (default name), order: asc (default) or desc
+        Values that don't make sense are ignored.
+        """
+        def param(name, default=""):
+            return (query.get(name) or [default])[0]
+
+        try:
+            limit = min(max(int(param("limit", STATS_PAGE_SIZE)), 0), STATS_MAX_PAGE_SIZE)
+        except ValueError:
+            limit = STATS_PAGE_SIZE
+        sort = param("sort", "name") if param("sort", "name") in STATS_SORT_KEYS else "name"
+        descending = param("order") == "desc"
+        location = param("location", "both")
+        owner = param("owner")
+        prefix = param("prefix")
+
+        with self.lock:
+            self.refresh(my_peer_id)
+            version = f"{self.epoch}.{self.version}"
+
+            # the files each filter allows, smallest first
+            allowed = []
+            if owner:
+                allowed.append(self.index("owner").get(owner, set()))
+            if prefix:
+                names = self.index("name")
+                start = bisect.bisect_left(names, (prefix,))
+                end = bisect.bisect_left(names, (prefix + "\U0010ffff",))
+                allowed.append({file_id for _, file_id in names[start:end]})
+            if location == "local":
+                allowed.append(self.index("local"))
+            allowed.sort(key=len)
+            candidates = set(allowed[0]).intersection(*allowed[1:]) if allowed else None
+            excluded = self.index("local") if location == "remote" else None
+            if candidates is not None and excluded is not None:
+                candidates -= excluded
+
+            if candidates is None:
+                total = len(self.files) - (len(excluded) if excluded is not None else 0)
+            else:
+                total = len(candidates)
+
+            # few matches are sorted on their own, many are picked out of the sorted index
+            ordered = self.index(sort)
+            if candidates is not None and len(candidates) * 4 < len(ordered):
+                ordered = sorted((self.sort_value(sort, self.files[file_id]), file_id) for file_id in candidates)
+                candidates = None
+
+            position = 0
+            cursor = stats_decode_cursor(param("cursor"))
+            if cursor is not None and isinstance(cursor[0], str) != (sort == "name"):
+                cursor = None # from a page sorted by something else
+            if cursor is not None:
+                position = bisect.bisect_right(ordered, cursor) if not descending else len(ordered) - bisect.bisect_left(ordered, cursor)
+            walk = reversed(ordered) if descending else iter(ordered)
+            page = []
+            last = cursor
+            next_cursor = None
+            for key in itertools.islice(walk, position, None):
+                file_id = key[1]
+                if candidates is not None and file_id not in candidates:
+                    continue
+                if excluded is not None and file_id in excluded:
+                    continue
+                if len(page) == limit:
+                    next_cursor = stats_encode_cursor(last) if last is not None else None
+                    break
+                page.append(self.files[file_id])
+                last = key
+
+            return version, json.dumps({
+                "peerId": my_peer_id,
+                "version": version,
+                "peers": self.peers(),
+                "files": page,
+                "total": total,
+                "next_cursor": next_cursor,
+                "gossip_id_cache": seen_gossip_ids.stats(),
+            }).encode()
+
+    def compress(self, body):
+        """Return body gzipped. Sending the same body again, e.g. the full document to several viewers, reuses the last compression"""
+        with self.lock:
+            if self.gzipped[0] == body:
+                return self.gzipped[1]
+        compressed = gzip.compress(body, compresslevel=HTTP_GZIP_LEVEL)
+        with self.lock:
+            self.gzipped = (body, compressed)
+        return compressed
+# end StatsCache
+
+stats_cache = StatsCache()
+
+def stats_encode_cursor(key):
+    """Encode the (sort value, file_id) of the last file of a page as the cursor of the next page"""
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode()
+# end stats_encode_cursor()
+
+def stats_decode_cursor(cursor):
+    """Decode a cursor made by stats_encode_cursor(). Returns None if it is empty or bad"""
+    if not cursor:
+        return None
+    try:
+        value, file_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(file_id, str) or not isinstance(value, (str, int, float)):
+        return None
+    return (value, file_id)
+# end stats_decode_cursor()
+
+def stats_is_query(query):
+    """Returns True if the /stats.json query asks for a page of the files, see StatsCache.query()"""
+    return any(name in query for name in STATS_QUERY_PARAMS)
+# end stats_is_query()
+
+class EventBus:
+    """
+    Pushes changes to the peers and files to the /events subscribers (Server-Sent Events) as
+    they happen, so the stats page doesn't have to poll.
+
+    While anyone is subscribed, a pump thread checks the stats cache every EVENTS_CHECK_INTERVAL
+    seconds, and turns what changed into peer-joined, peer-updated, peer-expired, file-added,
+    file-updated and file-removed events. Each event is built once, however many viewers there are.
+
+    Events carry the whole row, so applying them over a snapshot taken after subscribing gives the
+    current state. A subscriber whose queue is full is dropped; its EventSource reconnects and gets
+    a new snapshot.
+    """
+    def __init__(self):
+        self.subscribers = {} # key: subscription id, value: function that queues an encoded event, returns False when full
+        self.next_id = 0
+        self.version = None # stats_cache version the published events are up to. None while nobody is subscribed
+        self.peers_version = None # tracked_peers.version the published peer events are up to
+        self.peers = {} # key: peerId, value: the row last published
+        self.files = set() # file_ids last published
+        self.my_peer_id = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self, my_peer_id):
+        """Start the pump thread"""
+        if self.thread is None:
+            self.my_peer_id = my_peer_id
+            self.thread = threading.Thread(target=self.pump, daemon=True)
+            self.thread.start()
+
+    def subscribe(self, offer):
+        """Add a subscriber. offer(event) queues an encoded event. Returns the subscription id"""
+        with stats_cache.lock, self.lock:
+            if self.version is None:
+                # publish changes from here on
+                stats_cache.refresh(self.my_peer_id)
+                self.version = stats_cache.version
+                self.peers_version = tracked_peers.version
+                self.peers = {peer["peerId"]: peer for peer in stats_cache.peers()}
+                self.files = set(stats_cache.files)
+            self.next_id += 1
+            self.subscribers[self.next_id] = offer
+            return self.next_id
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.pop(subscription, None)
+            if not self.subscribers:
+                self.version = None
+
+    def subscribed(self, subscription):
+        """Return False once the subscription was dropped"""
+        return subscription in self.subscribers
+
+    def publish(self, event, data):
+        """Send an event to every subscriber. Called with self.lock held"""
+        encoded = f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+        for subscription, offer in list(self.subscribers.items()):
+            if not offer(encoded):
+                debug(f"Dropping /events subscriber {subscription}, it fell behind")
+                del self.subscribers[subscription]
+
+    def pump(self):
+        while True:
+            time.sleep(EVENTS_CHECK_INTERVAL)
+            if self.subscribers:
+                self.check()
+
+    def check(self):
+        """Publish what changed since the last check"""
+        with stats_cache.lock, self.lock:
+            if self.version is None:
+                return
+            stats_cache.refresh(self.my_peer_id)
+            # the stats version doesn't count peers being seen again, but viewers still get them
+            peers_version = tracked_peers.version
+            if stats_cache.version == self.version and peers_version == self.peers_version:
+                return
+
+            changes = stats_cache.changes(self.version)
+            if changes is None:
+                # too much changed to tell what, send every file again
+                files = list(stats_cache.files.values())
+                removed = [file_id for file_id in self.files if file_id not in stats_cache.files]
+            else:
+                files, removed = changes
+            self.version = stats_cache.version
+
+            if peers_version != self.peers_version:
+                self.peers_version = peers_version
+                peers = {peer["peerId"]: peer for peer in stats_cache.peers()}
+                for peer_id, peer in peers.items():
+                    if peer_id not in self.peers:
+                        self.publish("peer-joined", peer)
+                    elif peer != self.peers[peer_id]:
+                        self.publish("peer-updated", peer)
+                for peer_id in self.peers:
+                    if peer_id not in peers:
+                        self.publish("peer-expired", {"peerId": peer_id})
+                self.peers = peers
+
+            for row in files:
+                self.publish("file-updated" if row["file_id"] in self.files else "file-added", row)
+                self.files.add(row["file_id"])
+            for file_id in removed:
+                if file_id in self.files:
+                    self.publish("file-removed", {"file_id": file_id})
+                    self.files.discard(file_id)
+# end EventBus
+
+event_bus = EventBus()
+
+def http_build_stats(my_peer_id, query=None, headers=None):
+    """
+    Builds the response serving the peer and file statistics as a formatted json.
+    Returns its status, headers and body.
+
+    Answers 304 Not Modified when the client's If-None-Match is the current version, and only
+    the changes when the query has since=<version>. With any of the STATS_QUERY_PARAMS, serves
+    one page of the files instead, see StatsCache.query(). Gzipped if the client takes it.
+    """
+    headers = headers or {}
+    query = query or {}
+
+    # a client that has the current version gets a 304 before anything is encoded or compressed
+    version = stats_cache.current_version(my_peer_id)
+    for etag in (f'W/"{version}"', f'W/"{version}-gzip"'): # weak, since the peers' last_seen can change without a new version
+        if http_etag_matches(headers, (etag,)):
+            return "304 Not Modified", {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}, b""
+
+    if stats_is_query(query):
+        version, body = stats_cache.query(my_peer_id, query)
+    else:
+        version, body = stats_cache.document(my_peer_id, query.get("since", [None])[0])
+
+    response_headers = {"Content-Type": "application/json", "Cache-Control": "no-cache", "Vary": "Accept-Encoding", "ETag": f'W/"{version}"'}
+    if http_accepts_gzip(headers) and len(body) >= HTTP_GZIP_MIN_SIZE:
+        body = stats_cache.compress(body)
+        response_headers["Content-Encoding"] = "gzip"
+        response_headers["ETag"] = f'W/"{version}-gzip"'
+    return "200 OK", response_headers, body
+# end http_build_stats
 
-    body = json.dumps(stats_data).encode()
+def http_build_events_start(my_peer_id, query=None):
+    """
+    Builds the start of an /events stream: the headers, then a snapshot event with the whole stats
+    document, or the page of it the query asks for, like /stats.json
+    """
+    if query and stats_is_query(query):
+        _, body = stats_cache.query(my_peer_id, query)
+    else:
+        _, body = stats_cache.document(my_peer_id)
     header = (
         f"HTTP/1.1 200 OK\r\n"
-        f"Content-Type: application/json\r\n"
-        f"Content-Length: {len(body)}\r\n"
+        f"Content-Type: text/event-stream\r\n"
+        f"Cache-Control: no-cache\r\n"
         f"Connection: close\r\n"
         f"\r\n"
     )
-    client_socket.sendall(header.encode() + body)
-# end serve_stats
+    return header.encode() + b"retry: 3000\n\nevent: snapshot\ndata: " + body + b"\n\n"
+# end http_build_events_start
 
-def send_404(client_socket):
+def serve_events(client_socket, my_peer_id, query=None):
     """
-    Sends a 404 error to the client socket
+    Streams the /events Server-Sent Events to the client socket until the client goes away
+    or falls too far behind
     """
-    body = b"404 Not Found"
-    header = (
-        f"HTTP/1.1 404 Not Found\r\n"
-        f"Content-Type: text/plain\r\n"
-        f"Content-Length: {len(body)}\r\n"
-        f"Connection: close\r\n"
-        f"\r\n"
-    )
-    client_socket.sendall(header.encode() + body)
-# end send_404
+    events = queue.Queue(EVENTS_QUEUE_LIMIT)
+
+    def offer(event):
+        try:
+            events.put_nowait(event)
+            return True
+        except queue.Full:
+            return False
+
+    subscription = event_bus.subscribe(offer)
+    try:
+        client_socket.sendall(http_build_events_start(my_peer_id, query))
+        while True:
+            try:
+                event = events.get(timeout=EVENTS_KEEPALIVE)
+            except queue.Empty:
+                if not event_bus.subscribed(subscription):
+                    break
+                event = b": keepalive\n\n"
+            client_socket.sendall(event)
+    except OSError:
+        pass # the client went away
+    finally:
+        event_bus.unsubscribe(subscription)
+# end serve_events()
+
+def http_build_metrics(headers):
+    """
+    Builds the response serving the metrics in the Prometheus text format, as its status, headers and body.
+    Gzipped if the client takes it
+    """
+    body = metrics.render().encode()
+    response_headers = {"Content-Type": "text/plain; version=0.0.4; charset=utf-8", "Cache-Control": "no-cache"}
+    if http_accepts_gzip(headers) and len(body) >= HTTP_GZIP_MIN_SIZE:
+        body = gzip.compress(body, compresslevel=HTTP_GZIP_LEVEL)
+        response_headers["Content-Encoding"] = "gzip"
+    return "200 OK", response_headers, body
+# end http_build_metrics
+
+def http_build_404():
+    """
+    Builds a 404 error response, as its status, headers and body
+    """
+    return "404 Not Found", {"Content-Type": "text/plain"}, b"404 Not Found"
+# end http_build_404
 #------------------------------#
 # end of Webserver Management  #
 #------------------------------#
 
 
 
+#-----------------------------#
+#---# Asyncio Server Mode #---#
+#                             #
+# code for serving P2P and    #
+# HTTP from one asyncio       #
+# event loop (--async)        #
+#-----------------------------#
+class AsyncMessageReader(MessageReader):
+    """
+    Reads messages from an asyncio StreamReader, in the same formats as MessageReader.
+
+    The parsing is shared with MessageReader, only receiving differs. Every receive gives up
+    with an asyncio.TimeoutError if nothing arrives for timeout seconds.
+    """
+    def __init__(self, stream, timeout=SERVER_IDLE_TIMEOUT):
+        self.stream = stream
+        self.timeout = timeout
+        self.buffer = bytearray()
+        self.reset_scanner()
+
+    async def receive(self, size):
+        """Receive up to size bytes from the stream"""
+        return await asyncio.wait_for(self.stream.read(size), self.timeout)
+
+    async def fill(self):
+        """Receive more bytes into the buffer. Returns False if the connection closed"""
+        data = await self.receive(self.RECV_SIZE)
+        debug(f"receive_message: read returned {len(data)} bytes")
+        if not data:
+            return False
+        metrics.bytes_received.inc(len(data))
+        self.buffer += data
+        return True
+
+    async def recv_into(self, view):
+        """Receive raw bytes into view. Returns how many were received, 0 if the connection closed"""
+        block = await self.receive(min(self.RECV_SIZE, len(view)))
+        view[:len(block)] = block
+        metrics.bytes_received.inc(len(block))
+        return len(block)
+
+    async def run(self, parser):
+        """Run the parse_*() generator parser, receiving the bytes it asks for. Returns what it parsed"""
+        try:
+            request = next(parser)
+            while True:
+                request = parser.send(await (self.fill() if request is None else self.recv_into(request)))
+        except StopIteration as done:
+            return done.value
+
+    async def read_message(self):
+        """Receive in a message like MessageReader.read_message()"""
+        return await self.run(self.parse_message())
+# end AsyncMessageReader
+
+async def receive_message_async(reader):
+    """
+    Receive in a valid-formatted JSON message from the AsyncMessageReader reader, like receive_message()
+    """
+    return await reader.read_message()
+# end receive_message_async()
+
+async def handle_client_async(stream_reader, writer, peer_id, host, port):
+    """
+    Handles receiving messages from a client on the event loop, like handle_client()
+
+    GET_FILE replies are written from the event loop. Every other message is passed to
+    handle_message() on the message_pool, since the handlers block on disk and on other peers.
+    Messages from one connection are still handled one at a time, in order.
+    """
+    loop = asyncio.get_running_loop()
+    addr = writer.get_extra_info("peername")
+    debug(f"Accepted connection from {addr}")
+    reader = AsyncMessageReader(stream_reader)
+    try:
+        while True: # loop in case of multiple messages
+            msg = await receive_message_async(reader)
+            if not msg:
+                debug(f"Connection close by peer at {addr}")
+                break
+            if msg.get("peerId") == peer_id:
+                debug(f"Received connection my myself. Ignoring.")
+                continue # ignore because it's my own message
+            debug(f"Received from {addr}: {describe_message(msg)}")
+            metrics.received.inc(label_value=metrics.message_type(msg.get("type")))
+            if msg.get("type") == "GET_FILE":
+                debug("Handling GET")
+                start = time.perf_counter()
+                try:
+                    await receive_msg_get_async(msg, writer)
+                finally:
+                    metrics.handled("GET_FILE", time.perf_counter() - start)
+                continue
+            if msg.get("type") in UNSHED_MESSAGE_TYPES:
+                # submit() may wait for room in the queue, so don't wait on the event loop
+                future = await loop.run_in_executor(None, message_pool.submit, msg.get("type"), handle_message, msg, peer_id, host, port, None)
+            else:
+                future = message_pool.submit(msg.get("type"), handle_message, msg, peer_id, host, port, None)
+            if future is None:
+                shed_message(msg, addr) # only GET_FILE gets a reply when shed
+                continue
+            await asyncio.wrap_future(future)
+    except asyncio.TimeoutError:
+        debug(f"Closing idle connection from {addr}")
+    except Exception as e:
+        print(f"Exception while communicating with {addr}: {e}")
+    finally:
+        writer.close()
+        debug(f"Connection closed from {addr}")
+# end handle_client_async()
+
+async def receive_msg_get_async(msg, writer):
+    """
+    Handles a GET message on the event loop, like receive_msg_get()
+
+    Opening and hashing the file happen on the message_pool, and hex-encoding it on the executor.
+    File ranges are sent with loop.sendfile, which uses os.sendfile on the event loop's socket where it can.
+    """
+    loop = asyncio.get_running_loop()
+    future = message_pool.submit("GET_FILE", build_get_reply, msg)
+    if future is None:
+        reply = shed_message(msg, writer.get_extra_info("peername"))
+        writer.write(reply)
+        await writer.drain()
+        metrics.bytes_sent.inc(len(reply))
+        return
+    f, parts = await asyncio.wrap_future(future)
+    try:
+        while True:
+            part = await loop.run_in_executor(None, next, parts, None)
+            if part is None:
+                break
+            if isinstance(part, tuple):
+                offset, count = part
+                if count == 0:
+                    continue # loop.sendfile() refuses a count of 0, and an empty file or chunk has nothing to send
+                sent = await loop.sendfile(writer.transport, f, offset, count)
+                metrics.bytes_sent.inc(sent)
+                if sent != count:
+                    # the peer is waiting for count bytes, so give up on the connection
+                    raise ConnectionError(f"Only sent {sent} of {count} bytes of {f.name}")
+            else:
+                writer.write(part)
+                await writer.drain()
+                metrics.bytes_sent.inc(len(part))
+    finally:
+        if f is not None:
+            f.close()
+    debug(f"FILE_DATA sent to {writer.get_extra_info('peername')}")
+# end receive_msg_get_async()
+
+async def handle_http_client_async(stream_reader, writer, my_peer_id):
+    """
+    Parses HTTP requests then serves files to the client, like handle_http_client(),
+    including keeping the connection alive between requests.
+    The response is built on the executor, since it locks the metadata.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                head = await asyncio.wait_for(stream_reader.readuntil(b"\r\n\r\n"), HTTP_KEEPALIVE_TIMEOUT)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                break # closed, too big, or idle
+            request = head[:-4].decode()
+            events_query = http_wants_events(request)
+            if events_query is not None:
+                await serve_events_async(writer, my_peer_id, events_query)
+                break
+            response, keep_alive = await loop.run_in_executor(None, http_response, request, my_peer_id)
+            if response is None:
+                break
+            writer.write(response)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except Exception as e:
+        print(f"HTTP error: {e}")
+    finally:
+        writer.close()
+# end handle_http_client_async()
+
+async def serve_events_async(writer, my_peer_id, query=None):
+    """
+    Streams the /events Server-Sent Events to the client, like serve_events(). The event bus
+    runs on its own thread, so events are handed to the event loop thread-safely.
+    """
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def offer(event):
+        if events.qsize() >= EVENTS_QUEUE_LIMIT:
+            return False
+        loop.call_soon_threadsafe(events.put_nowait, event)
+        return True
+
+    subscription = await loop.run_in_executor(None, event_bus.subscribe, offer)
+    try:
+        writer.write(await loop.run_in_executor(None, http_build_events_start, my_peer_id, query))
+        await writer.drain()
+        while event_bus.subscribed(subscription) or not events.empty():
+            try:
+                event = await asyncio.wait_for(events.get(), EVENTS_KEEPALIVE)
+            except asyncio.TimeoutError:
+                event = b": keepalive\n\n"
+            writer.write(event)
+            await writer.drain()
+    except OSError:
+        pass # the client went away
+    finally:
+        event_bus.unsubscribe(subscription)
+# end serve_events_async()
+
+async def async_servers(peer_id, host, port, http_port):
+    """
+    Start the p2p server and the webserver on one event loop, and serve until the program exits
+    """
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=ASYNC_EXECUTOR_WORKERS))
+
+    p2p = await asyncio.start_server(
+        lambda stream_reader, writer: handle_client_async(stream_reader, writer, peer_id, host, port), host, port)
+    http = await asyncio.start_server(
+        lambda stream_reader, writer: handle_http_client_async(stream_reader, writer, peer_id), host, http_port,
+        limit=HTTP_MAX_REQUEST_SIZE)
+
+    print(f"Peer {peer_id} running on {host}:{port}, HTTP on {http_port} (asyncio)")
+    p2p_help_commands()
+    print(f"Web server running at http://{host}:{http_port}")
+    server_ready.set() # Server is ready
+
+    async with p2p, http:
+        await asyncio.gather(p2p.serve_forever(), http.serve_forever())
+# end async_servers()
+
+def run_async_servers(peer_id, host, port, http_port):
+    """
+    Runs the asyncio servers. Blocks, so it is started on its own thread
+    """
+    asyncio.run(async_servers(peer_id, host, port, http_port))
+# end run_async_servers()
+#-----------------------------#
+# end of Asyncio Server Mode  #
+#-----------------------------#
+
+
+
 #---------------------------------#
 #---# Command Line Management #---#
 #                                 #
@@ -1170,7 +4654,7 @@ def command_list(option="both"):
             'remote': list files NOT stored locally
             'both': list files stored locally as well as files NOT stored locally
     """
-    metadata = load_metadata()
+    metadata = metadata_store.snapshot()
 
     if option=="local":
         files = get_local_file_entries(metadata)
@@ -1219,11 +4703,13 @@ def parse_cli_args():
     Parses the command line interface arguments provided at runtime, and sets program values accordingly
 
     Expected arguments are:
-        python peer.py <peer_id> [host] [p2p_port] [http_port] [base_path] --debug
+        python peer.py <peer_id> [host] [p2p_port] [http_port] [base_path] --debug --no-journal --async
 
         --debug is an optional flag to enable [DEBUG] print lines at runtime. Useful in testing.
+        --no-journal is an optional flag to rewrite metadata.json on every save instead of journaling changes.
+        --async is an optional flag to serve P2P and HTTP connections from an asyncio event loop instead of a thread per connection.
     """
-    global DEBUG_ENABLED
+    global DEBUG_ENABLED, METADATA_JOURNAL_ENABLED, ASYNC_ENABLED
 
     args = sys.argv[1:]
 
@@ -1231,6 +4717,14 @@ def parse_cli_args():
         DEBUG_ENABLED = True
         args.remove("--debug")
 
+    if "--no-journal" in args: # Check if the journal should be disabled
+        METADATA_JOURNAL_ENABLED = False
+        args.remove("--no-journal")
+
+    if "--async" in args: # Check if the asyncio servers should be used
+        ASYNC_ENABLED = True
+        args.remove("--async")
+
     if not (1 <= len(args) <= 5): # Check if we received any flags
         print("Usage: python peer.py <peer_id> [host] [p2p_port] [http_port] [base_path]")
         sys.exit(1) # exit if it's wrong and guide user
@@ -1309,6 +4803,7 @@ def command_line(my_peer_id):
 
             case "exit":
                 # exit program
+                announce_coalescer.flush() # don't lose announcements still in their window
                 cleanup_on_exit(my_peer_id)
                 print(f"Exiting program...")
                 break
@@ -1332,12 +4827,21 @@ def main():
         print(f"{FILE_UPLOAD_PATH} directory missing. Creating directory.")
         os.mkdir(FILE_UPLOAD_PATH)
 
-    # ensure our metadata is fresh to our local files
-    cleanup_on_exit(peer_id) 
     # Load metadata
-    load_metadata()
-
-    server_thread = threading.Thread(target=p2p_server, args=(peer_id, host, p2p_port, http_port), daemon=True)
+    metadata_store.load(journal=METADATA_JOURNAL_ENABLED)
+    # ensure our metadata is fresh to our local files
+    cleanup_on_exit(peer_id)
+    metadata_store.start_flusher()
+    message_pool.start()
+    announce_coalescer.start()
+    event_bus.start(peer_id)
+    static_assets.load()
+
+    if ASYNC_ENABLED:
+        # the asyncio event loop serves both P2P and HTTP connections
+        server_thread = threading.Thread(target=run_async_servers, args=(peer_id, host, p2p_port, http_port), daemon=True)
+    else:
+        server_thread = threading.Thread(target=p2p_server, args=(peer_id, host, p2p_port, http_port), daemon=True)
     server_thread.start()
 
     server_ready.wait() # wait on P2P server to start
@@ -1346,6 +4850,7 @@ def main():
         first_gossip(host, p2p_port, peer_id) # Send a first gossip to a Well-Known-Host from this peer
     except KeyboardInterrupt:
         print("Exiting program...")
+        metadata_store.flush() # write out any pending metadata changes
         sys.exit(0)
 
     # attempt to load 3-5 files from other peers, after our first gossip
@@ -1357,13 +4862,18 @@ def main():
     gossip_thread = threading.Thread(target=interval_send_gossip, args=(host, p2p_port, peer_id), daemon=True)
     gossip_thread.start()
 
-    webserver_thread = threading.Thread(target=webserver, args=(host, http_port, peer_id,), daemon=True)
-    webserver_thread.start()
+    sync_thread = threading.Thread(target=interval_sync, args=(host, p2p_port, peer_id), daemon=True)
+    sync_thread.start()
+
+    if not ASYNC_ENABLED:
+        webserver_thread = threading.Thread(target=webserver, args=(host, http_port, peer_id,), daemon=True)
+        webserver_thread.start()
 
     try:
         command_line(peer_id)
     except KeyboardInterrupt:
         print("Exiting program...")
+        metadata_store.flush() # write out any pending metadata changes
         sys.exit(0)
 
 #end main()
@@ -1377,7 +4887,8 @@ def main():
 #                          #
 # does the things          #
 #--------------------------#
-main()
+if __name__ == "__main__":
+    main()
 #--------------------------#
 # end of The Main Program  #
 #--------------------------#
\ No newline at end of file
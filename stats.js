@@ -35,53 +35,241 @@ function formatTimestamp(timestamp) {
         String(date.getSeconds()).padStart(2, '0');
 }
 
+var PAGE_SIZE = 100; // files shown per page
+var statsVersion = null; // version of the stats we are showing, sent back to only get what changed
+var fileRows = {}; // key: file_id, value: the row of the file table showing it
+var lastPeers = []; // the peers we are showing, redrawn so their last seen times stay current
+var pageCursors = [null]; // cursors of the pages up to the one we are showing, null for the first
+var nextCursor = null; // cursor of the page after the one we are showing, null if it is the last
+var pageVersion = null; // version of the stats the page we are showing came from
+var pageTimer = null; // pending refresh of the page after files changed
+
+function renderPeers(peers) {
+    /*
+    Replaces the tracked peers table with peers
+    */
+    var peersTableBody = document.getElementById('peers');
+    peersTableBody.innerHTML = '';
+    peers.forEach(function(peer) {
+        var lastSeen = peer.last_seen ? timeSince(peer.last_seen) : "Unknown";     
+        var row = document.createElement('tr');
+        row.innerHTML = `
+            <td>${peer.peerId}</td>
+            <td>${peer.host}</td>
+            <td>${peer.port}</td>
+            <td>${lastSeen}</td>
+        `;
+        peersTableBody.appendChild(row);
+    });
+}
+
+function renderFile(file) {
+    /*
+    Adds the row for file to the file table, or updates its row if it has one
+    */
+    var row = fileRows[file.file_id];
+    if (!row) {
+        row = document.createElement('tr');
+        fileRows[file.file_id] = row;
+        document.getElementById('files').appendChild(row);
+    }
+    row.innerHTML = `
+        <td>${file.file_id}</td>
+        <td>${file.file_name}</td>
+        <td>${file.file_owner}</td>
+        <td>${file.file_size}</td>
+        <td>${formatTimestamp(file.file_timestamp)}</td>
+        <td>${file.has_copy ? 'Yes' : 'No'}</td>
+        <td>${file.peers_with_file.join(', ')}</td>
+    `;
+}
+
+function applyStats(data) {
+    /*
+    Shows the peers in data
+    */
+    document.getElementById('peer-id').textContent = data.peerId
+    lastPeers = data.peers;
+    renderPeers(lastPeers);
+    statsVersion = data.version;
+}
+
+function applyPage(data) {
+    /*
+    Shows the page of files in data, replacing the page we had
+    */
+    document.getElementById('files').innerHTML = '';
+    fileRows = {};
+    data.files.forEach(renderFile);
+    nextCursor = data.next_cursor;
+    pageVersion = data.version;
+
+    var first = (pageCursors.length - 1) * PAGE_SIZE;
+    document.getElementById('page-info').textContent = data.files.length ?
+        'Showing ' + (first + 1) + '-' + (first + data.files.length) + ' of ' + data.total :
+        'No files';
+    document.getElementById('page-prev').disabled = pageCursors.length == 1;
+    document.getElementById('page-next').disabled = !nextCursor;
+}
+
+function pageQuery() {
+    /*
+    Returns the /stats.json query for the page we are showing, from the filter and sort controls
+    */
+    var query = ['limit=' + PAGE_SIZE];
+    ['location', 'owner', 'prefix', 'sort', 'order'].forEach(function(name) {
+        var value = document.getElementById('page-' + name).value;
+        if (value) {
+            query.push(name + '=' + encodeURIComponent(value));
+        }
+    });
+    var cursor = pageCursors[pageCursors.length - 1];
+    if (cursor) {
+        query.push('cursor=' + encodeURIComponent(cursor));
+    }
+    return query.join('&');
+}
+
+function fetchPage() {
+    /*
+    Gets the page of files we are showing, unless the stats didn't change since we got it
+    */
+    var xhr = new XMLHttpRequest();
+    xhr.onreadystatechange = function() {
+        if (xhr.readyState === XMLHttpRequest.DONE && xhr.status === 200) {
+            applyPage(JSON.parse(xhr.responseText));
+        }
+    };
+    xhr.open('GET', '/stats.json?' + pageQuery(), true);
+    if (pageVersion) {
+        xhr.setRequestHeader('If-None-Match', '"' + pageVersion + '"');
+    }
+    xhr.send();
+}
+
+function refreshPage() {
+    /*
+    Gets the page again soon. Files that change together only cause one request
+    */
+    if (pageTimer === null) {
+        pageTimer = setTimeout(function() {
+            pageTimer = null;
+            fetchPage();
+        }, 1000);
+    }
+}
+
+function firstPage() {
+    pageCursors = [null];
+    pageVersion = null;
+    fetchPage();
+}
+
+function nextPage() {
+    if (nextCursor) {
+        pageCursors.push(nextCursor);
+        pageVersion = null;
+        fetchPage();
+    }
+}
+
+function prevPage() {
+    if (pageCursors.length > 1) {
+        pageCursors.pop();
+        pageVersion = null;
+        fetchPage();
+    }
+}
+
 function fetchStats() {
+    /*
+    Gets the peers, with no files, then the page of files if the stats changed
+    */
     var xhr = new XMLHttpRequest();
     xhr.onreadystatechange = function() {
         if (xhr.readyState === XMLHttpRequest.DONE) {
             if (xhr.status === 200) {
-                var data = JSON.parse(xhr.responseText);
-
-                // Update peer id
-                document.getElementById('peer-id').textContent = data.peerId
-
-                // Update peer stats
-                var peersTableBody = document.getElementById('peers');
-                peersTableBody.innerHTML = '';
-                data.peers.forEach(function(peer) {
-                    var lastSeen = peer.last_seen ? timeSince(peer.last_seen) : "Unknown";     
-                    var row = document.createElement('tr');
-                    row.innerHTML = `
-                        <td>${peer.peerId}</td>
-                        <td>${peer.host}</td>
-                        <td>${peer.port}</td>
-                        <td>${lastSeen}</td>
-                    `;
-                    peersTableBody.appendChild(row);
-                });
-
-                // Update file table
-                var tableBody = document.getElementById('files');
-                tableBody.innerHTML = '';
-                data.files.forEach(function(file) {
-                    var row = document.createElement('tr');
-                    row.innerHTML = `
-                        <td>${file.file_id}</td>
-                        <td>${file.file_name}</td>
-                        <td>${file.file_owner}</td>
-                        <td>${file.file_size}</td>
-                        <td>${formatTimestamp(file.file_timestamp)}</td>
-                        <td>${file.has_copy ? 'Yes' : 'No'}</td>
-                        <td>${file.peers_with_file.join(', ')}</td>
-                    `;
-                    tableBody.appendChild(row);
-                });
+                applyStats(JSON.parse(xhr.responseText));
+                fetchPage();
+            } else if (xhr.status === 304) {
+                renderPeers(lastPeers); // nothing changed since the version we have
             }
         }
     };
-    xhr.open('GET', '/stats.json', true);
+    xhr.open('GET', '/stats.json?limit=0', true);
+    if (statsVersion) {
+        xhr.setRequestHeader('If-None-Match', '"' + statsVersion + '"');
+    }
     xhr.send();
 }
 
-setInterval(fetchStats, 5000);
-window.onload = fetchStats;
+var peerRows = {}; // key: peerId, value: the peer as last pushed by /events
+
+function showPeers() {
+    /*
+    Redraws the peers table from peerRows
+    */
+    lastPeers = Object.values(peerRows);
+    renderPeers(lastPeers);
+}
+
+function startPolling() {
+    fetchStats();
+    setInterval(fetchStats, 5000);
+}
+
+function startEvents() {
+    /*
+    Listens to /events, where the peer pushes changes as they happen. Falls back to polling
+    /stats.json if the browser or the peer doesn't support it.
+    The snapshot only has the peers, the files are shown a page at a time from /stats.json
+    */
+    ['location', 'owner', 'prefix', 'sort', 'order'].forEach(function(name) {
+        document.getElementById('page-' + name).onchange = firstPage;
+    });
+    document.getElementById('page-prev').onclick = prevPage;
+    document.getElementById('page-next').onclick = nextPage;
+
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+    var opened = false;
+    var source = new EventSource('/events?limit=0');
+
+    source.addEventListener('snapshot', function(e) {
+        opened = true;
+        var data = JSON.parse(e.data);
+        peerRows = {};
+        data.peers.forEach(function(peer) { peerRows[peer.peerId] = peer; });
+        applyStats(data);
+        fetchPage();
+    });
+    ['peer-joined', 'peer-updated'].forEach(function(type) {
+        source.addEventListener(type, function(e) {
+            var peer = JSON.parse(e.data);
+            peerRows[peer.peerId] = peer;
+            showPeers();
+        });
+    });
+    source.addEventListener('peer-expired', function(e) {
+        delete peerRows[JSON.parse(e.data).peerId];
+        showPeers();
+    });
+    // any file change can move files in or out of the page, so get it again
+    ['file-added', 'file-updated', 'file-removed'].forEach(function(type) {
+        source.addEventListener(type, refreshPage);
+    });
+    source.onerror = function() {
+        // once connected, EventSource reconnects by itself and gets a new snapshot
+        if (!opened) {
+            source.close();
+            startPolling();
+        }
+    };
+
+    // keep the last seen times current between events
+    setInterval(function() { renderPeers(lastPeers); }, 5000);
+}
+
+window.onload = startEvents;
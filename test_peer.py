@@ -0,0 +1,731 @@
+"""
+Tests for peer.py
+
+Run with: python -m pytest test_peer.py
+"""
+
+import os
+import json
+import asyncio
+import socket
+import hashlib
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import peer
+
+
+class EmptyFileTests(unittest.TestCase):
+    """Sending files with no bytes in them, which sendfile() can't be asked to do"""
+
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.mkdir(peer.FILE_UPLOAD_PATH)
+        open(os.path.join(peer.FILE_UPLOAD_PATH, "empty"), "wb").close()
+        peer.update_metadata("empty", {
+            "file_id": "empty",
+            "file_name": "empty.txt",
+            "file_size": 0,
+            "file_owner": "me",
+            "file_timestamp": 1,
+            "peers_with_file": ["me"],
+        })
+        self.sender, self.receiver = socket.socketpair()
+        self.receiver.settimeout(5)
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+        os.chdir(self.old_cwd)
+        self.tmp.cleanup()
+
+    def test_stream_file_empty(self):
+        with open(os.path.join(peer.FILE_UPLOAD_PATH, "empty"), "rb") as f:
+            peer.stream_file(self.sender, f, 0, 0)
+        self.sender.close()
+        self.assertEqual(self.receiver.recv(1), b"")
+
+    def test_get_empty_file(self):
+        msg = peer.msg_build_get("empty")
+        peer.receive_msg_get(msg, self.sender)
+        reply = peer.receive_message(peer.MessageReader(self.receiver))
+        self.assertEqual(reply["type"], "FILE_DATA")
+        self.assertEqual(reply["file_id"], "empty")
+        self.assertEqual(reply["data_length"], 0)
+        self.assertEqual(bytes(reply["data"]), b"")
+
+    def test_get_empty_chunk(self):
+        msg = peer.msg_build_get("empty", 0, peer.DOWNLOAD_CHUNK_SIZE)
+        peer.receive_msg_get(msg, self.sender)
+        reply = peer.receive_message(peer.MessageReader(self.receiver))
+        self.assertEqual(reply["file_id"], "empty")
+        self.assertEqual(reply["data_length"], 0)
+
+    def test_get_empty_file_async(self):
+        async def serve():
+            _, writer = await asyncio.open_connection(sock=self.sender)
+            await peer.receive_msg_get_async(peer.msg_build_get("empty"), writer)
+            writer.close()
+
+        peer.message_pool.start()
+        asyncio.run(serve())
+        reply = peer.receive_message(peer.MessageReader(self.receiver))
+        self.assertEqual(reply["file_id"], "empty")
+        self.assertEqual(bytes(reply["data"]), b"")
+# end EmptyFileTests
+
+
+class MessageReaderTests(unittest.TestCase):
+    """Parsing framed and legacy messages, and the raw data of binary FILE_DATA"""
+
+    def read_all(self, data):
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            sender.sendall(data)
+            sender.close()
+            reader = peer.MessageReader(receiver)
+            msgs = []
+            while (msg := peer.receive_message(reader)) is not None:
+                msgs.append(msg)
+            return msgs
+
+    def mixed(self, framed):
+        msgs = [
+            {"type": "A", "s": 'we{ird"} \\ "x[', "n": [1, {"a": "}"}]},
+            {"type": "FILE_DATA", "encoding": "binary", "file_id": "x", "data_length": 5},
+            {"type": "B", "s": "\\\\"},
+        ]
+        data = b"".join(peer.encode_message(msg, framed) for msg in msgs[:2]) + b"\xff\x00{\"}"
+        data += peer.encode_message(msgs[2], framed) + b"  \n" + peer.encode_message({"type": "C"}, not framed)
+        return msgs, data
+
+    def check_mixed(self, msgs, got):
+        self.assertEqual(got[0], msgs[0])
+        self.assertEqual(bytes(got[1].pop("data")), b"\xff\x00{\"}")
+        self.assertEqual(got[1:], msgs[1:] + [{"type": "C"}])
+
+    def test_framed_and_legacy(self):
+        for framed in (False, True):
+            msgs, data = self.mixed(framed)
+            self.check_mixed(msgs, self.read_all(data))
+
+    def test_one_byte_at_a_time(self):
+        for framed in (False, True):
+            msgs, data = self.mixed(framed)
+            sender, receiver = socket.socketpair()
+            with sender, receiver:
+                def send():
+                    for n in range(len(data)):
+                        sender.sendall(data[n:n + 1])
+                    sender.close()
+                threading.Thread(target=send).start()
+                reader = peer.MessageReader(receiver)
+                got = []
+                while (msg := peer.receive_message(reader)) is not None:
+                    got.append(msg)
+            self.check_mixed(msgs, got)
+
+    def test_async_reader(self):
+        async def read_all(data):
+            stream = asyncio.StreamReader()
+            for n in range(0, len(data), 3):
+                stream.feed_data(data[n:n + 3])
+            stream.feed_eof()
+            reader = peer.AsyncMessageReader(stream)
+            got = []
+            while (msg := await peer.receive_message_async(reader)) is not None:
+                got.append(msg)
+            return got
+
+        for framed in (False, True):
+            msgs, data = self.mixed(framed)
+            self.check_mixed(msgs, asyncio.run(read_all(data)))
+
+    def test_bad_input(self):
+        with self.assertRaisesRegex(ConnectionError, "not a JSON message"):
+            self.read_all(b"hello")
+        with self.assertRaisesRegex(ConnectionError, "before valid JSON"):
+            self.read_all(b'{"type": "A"')
+        with self.assertRaisesRegex(ConnectionError, "bad frame header"):
+            self.read_all(b"\x00XXX" + bytes(4))
+        with self.assertRaisesRegex(ConnectionError, "larger than"):
+            self.read_all(peer.FRAME_HEADER.pack(peer.FRAME_MAGIC, peer.MAX_FRAME_SIZE + 1))
+
+    def file_data(self, data_length):
+        return peer.encode_message({"type": "FILE_DATA", "encoding": "binary", "file_id": "x", "data_length": data_length}, True)
+
+    def test_file_data_length_capped(self):
+        with self.assertRaisesRegex(ConnectionError, "larger than"):
+            self.read_all(self.file_data(peer.MAX_FILE_DATA_SIZE + 1))
+
+    def test_file_data_length_checked(self):
+        for data_length in (-1, "5", None, 1.5, True):
+            with self.assertRaisesRegex(ConnectionError, "bad data_length"):
+                self.read_all(self.file_data(data_length))
+# end MessageReaderTests
+
+
+class MetadataJournalTests(unittest.TestCase):
+    """Metadata changes are journaled, replayed over the snapshot on load, and compacted"""
+
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.store = self.new_store()
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        self.tmp.cleanup()
+
+    def new_store(self):
+        store = peer.MetadataStore("metadata.json", "metadata.journal")
+        store.load()
+        return store
+
+    def put(self, store, file_id, timestamp=1):
+        store.update(file_id, {"file_id": file_id, "file_name": file_id, "file_timestamp": timestamp})
+
+    def test_replay(self):
+        self.put(self.store, "a")
+        self.put(self.store, "b")
+        self.store.add_peer("a", "p1")
+        self.store.merge([{"file_id": "c", "file_timestamp": 1}], "p2")
+        self.store.delete("b")
+        self.store.flush()
+        self.assertEqual(peer.load_metadata("metadata.json"), {}) # only the journal was written
+
+        loaded = self.new_store()
+        self.assertEqual(loaded.snapshot(), self.store.snapshot())
+        self.assertEqual(loaded.holders_of("a"), ["p1"])
+        self.assertEqual(loaded.files_held_by("p2"), {"c"})
+
+    def test_partial_record_dropped(self):
+        self.put(self.store, "a")
+        self.store.flush()
+        with open("metadata.journal", "ab") as f:
+            f.write(b'{"op": "put", "file_id": "torn"')
+        loaded = self.new_store()
+        self.assertEqual(set(loaded.snapshot()), {"a"})
+
+        # new records don't land on the cut off one
+        self.put(loaded, "b")
+        loaded.flush()
+        self.assertEqual(set(self.new_store().snapshot()), {"a", "b"})
+
+    def test_compaction(self):
+        with mock.patch.object(peer, "METADATA_JOURNAL_MAX_SIZE", 200):
+            for n in range(5):
+                self.put(self.store, f"file-{n}")
+                self.store.flush()
+        self.assertLess(os.path.getsize("metadata.journal"), 200)
+        self.assertIn("file-0", peer.load_metadata("metadata.json"))
+        self.assertEqual(self.new_store().snapshot(), self.store.snapshot())
+
+    def test_snapshot_mode(self):
+        self.put(self.store, "a")
+        self.store.flush()
+        store = peer.MetadataStore("metadata.json", "metadata.journal")
+        store.load(journal=False) # folds the journal into the snapshot
+        self.assertEqual(os.path.getsize("metadata.journal"), 0)
+        self.put(store, "b")
+        store.flush()
+        self.assertEqual(set(peer.load_metadata("metadata.json")), {"a", "b"})
+# end MetadataJournalTests
+
+
+class MetadataMergeTests(unittest.TestCase):
+    """Malformed entries from peers are skipped instead of failing the whole batch"""
+
+    def test_merge_skips_malformed(self):
+        entries = [
+            {"file_id": "merge-no-timestamp", "file_name": "a"},
+            {"file_id": "merge-bad-timestamp", "file_timestamp": "yesterday"},
+            {"file_timestamp": 1},
+            "not an entry",
+            {"file_id": "merge-good", "file_name": "b", "file_timestamp": 1},
+        ]
+        self.assertEqual(peer.metadata_store.merge(entries, "other"), {"merge-good"})
+        self.assertNotIn("merge-no-timestamp", peer.metadata_store)
+        self.assertEqual(peer.metadata_store.holders_of("merge-good"), ["other"])
+
+    def test_update_skips_malformed_newer(self):
+        peer.update_metadata("merge-known", {"file_id": "merge-known", "file_timestamp": 1})
+        self.assertFalse(peer.update_metadata("merge-known", {"file_id": "merge-known"}))
+        self.assertEqual(peer.metadata_store.get("merge-known")["file_timestamp"], 1)
+# end MetadataMergeTests
+
+
+class ChunkServer:
+    """Answers ranged GET_FILEs for file_metadata with slices of content, like a peer that supports ranges"""
+
+    def __init__(self, content, file_metadata, max_requests=None):
+        self.content = content
+        self.file_metadata = file_metadata
+        self.max_requests = max_requests # after this many chunks, connections are dropped
+        self.requests = 0
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return # closed
+            threading.Thread(target=self.serve, args=(client,), daemon=True).start()
+
+    def serve(self, client):
+        with client:
+            reader = peer.MessageReader(client)
+            try:
+                while (msg := peer.receive_message(reader)) is not None:
+                    if msg.get("type") != "GET_FILE":
+                        continue
+                    if self.requests == self.max_requests:
+                        return
+                    self.requests += 1
+                    data = self.content[msg["offset"]:msg["offset"] + msg["length"]]
+                    header = peer.msg_build_file_chunk_header(len(data), self.file_metadata, msg["offset"], len(self.content), hashlib.sha256(data).hexdigest())
+                    client.sendall(peer.encode_message(header, True) + data)
+            except OSError:
+                pass
+
+    def close(self):
+        self.listener.close()
+# end ChunkServer
+
+
+class SwarmDownloadTests(unittest.TestCase):
+    """Chunked downloads are resumable, and only kept when they hash to their file_id"""
+
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.mkdir(peer.FILE_UPLOAD_PATH)
+        patcher = mock.patch.object(peer, "DOWNLOAD_CHUNK_SIZE", 1024)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.content = os.urandom(5 * 1024 + 100)
+        self.file_id = peer.hash_sha256(self.content, 1.5)
+        self.file_metadata = {
+            "file_id": self.file_id,
+            "file_name": "swarm.bin",
+            "file_size": len(self.content),
+            "file_owner": "owner",
+            "file_timestamp": 1.5,
+        }
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+            peer.tracked_peers.remove(f"swarm-{server.port}")
+        os.chdir(self.old_cwd)
+        self.tmp.cleanup()
+
+    def serve(self, content, max_requests=None):
+        server = ChunkServer(content, self.file_metadata, max_requests)
+        self.servers.append(server)
+        peer.tracked_peers.update("127.0.0.1", server.port, f"swarm-{server.port}", ["ranges", "framed", "binary"])
+        return f"swarm-{server.port}"
+
+    def download(self, peers):
+        return peer.download_file_swarm(self.file_id, peers, "me")
+
+    def test_download(self):
+        self.assertTrue(self.download([self.serve(self.content), self.serve(self.content)]))
+        with open(os.path.join(peer.FILE_UPLOAD_PATH, self.file_id), "rb") as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertEqual(os.listdir(peer.FILE_UPLOAD_PATH), [self.file_id])
+
+    def test_resume(self):
+        self.assertFalse(self.download([self.serve(self.content, max_requests=2)]))
+        progress = peer.load_download_progress(self.file_id)
+        self.assertEqual(progress["done"], {0, 1})
+        self.assertFalse(os.path.exists(os.path.join(peer.FILE_UPLOAD_PATH, self.file_id)))
+
+        peer_id = self.serve(self.content)
+        self.assertTrue(self.download([peer_id]))
+        self.assertEqual(self.servers[-1].requests, peer.chunk_count(len(self.content), 1024) - 2)
+        with open(os.path.join(peer.FILE_UPLOAD_PATH, self.file_id), "rb") as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertEqual(os.listdir(peer.FILE_UPLOAD_PATH), [self.file_id])
+
+    def test_progress_of_other_chunk_size_ignored(self):
+        self.assertFalse(self.download([self.serve(self.content, max_requests=2)]))
+        with mock.patch.object(peer, "DOWNLOAD_CHUNK_SIZE", 2048):
+            self.assertIsNone(peer.load_download_progress(self.file_id))
+
+    def test_wrong_content_discarded(self):
+        wrong = bytes(len(self.content)) # every chunk_sha256 matches, but not the file_id
+        self.assertFalse(self.download([self.serve(wrong)]))
+        self.assertEqual(os.listdir(peer.FILE_UPLOAD_PATH), [])
+        self.assertIsNone(peer.metadata_store.get(self.file_id))
+# end SwarmDownloadTests
+
+
+class SyncTests(unittest.TestCase):
+    """Two peers' metadata converges through a SYNC exchange"""
+
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+
+    def tearDown(self):
+        peer.tracked_peers.remove("sync-a")
+        peer.tracked_peers.remove("sync-b")
+        os.chdir(self.old_cwd)
+        self.tmp.cleanup()
+
+    def store(self, name, file_ids, timestamp=1):
+        store = peer.MetadataStore(f"{name}.json", f"{name}.journal")
+        for file_id in file_ids:
+            store.update(file_id, {"file_id": file_id, "file_name": file_id[:8], "file_timestamp": timestamp})
+        return store
+
+    def exchange(self, first, second):
+        """Run a sync started by first until the stores agree. Returns the number of SYNC messages"""
+        sent = []
+        capture = lambda my_host, my_port, my_peer_id, to_host, to_port, step: sent.append(step)
+        with mock.patch.object(peer, "metadata_store", first):
+            step = peer.sync_start()
+        sides = [(second, "sync-a", 9005), (first, "sync-b", 9006)]
+        messages = 0
+        while step is not None:
+            self.assertLess(messages, 20)
+            store, from_peer, port = sides[messages % 2]
+            msg = peer.msg_build_sync("localhost", port, from_peer, **step)
+            messages += 1
+            with mock.patch.object(peer, "metadata_store", store), mock.patch.object(peer, "msg_send_sync", capture):
+                peer.receive_msg_sync(msg, "me", "localhost", 9000)
+            step = sent.pop() if sent else None
+        return messages
+
+    def file_ids(self, start, stop):
+        return [hashlib.sha256(str(n).encode()).hexdigest() for n in range(start, stop)]
+
+    def test_converges(self):
+        a = self.store("a", self.file_ids(0, 900))
+        b = self.store("b", self.file_ids(100, 1000))
+        b.update(self.file_ids(500, 501)[0], {"file_id": self.file_ids(500, 501)[0], "file_name": "newer", "file_timestamp": 2})
+
+        self.exchange(a, b)
+        self.assertEqual(a.snapshot(), b.snapshot())
+        self.assertEqual(len(a), 1000)
+        self.assertEqual(a.get(self.file_ids(500, 501)[0])["file_name"], "newer")
+        self.assertEqual(a.digest.hash(""), b.digest.hash(""))
+
+    def test_in_sync_is_one_message(self):
+        a = self.store("a", self.file_ids(0, 200))
+        b = self.store("b", self.file_ids(0, 200))
+        self.assertEqual(self.exchange(a, b), 1)
+
+    def test_small_difference_stays_small(self):
+        a = self.store("a", self.file_ids(0, 2000))
+        b = self.store("b", self.file_ids(0, 2001))
+        sent_entries = []
+        merge = peer.MetadataStore.merge
+        def counting_merge(store, entries, peer_id, removed=()):
+            sent_entries.extend(entries)
+            return merge(store, entries, peer_id, removed)
+        with mock.patch.object(peer.MetadataStore, "merge", counting_merge):
+            self.exchange(a, b)
+        self.assertEqual(len(a), 2001)
+        self.assertLessEqual(len(sent_entries), peer.SYNC_LEAF_ENTRIES * 2)
+# end SyncTests
+
+
+class InventoryTests(unittest.TestCase):
+    """Inventory only rescans FileUploads when a local file may have changed"""
+
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.mkdir(peer.FILE_UPLOAD_PATH)
+        self.inventory = peer.Inventory()
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        self.tmp.cleanup()
+
+    def put(self, file_id, local):
+        if local:
+            open(os.path.join(peer.FILE_UPLOAD_PATH, file_id), "wb").close()
+        peer.update_metadata(file_id, {
+            "file_id": file_id,
+            "file_name": file_id,
+            "file_size": 0,
+            "file_owner": "owner",
+            "file_timestamp": 1,
+        })
+        if local:
+            peer.metadata_store.local_files_changed()
+
+    def test_remote_changes_keep_version(self):
+        self.put("local-1", True)
+        version = self.inventory.reply_files()["inventory"]
+        self.put("remote-1", False)
+        peer.add_peer_to_file("local-1", "other")
+        reply = self.inventory.reply_files(version)
+        self.assertEqual(reply["inventory"], version)
+        self.assertEqual(reply["files"], [])
+
+    def test_replies_carry_current_holders(self):
+        self.put("local-2", True)
+        self.inventory.reply_files()
+        peer.add_peer_to_file("local-2", "other")
+        files = {entry["file_id"]: entry for entry in self.inventory.reply_files()["files"]}
+        self.assertIn("other", files["local-2"]["peers_with_file"])
+
+    def test_merge_does_not_stat(self):
+        self.inventory.reply_files()
+        with mock.patch.object(peer.os.path, "isfile", side_effect=AssertionError("stat on merge")):
+            peer.metadata_store.merge([{"file_id": "remote-2", "file_timestamp": 1}], "other")
+        self.assertNotIn("remote-2", self.inventory.local_file_ids())
+
+    def test_pushed_file(self):
+        version = self.inventory.reply_files()["inventory"]
+        with open("pushed.txt", "wb") as f:
+            f.write(b"pushed")
+        peer.push_file("pushed.txt", "me")
+        reply = self.inventory.reply_files(version)
+        self.assertEqual([entry["file_name"] for entry in reply["files"]], ["pushed.txt"])
+
+    def test_saved_file_with_known_metadata(self):
+        self.put("known", False)
+        self.assertNotIn("known", self.inventory.local_file_ids())
+        open(os.path.join(peer.FILE_UPLOAD_PATH, "known"), "wb").close()
+        peer.file_received(peer.metadata_store.get("known"), "me")
+        self.assertIn("known", self.inventory.local_file_ids())
+# end InventoryTests
+
+
+class FileFilterTests(unittest.TestCase):
+    """Gossip only carries the bits of a file filter to peers behind on its version"""
+
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.mkdir(peer.FILE_UPLOAD_PATH)
+        open(os.path.join(peer.FILE_UPLOAD_PATH, "filtered"), "wb").close()
+        peer.update_metadata("filtered", {"file_id": "filtered", "file_timestamp": 1})
+        peer.metadata_store.local_files_changed()
+
+    def tearDown(self):
+        peer.holder_filters.forget("filter-a")
+        os.chdir(self.old_cwd)
+        self.tmp.cleanup()
+
+    def test_gossip_carries_version_only(self):
+        gossip = peer.msg_build_gossip("localhost", 9003, "me")
+        self.assertEqual(set(gossip["file_filter"]), {"epoch", "version"})
+
+    def test_reply_bits_only_when_behind(self):
+        full = peer.msg_build_gossip_reply("localhost", 9003, "me")
+        self.assertIn("bits", full["file_filter"])
+        self.assertTrue(peer.holder_filters.update("filter-a", full["file_filter"]))
+        self.assertTrue(peer.holder_filters.may_hold("filter-a", "filtered"))
+
+        delta = peer.msg_build_gossip_reply("localhost", 9003, "me", full["inventory"])
+        self.assertEqual(delta["file_filter"], full["inventory"])
+        self.assertTrue(peer.holder_filters.update("filter-a", delta["file_filter"]))
+
+    def test_missing_filter_asks_for_everything(self):
+        peer.tracked_peers.update("localhost", 9004, "filter-b")
+        self.addCleanup(peer.tracked_peers.remove, "filter-b")
+        reply = {
+            "type": "GOSSIP_REPLY", "host": "localhost", "port": 9004, "peerId": "filter-b",
+            "files": [], "inventory": {"epoch": "e", "version": 3},
+            "file_filter": {"epoch": "e", "version": 3},
+        }
+        peer.receive_msg_gossip_reply(reply, "me", "localhost", 9003)
+        self.assertNotIn("filter-b", peer.inventory.known_versions())
+# end FileFilterTests
+
+
+class StatsCacheTests(unittest.TestCase):
+    """/stats.json keeps its version while peers are only being seen again"""
+
+    def get(self, path, etag=None, gzip=False):
+        request = f"GET {path} HTTP/1.1\r\nHost: test\r\n"
+        if etag:
+            request += f"If-None-Match: {etag}\r\n"
+        if gzip:
+            request += "Accept-Encoding: gzip\r\n"
+        response, _ = peer.http_response(request + "\r\n", "me")
+        head, _, body = response.partition(b"\r\n\r\n")
+        return head.split(b"\r\n")[0], body
+
+    def version(self):
+        return json.loads(self.get("/stats.json")[1])["version"]
+
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.mkdir(peer.FILE_UPLOAD_PATH)
+
+    def tearDown(self):
+        for peer_id in ("stats-a", "stats-b"):
+            peer.tracked_peers.remove(peer_id)
+        os.chdir(self.old_cwd)
+        self.tmp.cleanup()
+
+    def test_seen_again_keeps_version(self):
+        peer.tracked_peers.update("localhost", 9001, "stats-a")
+        version = self.version()
+        peer.tracked_peers.update("localhost", 9001, "stats-a")
+        self.assertEqual(self.version(), version)
+        status, body = self.get("/stats.json", f'"{version}"')
+        self.assertEqual(status, b"HTTP/1.1 304 Not Modified")
+        self.assertEqual(body, b"")
+
+    def test_not_modified_skips_compression(self):
+        version = self.version()
+        compress = peer.stats_cache.compress
+        peer.stats_cache.compress = lambda body: self.fail("compressed for a 304")
+        try:
+            status, _ = self.get("/stats.json?limit=10", f'W/"{version}-gzip"', gzip=True)
+        finally:
+            peer.stats_cache.compress = compress
+        self.assertEqual(status, b"HTTP/1.1 304 Not Modified")
+
+    def test_holder_change_rebuilds_one_row(self):
+        for n in range(3):
+            peer.update_metadata(f"stats-file-{n}", {"file_id": f"stats-file-{n}", "file_name": "f", "file_timestamp": 1})
+        version = self.version()
+        with mock.patch.object(peer.stats_cache, "row", wraps=peer.stats_cache.row) as row:
+            peer.add_peer_to_file("stats-file-1", "stats-a")
+            document = json.loads(self.get("/stats.json")[1])
+        self.assertEqual([call.args[0] for call in row.call_args_list], ["stats-file-1"])
+        self.assertNotEqual(document["version"], version)
+        files = {entry["file_id"]: entry for entry in document["files"]}
+        self.assertIn("stats-a", files["stats-file-1"]["peers_with_file"])
+
+    def pages(self, query):
+        """Return the file_names of every page of query, following next_cursor, and the total"""
+        names, cursor = [], None
+        while True:
+            document = json.loads(self.get(f"/stats.json?{query}" + (f"&cursor={cursor}" if cursor else ""))[1])
+            names.extend(row["file_name"] for row in document["files"])
+            cursor = document["next_cursor"]
+            if cursor is None:
+                return names, document["total"]
+            self.assertLessEqual(len(names), 100)
+
+    def owner(self):
+        return f"stats-{self._testMethodName}" # the metadata store is shared between tests
+
+    def put_owned(self, name, size):
+        file_id = f"{self.owner()}-{name}"
+        peer.update_metadata(file_id, {"file_id": file_id, "file_name": name, "file_size": size, "file_owner": self.owner(), "file_timestamp": 1})
+
+    def test_pages(self):
+        sizes = {"apple": 5, "avocado": 1, "banana": 3, "blueberry": 3, "cherry": 9, "date": 2, "elder": 7}
+        for name, size in sizes.items():
+            self.put_owned(name, size)
+
+        self.assertEqual(self.pages(f"owner={self.owner()}&limit=3"), (sorted(sizes), 7))
+        by_size = sorted(sizes, key=lambda name: (sizes[name], f"{self.owner()}-{name}"), reverse=True)
+        self.assertEqual(self.pages(f"owner={self.owner()}&limit=2&sort=size&order=desc"), (by_size, 7))
+        self.assertEqual(self.pages(f"owner={self.owner()}&prefix=b&limit=1"), (["banana", "blueberry"], 2))
+        self.assertEqual(self.pages("owner=nobody"), ([], 0))
+
+    def test_cursor_survives_inserts(self):
+        for name in ("m1", "m2", "m3", "m4"):
+            self.put_owned(name, 1)
+        first = json.loads(self.get(f"/stats.json?owner={self.owner()}&prefix=m&limit=2")[1])
+        self.assertEqual([row["file_name"] for row in first["files"]], ["m1", "m2"])
+        self.put_owned("m0", 1) # before the cursor, doesn't shift the next page
+        second = json.loads(self.get(f"/stats.json?owner={self.owner()}&prefix=m&limit=2&cursor={first['next_cursor']}")[1])
+        self.assertEqual([row["file_name"] for row in second["files"]], ["m3", "m4"])
+
+    def test_bad_cursor_starts_over(self):
+        for name in ("z1", "z2"):
+            self.put_owned(name, 1)
+        by_size = json.loads(self.get(f"/stats.json?owner={self.owner()}&prefix=z&limit=1&sort=size")[1])
+        for cursor in ("garbage", by_size["next_cursor"]): # a size cursor on a name sort is ignored
+            document = json.loads(self.get(f"/stats.json?owner={self.owner()}&prefix=z&limit=1&cursor={cursor}")[1])
+            self.assertEqual([row["file_name"] for row in document["files"]], ["z1"])
+
+    def test_join_changes_version(self):
+        version = self.version()
+        peer.tracked_peers.update("localhost", 9002, "stats-b")
+        document = json.loads(self.get("/stats.json")[1])
+        self.assertNotEqual(document["version"], version)
+        self.assertIn("stats-b", [row["peerId"] for row in document["peers"]])
+# end StatsCacheTests
+
+
+class MetricsTests(unittest.TestCase):
+    """Send failures have one series per tracked peer"""
+
+    def unused_port(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
+    def failures(self):
+        return dict(peer.metrics.send_failures.values)
+
+    def test_failures_by_peer_id(self):
+        port = self.unused_port()
+        peer.tracked_peers.update("127.0.0.1", port, "metrics-a")
+        self.assertFalse(peer.send_message({"type": "GOSSIP"}, "127.0.0.1", port))
+        self.assertEqual(self.failures().get("metrics-a"), 1)
+
+        removed = self.failures().get("removed", 0)
+        peer.remove_peer("127.0.0.1", port)
+        self.assertNotIn("metrics-a", self.failures())
+        self.assertEqual(self.failures()["removed"], removed + 1)
+
+    def test_untracked_address(self):
+        untracked = self.failures().get("untracked", 0)
+        self.assertFalse(peer.send_message({"type": "GOSSIP"}, "127.0.0.1", self.unused_port()))
+        self.assertEqual(self.failures()["untracked"], untracked + 1)
+        self.assertIn('peer_send_failures_total{peer="untracked"}', peer.metrics.render())
+# end MetricsTests
+
+
+class MessageWorkerPoolTests(unittest.TestCase):
+    """Full queues shed most messages, but never FILE_DATA"""
+
+    def fill(self, pool, msg_type):
+        for _ in range(peer.MESSAGE_QUEUE_LIMITS[msg_type]):
+            self.assertIsNotNone(pool.submit(msg_type, lambda: None))
+
+    def test_full_queue_sheds(self):
+        pool = peer.MessageWorkerPool(workers=1, reserved=0)
+        self.fill(pool, "GOSSIP")
+        self.assertIsNone(pool.submit("GOSSIP", lambda: None))
+        self.assertEqual(pool.rejected["GOSSIP"], 1)
+
+    def test_full_queue_waits_for_file_data(self):
+        pool = peer.MessageWorkerPool(workers=1, reserved=0)
+        self.fill(pool, "FILE_DATA")
+        futures = []
+        submitter = threading.Thread(target=lambda: futures.append(pool.submit("FILE_DATA", lambda: "pushed")))
+        submitter.start()
+        submitter.join(0.2)
+        self.assertTrue(submitter.is_alive()) # waiting for room
+
+        pool.start()
+        submitter.join(5)
+        self.assertFalse(submitter.is_alive())
+        self.assertEqual(futures[0].result(5), "pushed")
+        self.assertEqual(pool.rejected["FILE_DATA"], 0)
+# end MessageWorkerPoolTests
+
+
+if __name__ == "__main__":
+    unittest.main()